@@ -1,32 +1,120 @@
 #! /usr/bin/env python3
 # coding: utf-8
 
+import io
 import os
-from flask import Flask, request, redirect, jsonify, url_for, session, abort
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from flask import Flask, request, redirect, jsonify, url_for, session, abort, Response, stream_with_context, g
+from flask import copy_current_request_context, Request
 from flask_cors import CORS
-from apiflask import APIFlask
+from apiflask import APIFlask, HTTPError
 
 # from PIL import Image
 import cv2
 import numpy as np
 from json2html import json2html
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import HTTPException
+
+from api_internals.config_postgres import init_db, start_price_refresh, demo_queries
+from api_internals.config_apiflask import DamagesIn, PlatesIn, AllIn, DamagesFullOut, PlatesFullOut, AllFullOut, JobIn, JobOut
+from api_internals.config_apiflask import VideoIn
+from api_internals.predict_video import predict_video, spool_video, check_video, VideoTooLargeError
+from api_internals.predict_video import VIDEO_BATCH_SIZE, VIDEO_MAX_FRAMES
+from api_internals.predict_damages import predict_damages, iter_predict_damages, cdd_model_name, damage_cache
+from api_internals.predict_damages import ROI_DECODE
+from api_internals.predict_plates import predict_plates, iter_predict_plates, lpd_model_name, plate_cache
+from api_internals.jobs import JobStore
+from api_internals.dedup import mark_duplicates
+from api_internals.image_io import decode_reduced, read_upload, close_upload, read_image_size, get_decoded_bytes
+from api_internals.image_io import share_roi_images, decode_pool, MAX_IMAGE_PIXELS, UPLOAD_SPOOL_SIZE, ROI_MIN_SIDE
+from api_internals import lifecycle
+from api_internals import inference_workers
+from api_internals import metrics
+from api_internals.admission import AdmissionController, TokenBuckets, retry_after
+from api_internals.responses import RESPONSE_FORMATS, dumps, json_response, compact_damages, compact_plates
+from api_internals.config_severity import sev_model_name
+
+
+# --- Uploads: the files bigger than UPLOAD_SPOOL_SIZE bytes are written to a temporary file
+# (then memory mapped, see image_io.read_upload) instead of being kept in the worker memory
+
+# Maximum memory needed to decode all the images of a request (estimated from their headers)
+MAX_REQUEST_DECODED_BYTES = int(os.environ.get("MAX_REQUEST_DECODED_BYTES") or 768 * 1024 * 1024)
+
+# Maximum size of the requests (the videos have their own limit, see SpoolingRequest.max_content_length)
+MAX_CONTENT_LENGTH = int(os.environ.get("MAX_CONTENT_LENGTH") or 1024 * 1024 * 20)
+VIDEO_MAX_CONTENT_LENGTH = int(os.environ.get("VIDEO_MAX_CONTENT_LENGTH") or 1024 * 1024 * 500)
+
+
+class SpoolingRequest(Request):
+    """
+    A Flask request spooling its uploaded files to disk above UPLOAD_SPOOL_SIZE bytes,
+    with a higher size limit for the videos.
+    """
+
+    @property
+    def max_content_length(self):
+        if self.endpoint == "route_predict_video":
+            return VIDEO_MAX_CONTENT_LENGTH
+        return super().max_content_length
 
-from api_internals.config_postgres import init_db, demo_queries
-from api_internals.config_apiflask import DamagesIn, PlatesIn, DamagesFullOut, PlatesFullOut
-from api_internals.predict_damages import predict_damages, cdd_model_name
-from api_internals.predict_plates import predict_plates, lpd_model_name
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE, mode="rb+")
 
 
 # --- API Flask app ---
 # app = Flask(__name__)
 app = APIFlask(__name__)
+app.request_class = SpoolingRequest
 app.secret_key = "super secret key"
-app.config["MAX_CONTENT_LENGTH"] = 1024 * 1024 * 20
+app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
 
 CORS(app)
-init_db(app)
+# (the inference worker processes import this module when started from `python API_client_server.py`,
+# but they don't serve any request, see inference_workers)
+if inference_workers.WORKER_TASK is None:
+    init_db(app)
 # demo_queries()
 
+# --- Asynchronous jobs (long claims run in a local pool instead of the HTTP threads)
+job_store = JobStore(
+    max_workers=int(os.environ.get("JOBS_MAX_WORKERS") or 2),
+    max_pending=int(os.environ.get("JOBS_MAX_PENDING") or 16),
+    max_stored=int(os.environ.get("JOBS_MAX_STORED") or 256),
+    ttl=float(os.environ.get("JOBS_TTL") or 3600),
+    max_result_bytes=int(os.environ.get("JOBS_MAX_RESULT_BYTES") or 64 * 1024 * 1024),
+)
+
+JOB_TASKS = {"damages", "plates", "all"}
+
+# --- Admission control of the predict endpoints (per gunicorn worker):
+# at most ADMISSION_MAX_IMAGES images in flight, at most ADMISSION_MAX_WAITING requests waiting
+# for ADMISSION_MAX_WAIT seconds (single image requests first), the others get a 503 answer
+admission = AdmissionController(
+    max_images=int(os.environ.get("ADMISSION_MAX_IMAGES") or 32),
+    max_waiting=int(os.environ.get("ADMISSION_MAX_WAITING") or 16),
+    max_wait=float(os.environ.get("ADMISSION_MAX_WAIT") or 5),
+    small_request=int(os.environ.get("ADMISSION_SMALL_REQUEST") or 1),
+)
+ADMISSION_RETRY_AFTER = float(os.environ.get("ADMISSION_RETRY_AFTER") or 2)
+
+# The requests are admitted once their uploads are spooled, before they are validated or decoded
+ADMITTED_ENDPOINTS = {"route_predict_damages", "route_predict_plates", "route_predict_all"}
+
+# --- Rate limit per API key ('X-API-Key' header, or the client address): RATE_LIMIT images
+# per second with bursts of RATE_LIMIT_BURST images (RATE_LIMIT=0 disables it)
+RATE_LIMIT = float(os.environ.get("RATE_LIMIT") or 0)
+rate_limiter = TokenBuckets(RATE_LIMIT, int(os.environ.get("RATE_LIMIT_BURST") or 20)) if RATE_LIMIT > 0 else None
+
+# --- Shared pool running the damages & plates pipelines side by side (/predict_all)
+pipeline_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("PIPELINE_WORKERS") or 4),
+    thread_name_prefix="pipeline",
+)
+
 ALLOWED_EXTENSIONS = {
     "bmp",
     "dng",
@@ -38,20 +126,22 @@ ALLOWED_EXTENSIONS = {
     "tiff",
     "webp",
     "pfm",  # images
-    # "asf",
-    # "avi",
-    # "gif",
-    # "m4v",
-    # "mkv",
-    # "mov",
-    # "mp4",
-    # "mpeg",
-    # "mpg",
-    # "ts",
-    # "wmv",
-    # "webm",  # videos
+    "asf",
+    "avi",
+    "gif",
+    "m4v",
+    "mkv",
+    "mov",
+    "mp4",
+    "mpeg",
+    "mpg",
+    "ts",
+    "wmv",
+    "webm",  # videos (see /predict_video)
 }
 
+VIDEO_EXTENSIONS = {"asf", "avi", "gif", "m4v", "mkv", "mov", "mp4", "mpeg", "mpg", "ts", "wmv", "webm"}
+
 # --- DEFINE FUNCTIONS
 
 
@@ -89,7 +179,13 @@ def filter_images(f):
     """
 
     # filename = secure_filename(file.filename)
-    return allowed_file(f.filename)
+    return allowed_file(f.filename) and not is_video(f.filename)
+
+
+def is_video(filename):
+    """ Check if a file is a video (see /predict_video) based on its extension. """
+
+    return "." in filename and filename.rsplit(".", 1)[1].lower() in VIDEO_EXTENSIONS
 
 
 def prepare_images(filtered_files):
@@ -109,10 +205,22 @@ def prepare_images(filtered_files):
         - original_ratios (list): A list of image ratios to recover the original positions/sizes.
     """
 
-    preprocessed_data = [preprocess_image(x) for x in filtered_files]
+    # Read the uploads in the request thread, then decode / resize them in parallel
+    with metrics.timer("decode"):
+        buffers = [read_upload(f) for f in filtered_files]
+        preprocessed_data = list(decode_pool.map(decode_image, buffers))
+
+    for f, data in zip(filtered_files, preprocessed_data):
+        if data is None:
+            abort(400, description=f"The file '{f.filename}' is not a valid image.")
     preprocessed_data = list(map(list, zip(*preprocessed_data)))
 
     preprocessed_files, original_ratios = preprocessed_data[0], preprocessed_data[1]
+
+    # Cluster the near-identical images (only one image per cluster is predicted)
+    with metrics.timer("dedup"):
+        metrics.count_duplicates(mark_duplicates(filtered_files, preprocessed_files))
+
     return preprocessed_files, original_ratios
 
 
@@ -131,23 +239,58 @@ def preprocess_image(f):
         A tuple containing two elements:
         - resized (ndarray): A preprocessed image.
         - ratioW, ratioH (tuple): A tuple of ratios for the original image.
+
+    Raises
+    ------
+    BadRequest
+        If the file can't be decoded.
+    """
+
+    with metrics.timer("decode"):
+        data = decode_image(read_upload(f))
+    if data is None:
+        abort(400, description=f"The file '{f.filename}' is not a valid image.")
+    return data
+
+
+def decode_image(buffer):
+    """
+    Decode and resize an encoded image.
+
+    Parameters
+    ----------
+    buffer : bytes
+        The content of the uploaded image file.
+
+    Returns
+    -------
+    tuple of (ndarray, tuple)
+        A tuple containing two elements:
+        - resized (ndarray): A preprocessed image.
+        - ratioW, ratioH (tuple): A tuple of ratios for the original image.
+        None if the image can't be decoded (or is larger than the OpenCV limit, OPENCV_IO_MAX_IMAGE_PIXELS).
     """
 
     # Open POST file with PIL
     # image_bytes = Image.open(io.BytesIO(file.read()))
 
     # Open POST file with CV2
-
-    nparr = np.fromstring(f.read(), np.uint8)
-    image_bytes = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    # (JPEG files are decoded at a reduced scale, as close as possible to the 640x640 model input,
+    # the damages & plates are decoded again at a higher resolution if needed)
 
     newSize = 640
+    if buffer is None:
+        return None
+    image_bytes, original_size = decode_reduced(buffer, newSize)
+    if image_bytes is None:
+        return None
+
     resized = cv2.resize(
         image_bytes, (newSize, newSize), interpolation=cv2.INTER_LINEAR
     )
 
-    ratioW = image_bytes.shape[0] / newSize
-    ratioH = image_bytes.shape[1] / newSize
+    ratioW = original_size[0] / newSize
+    ratioH = original_size[1] / newSize
 
     return resized, (ratioW, ratioH)
 
@@ -193,14 +336,251 @@ def check_uploaded_files(request: request) -> list:
 
     filtered_files = list(filter(filter_images, files))
     if len(filtered_files) == 0:
+        if any(is_video(f.filename) for f in files):
+            abort(400, description="The videos must be sent to the /predict_video entrypoint.")
         abort(400, description="The provided file(s) format is not supported.")
 
+    # --- CHECK THE DIMENSIONS OF THE IMAGES (HEADERS ONLY) BEFORE DECODING THEM
+
+    check_image_sizes(filtered_files)
+
+    metrics.count_images(len(filtered_files))
+
     return filtered_files
 
 
+def check_image_sizes(files: list):
+    """
+    Checks the dimensions of the uploaded images by reading their headers only (no decoding),
+    so that a small but highly compressed file can't make the worker decode gigabytes of pixels.
+    The formats whose header isn't parsed (or a damaged header) are left to the decoder,
+    which refuses the images larger than OPENCV_IO_MAX_IMAGE_PIXELS.
+
+    Parameters
+    ----------
+    files : list
+        The uploaded files with a compatible format.
+
+    Raises
+    ------
+    BadRequest
+        If a file can't be read.
+    RequestEntityTooLarge
+        If an image has more than MAX_IMAGE_PIXELS pixels, or if decoding all the images
+        would need more than MAX_REQUEST_DECODED_BYTES bytes.
+    """
+
+    decoded_bytes = 0
+    roi_bytes = 0
+
+    for f in files:
+        buffer = read_upload(f)
+        if buffer is None:
+            abort(400, description=f"The file '{f.filename}' is not a valid image.")
+
+        size = read_image_size(buffer)
+        if size is None:
+            continue
+
+        if size[0] * size[1] > MAX_IMAGE_PIXELS:
+            metrics.count_rejection("image_pixels")
+            abort(413, description=f"The image '{f.filename}' is too large ({size[0]}x{size[1]} pixels).")
+
+        decoded_bytes += get_decoded_bytes(buffer, size, 640)
+        if ROI_DECODE:
+            roi_bytes = max(roi_bytes, get_decoded_bytes(buffer, size, ROI_MIN_SIDE))
+
+    # (the ROI tiers are decoded image by image and released once cropped, see image_io.crop_rois:
+    # at most the current one and the prefetched next one are in memory at the same time)
+    decoded_bytes += 2 * roi_bytes
+
+    if decoded_bytes > MAX_REQUEST_DECODED_BYTES:
+        metrics.count_rejection("request_pixels")
+        abort(413, description="The images of the request are too large, please send fewer images.")
+
+
+def check_rate_limit(request: request, images: int):
+    """
+    Takes the images of a request from the token bucket of its API key.
+
+    Raises
+    ------
+    HTTPError
+        429 (with a Retry-After header) if the client sent too many images recently.
+    """
+
+    if rate_limiter is None:
+        return
+
+    api_key = request.headers.get("X-API-Key") or request.remote_addr or "anonymous"
+    wait = rate_limiter.take(api_key, images)
+    if wait > 0:
+        metrics.count_rejection("rate_limit")
+        raise HTTPError(
+            429, message="Too many images sent, please retry later.", headers={"Retry-After": retry_after(wait)}
+        )
+
+
+def count_file_parts(request: request) -> int:
+    """ Returns the number of files uploaded in the 'file' field of a request (at least 1). """
+
+    return max(1, sum(1 for f in request.files.getlist("file") if f.filename))
+
+
+def admit_request(request: request, images: int):
+    """
+    Waits for the in-flight images budget of the worker
+    (the budget is given back when the request ends, see release_admission).
+
+    Raises
+    ------
+    HTTPError
+        503 (with a Retry-After header) if the server is overloaded.
+    """
+
+    with metrics.timer("admission"):
+        admitted = admission.acquire(images)
+
+    if not admitted:
+        metrics.count_rejection("overloaded")
+        raise HTTPError(
+            503, message="The server is overloaded, please retry later.",
+            headers={"Retry-After": retry_after(ADMISSION_RETRY_AFTER)},
+        )
+
+    g.admitted_images = images
+
+
+def get_stream_format(request: request, response_format: str) -> str:
+    """
+    Returns the streaming format requested with the 'stream' query parameter.
+
+    Returns
+    -------
+    str
+        'ndjson' (stream=1 / stream=ndjson), 'sse' (stream=sse) or None (no streaming).
+
+    Raises
+    ------
+    BadRequest
+        If the compact format is requested too (the streamed records use the full format).
+    """
+
+    stream = request.args.get("stream")
+    if stream is None or stream.lower() in ("", "0", "false"):
+        return None
+    if response_format == "compact":
+        abort(400, description="The 'compact' format is not available with 'stream', use format=full.")
+    if stream.lower() == "sse":
+        return "sse"
+    return "ndjson"
+
+
+def get_response_format(request: request) -> str:
+    """
+    Returns the response format requested with the 'format' query parameter:
+    'full' (default, one record per damage / plate) or 'compact' (grouped per file, see responses).
+
+    Raises
+    ------
+    BadRequest
+        If the format is unknown.
+    """
+
+    response_format = (request.args.get("format") or "full").lower()
+    if response_format not in RESPONSE_FORMATS:
+        abort(400, description=f"The 'format' parameter must be one of {sorted(RESPONSE_FORMATS)}.")
+    return response_format
+
+
+def stream_records(records, stream_format: str) -> Response:
+    """
+    Sends the records produced by a generator as soon as they are available.
+
+    Parameters
+    ----------
+    records : iterable
+        The records (dict) to send, each one with a 'type' key.
+    stream_format : str
+        'ndjson' (one JSON object per line) or 'sse' (server-sent events).
+
+    Returns
+    -------
+    Response
+        A streamed Flask response.
+    """
+
+    def encode(record):
+        if stream_format == "sse":
+            return b"event: " + record["type"].encode() + b"\ndata: " + dumps(record) + b"\n\n"
+        return dumps(record) + b"\n"
+
+    def generate():
+        # (the status code is already sent, an image that can't be decoded ends the stream with an error record)
+        try:
+            for record in records:
+                yield encode(record)
+        except HTTPException as e:
+            yield encode({"type": "error", "code": e.code, "message": e.description})
+
+    mimetype = "text/event-stream" if stream_format == "sse" else "application/x-ndjson"
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
 # ########## API ENTRY POINTS (BACKEND) ##########
 
 
+# ----- METRICS -----
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    if "request_start" in g:
+        endpoint = metrics.current_endpoint()
+        metrics.REQUEST_LATENCY.labels(endpoint).observe(time.perf_counter() - g.request_start)
+        if response.status_code >= 500:
+            metrics.count_error("request")
+    return response
+
+
+@app.before_request
+def admit_predict_request():
+    # (the form is parsed, i.e. the uploads spooled, but nothing is read / decoded before the admission)
+    if request.endpoint in ADMITTED_ENDPOINTS:
+        admit_request(request, count_file_parts(request))
+
+
+@app.teardown_request
+def release_admission(exception):
+    # (the streamed answers keep the request context, so their budget is held until the last record)
+    images = g.pop("admitted_images", None)
+    if images is not None:
+        admission.release(images)
+
+
+@app.teardown_request
+def close_uploads(exception):
+    # (the memory maps of the spooled uploads, see image_io.read_upload)
+    for f in request.files.values():
+        close_upload(f)
+
+
+@app.route("/metrics", methods=["GET"])
+def route_metrics():
+    """
+    Define the API endpoint exporting the Prometheus metrics
+    (latency per request / stage / model, images, boxes, price lookups and errors).
+    """
+
+    content, content_type = metrics.export()
+    return Response(content, mimetype=content_type)
+
+
 # ----- PREDICT DAMAGES -----
 
 
@@ -226,9 +606,8 @@ def route_predict_damages(data):
 
     # --- CHECK FILES
     filtered_files = check_uploaded_files(request)
-
-    # --- PREPARE FILES
-    preprocessed_files, original_ratios = prepare_images(filtered_files)
+    response_format = get_response_format(request)
+    check_rate_limit(request, len(filtered_files))
 
     # --- GATHER CUSTOMER CAR INFORMATION
     customer_car_info = {
@@ -237,17 +616,34 @@ def route_predict_damages(data):
         "year": request.form.get("year"),
     }
 
+    # --- STREAM ONE RECORD PER IMAGE (IF REQUESTED)
+    stream_format = get_stream_format(request, response_format)
+    if stream_format is not None:
+        prepared_images = (preprocess_image(f) for f in filtered_files)
+        records = iter_predict_damages(filtered_files, prepared_images, customer_car_info)
+        return stream_records(records, stream_format)
+
+    # --- PREPARE FILES
+    preprocessed_files, original_ratios = prepare_images(filtered_files)
+
     # --- PREDICT
+    damage_indices = []
     json_damages = predict_damages(
-        filtered_files, preprocessed_files, original_ratios, customer_car_info
+        filtered_files, preprocessed_files, original_ratios, customer_car_info, damage_indices
     )
     json_dict = {"damage_model": cdd_model_name, "damages": json_damages}
 
     # --- RETURN ANSWER
     args = request.args
     if args.get("isfrontend") is None:
-        print(jsonify(json_dict))
-        return jsonify(json_dict)
+        if response_format == "compact":
+            return json_response({
+                "format": "compact",
+                "damage_model": cdd_model_name,
+                "severity_model": sev_model_name,
+                "files": compact_damages(json_damages, damage_indices, [f.filename for f in filtered_files]),
+            })
+        return json_response(json_dict)
 
     else:
         session["json2html"] = json2html.convert(json_dict)
@@ -279,24 +675,407 @@ def route_predict_plates(data):
 
     # --- CHECK FILES
     filtered_files = check_uploaded_files(request)
+    response_format = get_response_format(request)
+    check_rate_limit(request, len(filtered_files))
+
+    # --- STREAM ONE RECORD PER IMAGE (IF REQUESTED)
+    stream_format = get_stream_format(request, response_format)
+    if stream_format is not None:
+        prepared_images = (preprocess_image(f) for f in filtered_files)
+        records = iter_predict_plates(filtered_files, prepared_images)
+        return stream_records(records, stream_format)
 
     # --- PREPARE FILES
     preprocessed_files, original_ratios = prepare_images(filtered_files)
 
     # --- PREDICT
-    json_plates = predict_plates(filtered_files, preprocessed_files, original_ratios)
+    plate_indices = []
+    json_plates = predict_plates(filtered_files, preprocessed_files, original_ratios, plate_indices)
     json_dict = {"plate_model": lpd_model_name, "plates": json_plates}
 
     # --- RETURN ANSWER
     args = request.args
     if args.get("isfrontend") is None:
-        return jsonify(json_dict)
+        if response_format == "compact":
+            return json_response({
+                "format": "compact",
+                "plate_model": lpd_model_name,
+                "files": compact_plates(json_plates, plate_indices, [f.filename for f in filtered_files]),
+            })
+        return json_response(json_dict)
 
     else:
         session["json2html"] = json2html.convert(json_dict)
         return redirect(url_for("upload_plate"))
 
 
+# ----- PREDICT DAMAGES & PLATES -----
+
+
+@app.route("/predict_all", methods=["POST"])
+@app.input(AllIn, location="files")
+@app.output(AllFullOut)
+def route_predict_all(data):
+    """
+    Define the API endpoint to get both the damages and the plates predictions from one or more images.
+    This entrypoint awaits a POST request along with a 'file' parameter
+    containing image(s) and returns a JSON object.
+    The images are uploaded and decoded once, then both models run concurrently.
+
+    Parameters
+    ----------
+    request : request
+        The Flask request object containing the files and optional car parameters.
+
+    Returns
+    -------
+    jsonify(json_dict) : JSON object
+        A JSON object containing the predicted damages and plates along with several other information.
+    """
+
+    # --- CHECK FILES
+    filtered_files = check_uploaded_files(request)
+    response_format = get_response_format(request)
+    check_rate_limit(request, len(filtered_files))
+
+    # --- PREPARE FILES
+    preprocessed_files, original_ratios = prepare_images(filtered_files)
+
+    # --- GATHER CUSTOMER CAR INFORMATION
+    customer_car_info = {
+        "trade": request.form.get("trade"),
+        "model": request.form.get("model"),
+        "year": request.form.get("year"),
+    }
+
+    # --- PREDICT (plates in the pipeline pool, damages in the request thread, sharing the ROI tier of the images)
+    damage_indices, plate_indices = [], []
+    share_roi_images(filtered_files, 2)
+    plates_future = pipeline_pool.submit(
+        copy_current_request_context(predict_plates), filtered_files, preprocessed_files, original_ratios, plate_indices
+    )
+    json_damages = predict_damages(
+        filtered_files, preprocessed_files, original_ratios, customer_car_info, damage_indices
+    )
+    json_plates = plates_future.result()
+
+    # --- RETURN ANSWER
+    if response_format == "compact":
+        filenames = [f.filename for f in filtered_files]
+        damages_per_file = compact_damages(json_damages, damage_indices, filenames)
+        plates_per_file = compact_plates(json_plates, plate_indices, filenames)
+
+        return json_response({
+            "format": "compact",
+            "damage_model": cdd_model_name,
+            "severity_model": sev_model_name,
+            "plate_model": lpd_model_name,
+            "files": [
+                {"file": d["file"], "damages": {k: v for k, v in d.items() if k != "file"},
+                 "plates": {k: v for k, v in p.items() if k != "file"}}
+                for d, p in zip(damages_per_file, plates_per_file)
+            ],
+        })
+
+    json_dict = {
+        "damage_model": cdd_model_name,
+        "damages": json_damages,
+        "plate_model": lpd_model_name,
+        "plates": json_plates,
+    }
+
+    return json_response(json_dict)
+
+
+# ----- PREDICT VIDEO -----
+
+
+def make_video_job(video_file, video_name: str, task: str, customer_car_info: dict):
+    """
+    Returns the function computing the predictions of a video job (see make_prediction_job).
+
+    Parameters
+    ----------
+    video_file: NamedTemporaryFile
+        The spooled video (see spool_video), closed (removed) once the job is done.
+    video_name: str
+        The name of the uploaded video.
+    task: str
+        The predictions to compute: 'damages', 'plates' or 'all'.
+    customer_car_info: dict
+        A dictionary containing the 'trade', 'model', 'year' send along with the POST request.
+
+    Returns
+    -------
+    callable:
+        A function taking a progress(stage, step, steps) callback and returning the frames statistics,
+        the top damages of each class and / or the distinct plates of the video (see VideoOut).
+    """
+
+    def job(progress):
+        try:
+            result = predict_video(
+                video_file.name, video_name, task, customer_car_info, max_pixels=MAX_IMAGE_PIXELS, progress=progress
+            )
+        finally:
+            video_file.close()
+
+        json_dict = {"video": video_name, "frames": result["frames"]}
+        if task in ("damages", "all"):
+            json_dict["damage_model"] = cdd_model_name
+            json_dict["damages"] = result["damages"]
+        if task in ("plates", "all"):
+            json_dict["plate_model"] = lpd_model_name
+            json_dict["plates"] = result["plates"]
+
+        progress("done", result["frames"]["kept"], VIDEO_MAX_FRAMES)
+        return json_dict
+
+    return job
+
+
+@app.route("/predict_video", methods=["POST"])
+@app.input(VideoIn, location="files")
+@app.output(JobOut, status_code=202)
+def route_predict_video(data):
+    """
+    Define the API endpoint to get the damages and / or the plates of a walk-around video.
+    This entrypoint awaits a POST request along with a 'file' parameter containing one video,
+    an optional 'task' parameter ('damages', 'plates' or 'all') and optional car parameters.
+    The frames are sampled every VIDEO_SAMPLE_INTERVAL seconds (the near-identical ones are dropped),
+    predicted by batches, and the detections are merged across the frames.
+    A video takes longer than the HTTP timeout: it is predicted in a job, polled with GET /jobs/<id>.
+
+    Parameters
+    ----------
+    request : request
+        The Flask request object containing the video and optional car parameters.
+
+    Returns
+    -------
+    jsonify(job) : JSON object
+        A JSON object containing the id and status of the new job, whose result contains
+        the frames statistics, the top damages of each class and the distinct plates of the video.
+    """
+
+    # --- CHECK FILE
+    if "file" not in request.files or request.files["file"].filename == "":
+        abort(400, description="The 'file' form-data field is missing in the request.")
+
+    f = request.files["file"]
+    if not is_video(f.filename):
+        abort(400, description=f"The video format is not supported (use one of {sorted(VIDEO_EXTENSIONS)}).")
+
+    task = request.form.get("task") or "all"
+    if task not in JOB_TASKS:
+        abort(400, description=f"The 'task' field must be one of {sorted(JOB_TASKS)}.")
+
+    # (the frames are predicted VIDEO_BATCH_SIZE at a time)
+    check_rate_limit(request, VIDEO_BATCH_SIZE)
+
+    # --- GATHER CUSTOMER CAR INFORMATION
+    customer_car_info = {
+        "trade": request.form.get("trade"),
+        "model": request.form.get("model"),
+        "year": request.form.get("year"),
+    }
+
+    # --- COPY THE VIDEO (the request streams are closed once the answer is sent) & CHECK IT
+    video_file = spool_video(f, os.path.splitext(f.filename)[1])
+    try:
+        check_video(video_file.name, f.filename, max_pixels=MAX_IMAGE_PIXELS)
+        error = None
+    except VideoTooLargeError as e:
+        error = (413, str(e))
+    except ValueError as e:
+        error = (400, str(e))
+    if error is not None:
+        video_file.close()
+        abort(error[0], description=error[1])
+
+    # --- QUEUE JOB
+    job_id = job_store.submit(make_video_job(video_file, f.filename, task, customer_car_info))
+    if job_id is None:
+        video_file.close()
+        abort(503, description="Too many pending jobs, please retry later.")
+
+    response = jsonify(job_store.get(job_id))
+    response.status_code = 202
+    response.headers["Location"] = url_for("route_get_job", job_id=job_id)
+    return response
+
+
+# ----- ASYNCHRONOUS JOBS -----
+
+
+def make_prediction_job(files: list, task: str, customer_car_info: dict):
+    """
+    Returns the function computing the predictions of a job.
+
+    Parameters
+    ----------
+    files: list
+        The uploaded file objects (copied in memory so they outlive the request).
+    task: str
+        The predictions to compute: 'damages', 'plates' or 'all'.
+    customer_car_info: dict
+        A dictionary containing the 'trade', 'model', 'year' send along with the POST request.
+
+    Returns
+    -------
+    callable:
+        A function taking a progress(stage, step, steps) callback and returning
+        the same JSON content as the /predict_damages and / or /predict_plates entrypoints.
+    """
+
+    def job(progress):
+        steps = 3 if task == "all" else 2
+        step = 0
+
+        progress("decoding", step, steps)
+        preprocessed_files, original_ratios = prepare_images(files)
+        step += 1
+
+        json_dict = {}
+
+        if task in ("damages", "all"):
+            progress("damages", step, steps)
+            json_dict["damage_model"] = cdd_model_name
+            json_dict["damages"] = predict_damages(
+                files, preprocessed_files, original_ratios, customer_car_info
+            )
+            step += 1
+
+        if task in ("plates", "all"):
+            progress("plates", step, steps)
+            json_dict["plate_model"] = lpd_model_name
+            json_dict["plates"] = predict_plates(files, preprocessed_files, original_ratios)
+            step += 1
+
+        progress("done", step, steps)
+        return json_dict
+
+    return job
+
+
+@app.route("/jobs", methods=["POST"])
+@app.input(JobIn, location="files")
+@app.output(JobOut, status_code=202)
+def route_create_job(data):
+    """
+    Define the API endpoint to start an asynchronous prediction job.
+    This entrypoint awaits the same POST request as /predict_damages (with an optional
+    'task' parameter: 'damages', 'plates' or 'all') and immediately returns the id of the job,
+    the results can then be polled with GET /jobs/<id>.
+
+    Parameters
+    ----------
+    request : request
+        The Flask request object containing the files and optional car parameters.
+
+    Returns
+    -------
+    jsonify(job) : JSON object
+        A JSON object containing the id and status of the new job.
+    """
+
+    # --- CHECK FILES
+    filtered_files = check_uploaded_files(request)
+    check_rate_limit(request, len(filtered_files))
+
+    task = request.form.get("task") or "damages"
+    if task not in JOB_TASKS:
+        abort(400, description=f"The 'task' field must be one of {sorted(JOB_TASKS)}.")
+
+    # --- COPY FILES (the request streams are closed once the answer is sent)
+    files = []
+    for f in filtered_files:
+        content = read_upload(f)
+        if content is None:
+            abort(400, description=f"The file '{f.filename}' can't be read.")
+        files.append(FileStorage(io.BytesIO(content), filename=f.filename))
+
+    # --- GATHER CUSTOMER CAR INFORMATION
+    customer_car_info = {
+        "trade": request.form.get("trade"),
+        "model": request.form.get("model"),
+        "year": request.form.get("year"),
+    }
+
+    # --- QUEUE JOB
+    job_id = job_store.submit(make_prediction_job(files, task, customer_car_info))
+    if job_id is None:
+        abort(503, description="Too many pending jobs, please retry later.")
+
+    response = jsonify(job_store.get(job_id))
+    response.status_code = 202
+    response.headers["Location"] = url_for("route_get_job", job_id=job_id)
+    return response
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+@app.output(JobOut)
+def route_get_job(job_id):
+    """
+    Define the API endpoint to get the progress and the results of an asynchronous prediction job.
+
+    Parameters
+    ----------
+    job_id : str
+        The id returned by POST /jobs.
+
+    Returns
+    -------
+    jsonify(job) : JSON object
+        A JSON object containing the status, the progress and (once done) the results of the job.
+    """
+
+    job = job_store.get(job_id)
+    if job is None:
+        abort(404, description="Unknown or expired job.")
+
+    return jsonify(job)
+
+
+# ----- READINESS -----
+
+
+@app.route("/ready", methods=["GET"])
+def route_ready():
+    """
+    Define the API endpoint reporting whether the models are loaded and warmed up
+    (200 once ready, 503 before).
+
+    Returns
+    -------
+    jsonify(json_dict) : JSON object
+        A JSON object containing the readiness of the server.
+    """
+
+    json_dict = {"ready": lifecycle.is_ready(), "error": lifecycle.state["error"]}
+    response = jsonify(json_dict)
+    response.status_code = 200 if json_dict["ready"] else 503
+    return response
+
+
+# ----- RESULT CACHE STATISTICS -----
+
+
+@app.route("/cache_stats", methods=["GET"])
+def route_cache_stats():
+    """
+    Define the API endpoint returning the hit / miss counters of the result caches
+    (the raw predictions are cached by image content and model names).
+
+    Returns
+    -------
+    jsonify(json_dict) : JSON object
+        A JSON object containing the statistics of the damages and plates caches.
+    """
+
+    return jsonify({"damages": damage_cache.stats(), "plates": plate_cache.stats()})
+
+
 # ########## DEMO FRONTEND ##########
 # This could be a different Flask script totally independant from the API!
 
@@ -388,6 +1167,11 @@ def upload_plate():
 
 # ########## START BOTH API & FRONTEND ##########
 
+# Everything is loaded: the models memory can be shared by the forked workers
+lifecycle.freeze_models()
+
 if __name__ == "__main__":
+    start_price_refresh()
+    lifecycle.start_warmup()
     current_port = int(os.environ.get("PORT") or 5000)
     app.run(debug=True, host="0.0.0.0", port=current_port, threaded=True)
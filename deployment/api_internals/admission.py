@@ -0,0 +1,177 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+from collections import OrderedDict
+
+# --- DEFINE CLASSES
+
+
+class AdmissionController:
+    """
+    Bounds the number of images predicted at the same time by a worker. The requests over the budget wait
+    in a bounded queue (the single image requests first, then the others in their arrival order),
+    and are rejected when the queue is full or when they waited too long, so that the admitted requests
+    keep a stable latency instead of all of them reaching the gunicorn timeout.
+
+    Attributes
+    ----------
+    max_images : int
+        The maximum number of images in flight (a request with more images runs alone).
+    max_waiting : int
+        The maximum number of waiting requests.
+    max_wait : float
+        The maximum waiting duration of a request (seconds).
+    small_request : int
+        The requests with at most small_request images are admitted first.
+
+    Methods
+    -------
+    acquire(images)
+        Waits for the budget of a request, returns False if the request is rejected.
+    release(images)
+        Gives back the budget of an admitted request.
+    stats()
+        Returns the number of images in flight and of waiting requests.
+    """
+
+    def __init__(self, max_images: int, max_waiting: int, max_wait: float, small_request: int = 1):
+        self.max_images = max_images
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.small_request = small_request
+
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.waiting = []  # heap of (priority, arrival) entries
+        self.arrivals = itertools.count()
+
+    def _cost(self, images: int) -> int:
+        return min(images, self.max_images)
+
+    def acquire(self, images: int) -> bool:
+        """
+        Waits until the request fits in the budget (and no request with a higher priority is waiting).
+
+        Parameters
+        ----------
+        images : int
+            The number of images of the request.
+
+        Returns
+        -------
+        bool:
+            True if the request is admitted (release must then be called), False if it is rejected.
+        """
+
+        cost = self._cost(images)
+        entry = (0 if images <= self.small_request else 1, next(self.arrivals))
+        deadline = time.monotonic() + self.max_wait
+
+        with self.condition:
+            if len(self.waiting) >= self.max_waiting and self.in_flight + cost > self.max_images:
+                return False
+
+            heapq.heappush(self.waiting, entry)
+
+            while True:
+                if self.waiting[0] == entry and self.in_flight + cost <= self.max_images:
+                    heapq.heappop(self.waiting)
+                    self.in_flight += cost
+                    self.condition.notify_all()  # the next request might fit too
+                    return True
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                    self.condition.notify_all()
+                    return False
+
+                self.condition.wait(remaining)
+
+    def release(self, images: int):
+        """ Gives back the budget of an admitted request. """
+
+        with self.condition:
+            self.in_flight -= self._cost(images)
+            self.condition.notify_all()
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {"in_flight_images": self.in_flight, "waiting_requests": len(self.waiting)}
+
+
+class TokenBuckets:
+    """
+    Limits the rate of images sent by each client (API key): every client has a bucket of
+    'burst' tokens refilled at 'rate' tokens per second, and each image takes one token.
+
+    Attributes
+    ----------
+    rate : float
+        The number of tokens added per second.
+    burst : int
+        The size of the buckets.
+    max_clients : int
+        The maximum number of buckets kept (the least recently used ones are dropped).
+
+    Methods
+    -------
+    take(key, tokens)
+        Takes tokens from the bucket of a client, returns 0 or the number of seconds to wait.
+    """
+
+    def __init__(self, rate: float, burst: int, max_clients: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()  # key -> (tokens, last update)
+
+    def take(self, key: str, tokens: int) -> float:
+        """
+        Takes tokens from the bucket of a client.
+
+        Parameters
+        ----------
+        key : str
+            The client (API key).
+        tokens : int
+            The number of tokens to take (a request bigger than the bucket takes the whole bucket).
+
+        Returns
+        -------
+        float:
+            0 if the tokens were taken, otherwise the number of seconds before the bucket holds them.
+        """
+
+        tokens = min(tokens, self.burst)
+        now = time.monotonic()
+
+        with self.lock:
+            available, last = self.buckets.pop(key, (self.burst, now))
+            available = min(self.burst, available + (now - last) * self.rate)
+
+            wait = 0.0
+            if available >= tokens:
+                available -= tokens
+            else:
+                wait = (tokens - available) / self.rate
+
+            self.buckets[key] = (available, now)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+
+        return wait
+
+
+# --- DEFINE FUNCTIONS
+
+
+def retry_after(seconds: float) -> str:
+    """ Returns the value of a Retry-After header (whole seconds, at least 1). """
+
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,127 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class BatchScheduler:
+    """
+    A scheduler gathering the images sent by concurrent requests so that
+    they can be predicted together (dynamic micro-batching).
+
+    Each request submits its own list of images and waits for its own results.
+    A single background thread takes the pending requests from the queue and
+    calls the predict function on batches bounded by max_batch_size images
+    and by max_wait seconds (counted from the first request of the batch).
+
+    Attributes
+    ----------
+    predict_fn : callable
+        A function taking a list of images and returning one result per image.
+    max_batch_size : int
+        The maximum number of images in a batch (a single request bigger than
+        this limit is still predicted in one batch).
+    max_wait : float
+        The maximum time (in seconds) to wait for other requests before running a batch.
+
+    Methods
+    -------
+    submit(images)
+        Queues the images of a request and returns their results once predicted.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=8, max_wait=0.010):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self._queue = queue.Queue()
+        self._carry = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        """ Starts the batching thread (lazily, so that it is created in each forked worker). """
+
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="batch-scheduler", daemon=True
+                )
+                self._thread.start()
+
+    def submit(self, images: list) -> list:
+        """
+        Queues the images of a request and waits for their results.
+
+        Parameters
+        ----------
+        images : list
+            The preprocessed images of the request.
+
+        Returns
+        -------
+        list:
+            The results returned by predict_fn for these images (in the same order).
+        """
+
+        if len(images) == 0:
+            return []
+
+        self._start()
+
+        future = Future()
+        self._queue.put((images, future))
+        return future.result()
+
+    def _next_batch(self) -> list:
+        """ Waits for a request, then gathers the other requests that fit in the batch. """
+
+        if self._carry is not None:
+            pending, self._carry = [self._carry], None
+        else:
+            pending = [self._queue.get()]
+        size = len(pending[0][0])
+        deadline = time.monotonic() + self.max_wait
+
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+
+            # --- keep a request that would overflow the batch for the next one
+            if size + len(item[0]) > self.max_batch_size:
+                self._carry = item
+                break
+
+            pending.append(item)
+            size += len(item[0])
+
+        return pending
+
+    def _run(self):
+        """ The batching loop: predicts the batches and hands each request its own results. """
+
+        while True:
+            pending = self._next_batch()
+
+            images = []
+            for request_images, _ in pending:
+                images.extend(request_images)
+
+            try:
+                results = self.predict_fn(images)
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+
+            start = 0
+            for request_images, future in pending:
+                end = start + len(request_images)
+                future.set_result(list(results[start:end]))
+                start = end
@@ -1,5 +1,5 @@
 from apiflask import APIFlask, Schema
-from apiflask.fields import Integer, String, File, List, Nested, Boolean
+from apiflask.fields import Integer, String, File, List, Nested, Boolean, Dict, Float
 from apiflask.validators import Length
 
 
@@ -17,6 +17,29 @@ class PlatesIn(Schema):
     file = File(required=True)
 
 
+class AllIn(Schema):
+    file = File(required=True)
+    trade = String(required=False)
+    model = String(required=False)
+    year = String(required=False)
+
+
+class JobIn(Schema):
+    file = File(required=True)
+    task = String(required=False, load_default="damages")  # damages / plates / all
+    trade = String(required=False)
+    model = String(required=False)
+    year = String(required=False)
+
+
+class VideoIn(Schema):
+    file = File(required=True)
+    task = String(required=False, load_default="all")  # damages / plates / all
+    trade = String(required=False)
+    model = String(required=False)
+    year = String(required=False)
+
+
 damage_sample = [
     {
         "action": "REPLACE",
@@ -66,3 +89,49 @@ class PlatesOut(Schema):
 class PlatesFullOut(Schema):
     plate_model = String(load_default="car_damage_detect.pt")
     plates = List(Nested(PlatesOut), load_default=plate_sample)
+
+
+class AllFullOut(Schema):
+    damage_model = String(load_default="car_damage_detect.pt")
+    damages = List(Nested(DamagesOut), load_default=damage_sample)
+    plate_model = String(load_default="car_damage_detect.pt")
+    plates = List(Nested(PlatesOut), load_default=plate_sample)
+
+
+class VideoFrames(Schema):
+    read = Integer()
+    sampled = Integer()
+    kept = Integer()
+    duration = Float()
+
+
+class VideoDamagesOut(DamagesOut):
+    frames = Integer()
+
+
+class VideoPlatesOut(PlatesOut):
+    frames = Integer()
+
+
+class VideoOut(Schema):
+    # (the result of the /predict_video jobs)
+    video = String()
+    frames = Nested(VideoFrames)
+    damage_model = String(load_default="car_damage_detect.pt")
+    damages = List(Nested(VideoDamagesOut))
+    plate_model = String(load_default="license_plate_detect_model.pt")
+    plates = List(Nested(VideoPlatesOut))
+
+
+class JobProgress(Schema):
+    stage = String(allow_none=True)
+    step = Integer()
+    steps = Integer(allow_none=True)
+
+
+class JobOut(Schema):
+    id = String()
+    status = String()  # pending / running / done / failed
+    progress = Nested(JobProgress)
+    result = Dict(allow_none=True)
+    error = String(allow_none=True)
@@ -1,5 +1,13 @@
 import os
+import threading
+import time
+from contextlib import nullcontext
+
+from flask import has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+
+from api_internals import metrics, price_snapshot
 
 # --- CONNECT PostgreSQL DATABASE
 
@@ -10,9 +18,49 @@ DB_UNAME = os.environ.get("DATABASE_USR")
 DB_PASSW = os.environ.get("DATABASE_PWD")
 DB_URL = f"postgresql://{DB_UNAME}:{DB_PASSW}@{DB_ADDRESS}:{DB_PORT}/{DB_NAME}"
 
+# DATABASE_URL replaces the PostgreSQL database (e.g. a local SQLite file for the benchmarks)
+DB_URL = os.environ.get("DATABASE_URL") or DB_URL
+
+
+# --- CONNECTION POOL
+# The price lookups release their connection as soon as the query returns, so a few connections per worker
+# are enough. A request waits at most DB_POOL_TIMEOUT seconds for a connection, and DB_CONNECT_TIMEOUT /
+# DB_STATEMENT_TIMEOUT_MS bound the (PostgreSQL) connections & queries. When the database can't be reached
+# (connection errors, no connection available in the pool), the lookups return None without querying
+# the database for DB_RETRY_INTERVAL seconds.
+
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE") or 4)
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW") or 4)
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT") or 2)
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE") or 1800)
+DB_POOL_PRE_PING = (os.environ.get("DB_POOL_PRE_PING") or "1") != "0"
+DB_CONNECT_TIMEOUT = int(os.environ.get("DB_CONNECT_TIMEOUT") or 3)
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS") or 2000)
+DB_RETRY_INTERVAL = float(os.environ.get("DB_RETRY_INTERVAL") or 10)
 
 db = SQLAlchemy()
 db_app = None
+db_unavailable_until = 0.0  # time.monotonic() value
+
+# --- PRICE CACHE
+# The whole price table is kept in memory and reloaded every PRICE_CACHE_TTL seconds
+# (a TTL <= 0 disables the cache, so that each lookup queries the database)
+
+PRICE_CACHE_TTL = float(os.environ.get("PRICE_CACHE_TTL") or 600)
+
+price_index = None  # {(part, trade, model, year): (price_repair, price_replace)}
+price_index_loaded_at = None
+
+# --- PRICE BACKEND
+# PRICE_BACKEND=postgres loads the price index from the database (see above), PRICE_BACKEND=snapshot from
+# a local SQLite snapshot of the price table (PRICE_SNAPSHOT_PATH, see price_snapshot): the database is
+# not used at all, and the snapshot is loaded again when the file is replaced (checked every PRICE_SNAPSHOT_POLL seconds)
+
+PRICE_BACKEND = os.environ.get("PRICE_BACKEND") or "postgres"
+PRICE_SNAPSHOT_PATH = os.environ.get("PRICE_SNAPSHOT_PATH") or "prices.db"
+PRICE_SNAPSHOT_POLL = float(os.environ.get("PRICE_SNAPSHOT_POLL") or 5)
+
+price_snapshot_signature = None
 
 
 # --- DEFINE TABLE SCHEMA
@@ -49,16 +97,293 @@ def init_db(app):
     global db_app
     db_app = app
 
+    # (the refresh threads are started by the serving processes, see start_price_refresh)
+    if PRICE_BACKEND == "snapshot":
+        load_price_snapshot()
+        return
+
     # app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
     app.config["SQLALCHEMY_DATABASE_URI"] = DB_URL
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = get_engine_options(DB_URL)
 
     try:
         db.init_app(app)
         with db_app.app_context():
+            track_pool(db.engine)
             db.create_all()
     except Exception as e:
         print(f"#### ERROR #### Invalid PostgreSQL config: {DB_URL} ({e})")
 
+    if PRICE_CACHE_TTL > 0:
+        load_price_cache()
+
+
+def get_engine_options(url: str) -> dict:
+    """
+    Returns the SQLAlchemy engine options (connection pool & timeouts) of a database URL.
+    The pool size and the timeouts only apply to PostgreSQL (Flask-SQLAlchemy picks the pool of SQLite).
+    """
+
+    options = {"pool_pre_ping": DB_POOL_PRE_PING, "pool_recycle": DB_POOL_RECYCLE}
+
+    if url.startswith("postgresql"):
+        options.update(
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            connect_args={
+                "connect_timeout": DB_CONNECT_TIMEOUT,
+                "options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}",
+            },
+        )
+
+    return options
+
+
+def track_pool(engine):
+    """ Counts the connections checked out of the pool of an engine (kept by engine.dispose). """
+
+    event.listen(engine, "checkout", lambda *args: metrics.count_db_connections(1))
+    event.listen(engine, "checkin", lambda *args: metrics.count_db_connections(-1))
+
+
+def price_session():
+    """
+    Returns a context manager providing the database session of the current request: Flask-SQLAlchemy
+    scopes db.session to the application context, so all the lookups of a request share one session
+    (removed at the end of the request). Outside of a request (price cache refresh), a context is pushed.
+    """
+
+    return nullcontext() if has_app_context() else db_app.app_context()
+
+
+def is_unavailable_error(e: Exception) -> bool:
+    """
+    Returns True if an error means that the database can't be reached (the connection errors and the pool
+    timeouts), False for the errors of a single query (statement timeout, invalid query, ...).
+    """
+
+    if isinstance(e, exc.TimeoutError):
+        return True
+    if isinstance(e, exc.OperationalError):
+        # (57014: query_canceled, the statement timeout only cancels its own query)
+        return getattr(e.orig, "pgcode", None) != "57014"
+    return False
+
+
+def query_rows(query_function) -> list:
+    """
+    Runs a price query on the session of the current request, and gives its connection back to the pool
+    right after (the request doesn't keep a connection during the inference).
+
+    Parameters
+    ----------
+    query_function : function
+        Returns the rows from a session.
+
+    Returns
+    -------
+    list:
+        The rows.
+
+    Raises
+    ------
+    ConnectionError
+        If the database couldn't be reached less than DB_RETRY_INTERVAL seconds ago (the query is not sent).
+    LookupError
+        With the snapshot backend (the database is not used, see load_price_snapshot).
+    """
+
+    global db_unavailable_until
+
+    if PRICE_BACKEND == "snapshot":
+        raise LookupError("no price snapshot is loaded")
+
+    if time.monotonic() < db_unavailable_until:
+        raise ConnectionError("the price database is unavailable, retrying later")
+
+    with price_session():
+        session = db.session
+        try:
+            with metrics.db_pool_timer():
+                session.connection()
+            return query_function(session)
+        except Exception as e:
+            if is_unavailable_error(e):
+                db_unavailable_until = time.monotonic() + DB_RETRY_INTERVAL
+                metrics.count_db_unavailable()
+                print(f"#### query_rows ERROR #### the price database can't be reached, "
+                      f"no query for {DB_RETRY_INTERVAL} seconds ({e})")
+            raise
+        finally:
+            session.close()
+
+
+def after_fork():
+    """
+    Prepares the database access of a forked (gunicorn) worker: the pool forgets the connections
+    opened by the master process without closing them (their sockets are still used by the master
+    and the other workers), and the price refresh thread is started.
+    """
+
+    if PRICE_BACKEND != "snapshot" and db_app is not None:
+        try:
+            with db_app.app_context():
+                db.engine.dispose(close=False)
+        except Exception as e:
+            print(f"#### after_fork ERROR #### {e}")
+
+    start_price_refresh()
+
+
+def start_price_refresh():
+    """
+    Starts the thread keeping the in-memory prices up to date (price cache reload or snapshot watch).
+    It is only started by the serving processes (gunicorn workers, or `python API_client_server.py`),
+    never in the preloaded gunicorn master: a worker forked while the thread holds the pool or
+    session locks would keep them locked forever.
+    """
+
+    if PRICE_BACKEND == "snapshot":
+        return start_price_snapshot_watch()
+    if PRICE_CACHE_TTL > 0:
+        return start_price_cache_refresh()
+    return None
+
+
+def load_price_cache() -> bool:
+    """
+    Loads the whole price table into the in-memory index used by get_db_price.
+    The new index replaces the previous one in a single assignment, so the
+    concurrent lookups always see a complete table.
+
+    Returns
+    -------
+    bool
+        True if the table was loaded, False otherwise (the previous index is kept).
+    """
+
+    global price_index, price_index_loaded_at
+
+    try:
+        rows = query_rows(lambda session: session.query(
+            Price.part, Price.trade, Price.model, Price.year,
+            Price.price_repair, Price.price_replace,
+        ).all())
+
+        new_index = {}
+        for part, trade, model, year, price_repair, price_replace in rows:
+            new_index[(part, trade, model, year)] = (price_repair, price_replace)
+
+        price_index = new_index
+        price_index_loaded_at = time.time()
+        print(f"Price cache loaded ({len(new_index)} entries)")
+        return True
+
+    except Exception as e:
+        print(f"#### load_price_cache ERROR #### {e}")
+        return False
+
+
+def start_price_cache_refresh():
+    """ Starts a daemon thread reloading the price cache every PRICE_CACHE_TTL seconds. """
+
+    def refresh_loop():
+        while True:
+            time.sleep(PRICE_CACHE_TTL)
+            load_price_cache()
+
+    thread = threading.Thread(target=refresh_loop, name="price-cache-refresh", daemon=True)
+    thread.start()
+    return thread
+
+
+def load_price_snapshot() -> bool:
+    """
+    Loads the price snapshot file into the in-memory index used by get_db_price
+    (replaced in a single assignment, as in load_price_cache).
+
+    Returns
+    -------
+    bool
+        True if the snapshot was loaded, False otherwise (the previous index is kept).
+    """
+
+    global price_index, price_index_loaded_at, price_snapshot_signature
+
+    # (read before the file: if the file is replaced meanwhile, the next check loads it again)
+    price_snapshot_signature = price_snapshot.get_signature(PRICE_SNAPSHOT_PATH)
+
+    try:
+        start = time.perf_counter()
+        new_index = price_snapshot.read_snapshot(PRICE_SNAPSHOT_PATH)
+
+        price_index = new_index
+        price_index_loaded_at = time.time()
+        print(f"Price snapshot loaded ({len(new_index)} entries in {(time.perf_counter() - start) * 1000:.1f} ms)")
+        return True
+
+    except Exception as e:
+        print(f"#### load_price_snapshot ERROR #### {PRICE_SNAPSHOT_PATH}: {e}")
+        return False
+
+
+def start_price_snapshot_watch():
+    """ Starts a daemon thread loading the price snapshot again when its file is replaced. """
+
+    def watch_loop():
+        while True:
+            time.sleep(PRICE_SNAPSHOT_POLL)
+            if price_snapshot.get_signature(PRICE_SNAPSHOT_PATH) != price_snapshot_signature:
+                load_price_snapshot()
+
+    thread = threading.Thread(target=watch_loop, name="price-snapshot-watch", daemon=True)
+    thread.start()
+    return thread
+
+
+def normalize_price_keys(trade: str, model: str, year: int, part: str) -> tuple:
+    """
+    Converts the customer car information and the damage name to the format used in the price table.
+
+    Returns
+    -------
+    tuple
+        The (part, trade, model, year) values, with None for the missing car information.
+    """
+
+    trade_v = None if trade is None or trade == "" else trade.lower()
+    model_v = None if model is None or model == "" else model.lower()
+    year_v = None if year is None or year == "" else str(year)
+    part_v = part.replace('_damage', '')
+
+    return part_v, trade_v, model_v, year_v
+
+
+def lookup_price(index: dict, part_v: str, trade_v: str, model_v: str, year_v: str, action: str) -> int:
+    """
+    Returns the price of a car part from a price index ({(part, trade, model, year): (repair, replace)}),
+    falling back to the generic part price (no trade / model / year).
+    The arguments are expected to be normalized with normalize_price_keys.
+    """
+
+    try:
+        year_i = None if year_v is None else int(year_v)
+    except ValueError:
+        year_i = -1  # can't match any row, so we fall back to the generic price
+
+    part_price = index.get((part_v, trade_v, model_v, year_i))
+    if part_price is None:
+        part_price = index.get((part_v, None, None, None))
+
+    if part_price is not None:
+        if action == "REPAIR":
+            return part_price[0]
+        elif action == "REPLACE":
+            return part_price[1]
+
+    return None
+
 
 def get_db_price(trade: str, model: str, year: int, part: str, action: str) -> int:
     """
@@ -86,16 +411,21 @@ def get_db_price(trade: str, model: str, year: int, part: str, action: str) -> i
     try:
         price = None
 
-        with db_app.app_context():
+        part_v, trade_v, model_v, year_v = normalize_price_keys(trade, model, year, part)
 
-            # --- search exact price
+        # --- use the in-memory copy of the price table when available
+
+        if price_index is not None:
+            metrics.count_db_lookups(1, "cache")
+            return lookup_price(price_index, part_v, trade_v, model_v, year_v, action)
 
-            trade_v = None if trade is None or trade == "" else trade.lower()
-            model_v = None if model is None or model == "" else model.lower()
-            year_v = None if year is None or year == "" else str(year)
-            part_v = part.replace('_damage', '')
+        metrics.count_db_lookups(1, "db")
 
-            part_price = Price.query.filter(
+        def query(session):
+
+            # --- search exact price
+
+            part_price = session.query(Price).filter(
                 Price.part == part_v,
                 Price.trade == trade_v,
                 Price.model == model_v,
@@ -106,26 +436,100 @@ def get_db_price(trade: str, model: str, year: int, part: str, action: str) -> i
             # --- we fall back to the avarage part prices
 
             if len(part_price) == 0:
-                part_price = Price.query.filter(
+                part_price = session.query(Price).filter(
                     Price.part == part_v,
                     Price.trade == None,
                     Price.model == None,
                     Price.year == None,
                 ).all()
 
-            # --- return price according to the recommended action
+            return [(row.price_repair, row.price_replace) for row in part_price]
+
+        part_price = query_rows(query)
+
+        # --- return price according to the recommended action
 
-            if len(part_price) > 0:
-                if action == "REPAIR":
-                    price = part_price[0].price_repair
-                elif action == "REPLACE":
-                    price = part_price[0].price_replace
+        if len(part_price) > 0:
+            if action == "REPAIR":
+                price = part_price[0][0]
+            elif action == "REPLACE":
+                price = part_price[0][1]
 
         return price
     except Exception as e:
+        metrics.count_error("price")
         print(f"#### get_db_price ERROR #### {e}")
 
 
+def get_db_prices(trade: str, model: str, year: int, parts_actions: list) -> list:
+    """
+    Returns the prices of several car parts at once, using a single database query
+    (or the in-memory price index when available).
+
+    Parameters
+    ----------
+    trade: str
+        The name of the trade of the car manufacturer.
+    model: str
+        The model of the car.
+    year: int
+        The year the car was manufactured.
+    parts_actions: list
+        A list of (part, action) tuples, where action is either 'REPAIR' or 'REPLACE'.
+
+    Returns
+    -------
+    list
+        The prices (int or None) in the same order as parts_actions.
+    """
+
+    if len(parts_actions) == 0:
+        return []
+
+    try:
+        keys = [normalize_price_keys(trade, model, year, part) for part, _ in parts_actions]
+        actions = [action for _, action in parts_actions]
+
+        index = price_index
+        metrics.count_db_lookups(len(parts_actions), "db" if index is None else "cache")
+
+        if index is None:
+            _, trade_v, model_v, year_v = keys[0]
+            parts_v = sorted({key[0] for key in keys})
+
+            # --- fetch both the exact and the fallback rows of every part in one query
+
+            rows = query_rows(lambda session: session.query(
+                Price.part, Price.trade, Price.model, Price.year,
+                Price.price_repair, Price.price_replace,
+            ).filter(
+                Price.part.in_(parts_v),
+                db.or_(
+                    db.and_(
+                        Price.trade == trade_v,
+                        Price.model == model_v,
+                        Price.year == year_v,
+                    ),
+                    db.and_(
+                        Price.trade == None,
+                        Price.model == None,
+                        Price.year == None,
+                    ),
+                ),
+            ).all())
+
+            index = {}
+            for part, trade_r, model_r, year_r, price_repair, price_replace in rows:
+                index[(part, trade_r, model_r, year_r)] = (price_repair, price_replace)
+
+        return [lookup_price(index, *key, action) for key, action in zip(keys, actions)]
+
+    except Exception as e:
+        metrics.count_error("price")
+        print(f"#### get_db_prices ERROR #### {e}")
+        return [None] * len(parts_actions)
+
+
 def demo_queries():
 
     try:
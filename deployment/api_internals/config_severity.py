@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+
+# --- SEVERITY MODELS
+# SEVERITY_PRECISION selects the fp32 model or its INT8 quantized version
+# (see quantize_severity.py to build and evaluate the quantized model)
+
+SEVERITY_MODELS = {
+    "fp32": "severity_model.onnx",
+    "int8": "severity_model_int8.onnx",
+}
+
+SEVERITY_PRECISION = (os.environ.get("SEVERITY_PRECISION") or "fp32").lower()
+
+sev_model_name = SEVERITY_MODELS[SEVERITY_PRECISION]
+model_severity_input_name = "sequential_2_input"
+model_severity_output_name = "output_layer"
+
+SEVERITY_INPUT_SIZE = (224, 224)
+
+# --- DEFINE VARIABLES
+
+DEFAULT_THRESHOLDS = {
+    "hood_damage": 0.5,
+    "front_bumper_damage": 0.5,
+    "front_fender_damage": 0.5,
+    "headlight_damage": 0.0,  # REPLACE
+    "front_windscreen_damage": 0.0,  # REPLACE
+    "sidemirror_damage": 0.0,  # REPLACE
+    "sidedoor_panel_damage": 0.5,
+    "roof_damage": 0.5,
+    "runnigboard_damage": 0.5,
+    "pillar_damage": 0.5,
+    "sidedoor_window_damage": 0.0,  # REPLACE
+    "rear_fender_damage": 0.5,
+    "rear_windscreen_damage": 0.0,  # REPLACE
+    "taillight_damage": 0.0,  # REPLACE
+    "rear_bumper_damage": 0.5,
+    "backdoor_panel_damage": 0.5,
+}
+
+# --- DEFINE FUNCTIONS
+
+
+def get_fixed_batch_size(session) -> int:
+    """ Returns the fixed batch dimension of a severity model session (None if it is dynamic). """
+
+    batch_dim = session.get_inputs()[0].shape[0]
+    if isinstance(batch_dim, int) and batch_dim > 0:
+        return batch_dim
+    return None
+
+
+def pad_severity_batch(chunk: np.array, batch_size: int) -> np.array:
+    """
+    Pads a chunk of crops with zero crops up to the fixed batch size of the model
+    (the severities of the padding must be dropped: output[:len(chunk)]).
+    """
+
+    if len(chunk) >= batch_size:
+        return chunk
+    padding = np.zeros((batch_size - len(chunk), *chunk.shape[1:]), dtype=chunk.dtype)
+    return np.concatenate([chunk, padding])
@@ -0,0 +1,162 @@
+import os
+
+import cv2
+import numpy as np
+
+# --- DEFINE VARIABLES
+
+# DEDUP=1: the near-identical images of a request (bursts of shots) are predicted once, and the others get
+# a copy of their predictions (damages, severities & prices). Off by default: two distinct shots of the same
+# car side can be near-identical, the damages of one of them would then replace the damages of the other.
+# Two images are near-identical when the Hamming distance of their difference hashes
+# (HASH_SIZE x HASH_SIZE bits) is at most DEDUP_MAX_DISTANCE bits
+DEDUP = (os.environ.get("DEDUP") or "0") != "0"
+DEDUP_MAX_DISTANCE = int(os.environ.get("DEDUP_MAX_DISTANCE") or 10)
+HASH_SIZE = 16
+
+# --- DEFINE FUNCTIONS
+
+
+def dhash(image: np.array) -> int:
+    """
+    Returns the difference hash of an image: the sign of the horizontal gradients
+    of its (HASH_SIZE + 1) x HASH_SIZE grayscale thumbnail.
+
+    Parameters
+    ----------
+    image : np.array
+        A BGR (or grayscale) image.
+
+    Returns
+    -------
+    int:
+        The HASH_SIZE * HASH_SIZE bits hash.
+    """
+
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    thumbnail = cv2.resize(gray, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = thumbnail[:, 1:] > thumbnail[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def find_representatives(images: list) -> list:
+    """
+    Clusters the near-identical images: each image is compared with the representatives found so far,
+    and becomes a new representative if none of them is close enough.
+
+    Parameters
+    ----------
+    images : list
+        The preprocessed images.
+
+    Returns
+    -------
+    list:
+        The index of the representative of each image (its own index for the representatives).
+    """
+
+    deduplicator = StreamDeduplicator()
+    return [deduplicator.add(image) for image in images]
+
+
+class StreamDeduplicator:
+    """
+    Clusters the near-identical images of a request as they arrive one by one (streamed answers),
+    with the same representatives as find_representatives.
+
+    Methods
+    -------
+    add(image)
+        Returns the index of the representative of the next image.
+    """
+
+    def __init__(self):
+        self.representatives = []  # (index, hash)
+        self.count = 0
+
+    def add(self, image: np.array) -> int:
+        """ Returns the index of the representative of the next image (its own index for a representative). """
+
+        i = self.count
+        self.count += 1
+
+        h = dhash(image)
+        for j, representative_hash in self.representatives:
+            if bin(h ^ representative_hash).count("1") <= DEDUP_MAX_DISTANCE:
+                return j
+
+        self.representatives.append((i, h))
+        return i
+
+
+def mark_duplicates(files: list, images: list) -> int:
+    """
+    Finds the near-identical images of a request, and sets the 'duplicate_of' attribute of the
+    duplicated files to the file of their representative (None for the other files),
+    so that only the representatives are predicted (see get_representative & fan_out).
+
+    Returns
+    -------
+    int:
+        The number of duplicated files.
+    """
+
+    if not DEDUP or len(files) < 2:
+        return 0
+
+    duplicates = 0
+    for i, (f, j) in enumerate(zip(files, find_representatives(images))):
+        f.duplicate_of = files[j] if j != i else None
+        duplicates += j != i
+
+    return duplicates
+
+
+def get_representative(f, files: list) -> int:
+    """ Returns the index of the representative of a duplicated file in files (None if not found). """
+
+    representative = getattr(f, "duplicate_of", None)
+    if representative is None:
+        return None
+
+    for j, other in enumerate(files):
+        if other is representative:
+            return j
+    return None
+
+
+def scale_coords(coords: list, from_ratio: tuple, to_ratio: tuple) -> list:
+    """ Converts (x1, y1, x2, y2) coordinates between two original image sizes (ratios are (h, w) / 640). """
+
+    scale_x = to_ratio[1] / from_ratio[1]
+    scale_y = to_ratio[0] / from_ratio[0]
+    return [coords[0] * scale_x, coords[1] * scale_y, coords[2] * scale_x, coords[3] * scale_y]
+
+
+def fan_out(raw_lists: list, files: list, original_ratios: list):
+    """
+    Copies the raw predictions of the representatives to their duplicates (in place),
+    the coordinates are scaled to the original size of each duplicate.
+
+    Parameters
+    ----------
+    raw_lists : list
+        One list of raw predictions (dictionaries with 'coords') per file, None for the duplicates.
+    files : list
+        The files of the predictions.
+    original_ratios : list
+        The original ratios of the files.
+    """
+
+    for i, f in enumerate(files):
+        if raw_lists[i] is not None:
+            continue
+
+        j = get_representative(f, files)
+        raw_lists[i] = copy_raws(raw_lists[j], original_ratios[j], original_ratios[i])
+
+
+def copy_raws(raws: list, from_ratio: tuple, to_ratio: tuple) -> list:
+    """ Returns a copy of the raw predictions of a representative, scaled to the original size of a duplicate. """
+
+    return [{**raw, "coords": scale_coords(raw["coords"], from_ratio, to_ratio)} for raw in raws]
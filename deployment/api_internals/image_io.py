@@ -0,0 +1,472 @@
+import io
+import mmap
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# --- DEFINE VARIABLES
+
+# Maximum number of pixels of an uploaded image (checked on the header, before decoding),
+# also given to OpenCV as a last resort limit (read by OpenCV on its first decoding)
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS") or 100_000_000)
+os.environ.setdefault("OPENCV_IO_MAX_IMAGE_PIXELS", str(MAX_IMAGE_PIXELS))
+
+import cv2  # noqa: E402
+import numpy as np  # noqa: E402
+
+# OpenCV decoding flags per reduction factor (the JPEG decoder downscales while decoding)
+REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# The uploads bigger than UPLOAD_SPOOL_SIZE bytes are spooled to disk (see API_client_server.SpoolingRequest)
+# and memory mapped by read_upload, the smaller ones are kept in memory
+UPLOAD_SPOOL_SIZE = int(os.environ.get("UPLOAD_SPOOL_SIZE") or 256 * 1024)
+
+# The damages & plates are cropped from a second decoding of each upload (its ROI tier), shared by the
+# severity & OCR inputs: the lowest resolution keeping the smallest side of the image >= ROI_MIN_SIDE
+ROI_MIN_SIDE = int(os.environ.get("ROI_MIN_SIDE") or 1024)
+
+# Shared pool decoding the uploaded images in parallel (OpenCV releases the GIL)
+decode_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("DECODE_WORKERS") or os.cpu_count() or 1),
+    thread_name_prefix="decode",
+)
+
+# Serializes the creation & release of the ROI tiers
+roi_lock = threading.Lock()
+
+# Serializes the seek + read of the uploads (the same file can be read by several pipelines)
+upload_lock = threading.Lock()
+
+JPEG_SOF_MARKERS = {
+    0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF
+}
+
+# TIFF tags: ImageWidth, ImageLength, SubIFDs (the full resolution image of the DNG files)
+TIFF_WIDTH, TIFF_HEIGHT, TIFF_SUB_IFDS = 256, 257, 330
+TIFF_MAX_IFDS = 64
+
+# --- DEFINE FUNCTIONS
+
+
+def _map_stream(stream):
+    """
+    Returns the content of an upload stream without reading it when possible: the content of the
+    in-memory buffer, or a read-only memory map of the temporary file the large uploads are spooled to.
+    """
+
+    if isinstance(stream, io.BytesIO):
+        return stream.getvalue()
+
+    # SpooledTemporaryFile (werkzeug & SpoolingRequest): only map the uploads bigger than UPLOAD_SPOOL_SIZE,
+    # which are already on disk (asking the file descriptor of the small ones would write them to disk)
+    stream.seek(0, io.SEEK_END)
+    if stream.tell() <= UPLOAD_SPOOL_SIZE:
+        return None
+
+    try:
+        fileno = stream.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+    if os.fstat(fileno).st_size > 0:
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+    return None
+
+
+def read_upload(f) -> bytes:
+    """
+    Returns the whole content of an uploaded file, even if it was already read.
+    The content is kept on the file object, so the following calls don't read it again.
+    The uploads spooled to disk are memory mapped (instead of being read into the worker memory).
+
+    Parameters
+    ----------
+    f : file object
+        The uploaded file (werkzeug FileStorage).
+
+    Returns
+    -------
+    bytes:
+        The content of the file (bytes or a bytes-like buffer), or None if the file can't be read again.
+    """
+
+    with upload_lock:
+        buffer = getattr(f, "content", None)
+        if buffer is not None:
+            return buffer
+
+        try:
+            f.content = _map_stream(f.stream)
+            if f.content is None:
+                f.stream.seek(0)
+                f.content = f.read()
+            return f.content
+        except Exception as e:
+            print(f"#### read_upload ERROR #### {e}")
+            return None
+
+
+def close_upload(f):
+    """
+    Closes the memory map of an upload read by read_upload and drops its ROI tier (at the end of the request).
+    A map still referenced (e.g. by an image decoded from it) is released by the garbage collector instead.
+    """
+
+    f.roi_future = None
+
+    content = getattr(f, "content", None)
+    if isinstance(content, mmap.mmap):
+        f.content = None
+        try:
+            content.close()
+        except BufferError:
+            pass
+
+
+def _read_jpeg_size(buffer) -> tuple:
+    """ Returns the (width, height) found in the SOF segment of a JPEG file. """
+
+    i = 2
+    size = len(buffer)
+    while i + 4 <= size:
+        if buffer[i] != 0xFF:
+            return None
+        marker = buffer[i + 1]
+
+        # --- fill bytes & standalone markers
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+
+        length = struct.unpack(">H", buffer[i + 2:i + 4])[0]
+        if marker in JPEG_SOF_MARKERS:
+            if i + 9 > size:
+                return None
+            height, width = struct.unpack(">HH", buffer[i + 5:i + 9])
+            return width, height
+        i += 2 + length
+
+    return None
+
+
+def _read_webp_size(buffer) -> tuple:
+    """ Returns the (width, height) found in the first chunk of a WebP file. """
+
+    chunk = buffer[12:16]
+    if chunk == b"VP8X" and len(buffer) >= 30:
+        width = int.from_bytes(buffer[24:27], "little") + 1
+        height = int.from_bytes(buffer[27:30], "little") + 1
+        return width, height
+    if chunk == b"VP8L" and len(buffer) >= 25:
+        bits = int.from_bytes(buffer[21:25], "little")
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8 " and len(buffer) >= 30:
+        width, height = struct.unpack("<HH", buffer[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    return None
+
+
+def _read_tiff_ifd(buffer, order: str, ifd: int) -> tuple:
+    """
+    Reads an IFD of a TIFF file.
+
+    Returns
+    -------
+    tuple of (dict, list, int)
+        The ImageWidth / ImageLength values found, the offsets of the SubIFDs and the offset of the next IFD
+        (0 for the last one), or None if the IFD is out of the file.
+    """
+
+    if ifd + 2 > len(buffer):
+        return None
+
+    entries = struct.unpack(order + "H", buffer[ifd:ifd + 2])[0]
+    values, sub_ifds = {}, []
+    for k in range(entries):
+        entry = ifd + 2 + 12 * k
+        if entry + 12 > len(buffer):
+            return None
+        tag, kind, count = struct.unpack(order + "HHI", buffer[entry:entry + 8])
+
+        if tag in (TIFF_WIDTH, TIFF_HEIGHT):
+            if kind == 3:  # SHORT
+                values[tag] = struct.unpack(order + "H", buffer[entry + 8:entry + 10])[0]
+            elif kind == 4:  # LONG
+                values[tag] = struct.unpack(order + "I", buffer[entry + 8:entry + 12])[0]
+
+        elif tag == TIFF_SUB_IFDS and kind in (4, 13):  # LONG or IFD offsets
+            if count == 1:
+                sub_ifds.append(struct.unpack(order + "I", buffer[entry + 8:entry + 12])[0])
+            else:
+                offset = struct.unpack(order + "I", buffer[entry + 8:entry + 12])[0]
+                count = min(count, TIFF_MAX_IFDS)
+                if offset + 4 * count <= len(buffer):
+                    sub_ifds.extend(struct.unpack(order + "I" * count, buffer[offset:offset + 4 * count]))
+
+    end = ifd + 2 + 12 * entries
+    next_ifd = struct.unpack(order + "I", buffer[end:end + 4])[0] if end + 4 <= len(buffer) else 0
+    return values, sub_ifds, next_ifd
+
+
+def _read_tiff_size(buffer) -> tuple:
+    """
+    Returns the largest (width, height) found in the IFDs of a TIFF file: the pages and their SubIFDs
+    (the first IFD of a DNG file is usually a small preview, the raw image is in a SubIFD).
+    """
+
+    order = "<" if buffer[:2] == b"II" else ">"
+    pending = [struct.unpack(order + "I", buffer[4:8])[0]]
+    visited = set()
+    largest = None
+
+    while len(pending) > 0 and len(visited) < TIFF_MAX_IFDS:
+        ifd = pending.pop()
+        if ifd == 0 or ifd in visited:
+            continue
+        visited.add(ifd)
+
+        content = _read_tiff_ifd(buffer, order, ifd)
+        if content is None:
+            return None
+        values, sub_ifds, next_ifd = content
+
+        if TIFF_WIDTH in values and TIFF_HEIGHT in values:
+            size = (values[TIFF_WIDTH], values[TIFF_HEIGHT])
+            if largest is None or size[0] * size[1] > largest[0] * largest[1]:
+                largest = size
+
+        pending.extend(sub_ifds)
+        pending.append(next_ifd)
+
+    return largest
+
+
+def _read_pfm_size(buffer) -> tuple:
+    """ Returns the (width, height) found in the text header of a PFM file. """
+
+    tokens = bytes(buffer[:64]).split()
+    if len(tokens) < 3:
+        return None
+    return int(tokens[1]), int(tokens[2])
+
+
+def read_image_size(buffer) -> tuple:
+    """
+    Returns the dimensions of an encoded image by reading its header only (no decoding).
+
+    Parameters
+    ----------
+    buffer : bytes
+        The content of the image file (JPEG, PNG, BMP, WebP, TIFF and PFM are supported).
+
+    Returns
+    -------
+    tuple:
+        The (width, height) of the image, or None if the format is not supported / the header is invalid.
+    """
+
+    try:
+        if buffer[:2] == b"\xff\xd8":
+            return _read_jpeg_size(buffer)
+        if buffer[:8] == b"\x89PNG\r\n\x1a\n" and len(buffer) >= 24:
+            return struct.unpack(">II", buffer[16:24])
+        if buffer[:2] == b"BM" and len(buffer) >= 26:
+            width, height = struct.unpack("<ii", buffer[18:26])
+            return abs(width), abs(height)
+        if buffer[:4] == b"RIFF" and buffer[8:12] == b"WEBP":
+            return _read_webp_size(buffer)
+        if buffer[:4] in (b"II*\0", b"MM\0*"):
+            return _read_tiff_size(buffer)
+        if buffer[:3] in (b"PF\n", b"Pf\n"):
+            return _read_pfm_size(buffer)
+    except Exception as e:
+        print(f"#### read_image_size ERROR #### {e}")
+
+    return None
+
+
+def get_reduction_factor(smallest_side: float, min_size: int) -> int:
+    """
+    Returns the biggest decoding reduction factor (1, 2, 4 or 8) keeping smallest_side >= min_size.
+    """
+
+    for factor in (8, 4, 2):
+        if smallest_side / factor >= min_size:
+            return factor
+    return 1
+
+
+def get_decoded_bytes(buffer, size: tuple, min_size: int) -> int:
+    """
+    Returns the memory needed to decode an image with decode_reduced (estimated from its header).
+
+    Parameters
+    ----------
+    buffer : bytes
+        The content of the image file.
+    size : tuple
+        The (width, height) of the image (see read_image_size).
+    min_size : int
+        The minimum size of the smallest side of the decoded image.
+
+    Returns
+    -------
+    int:
+        The number of bytes of the decoded image (only JPEG files are downscaled by the decoder,
+        the other formats are decoded at full resolution then resized).
+    """
+
+    width, height = size
+    factor = get_reduction_factor(min(width, height), min_size) if buffer[:2] == b"\xff\xd8" else 1
+    return (width // factor) * (height // factor) * 3
+
+
+def _full_size(image: np.array, header_size: tuple, factor: int) -> tuple:
+    """
+    Returns the (height, width) of the full resolution image in the orientation of the decoded image
+    (OpenCV applies the EXIF orientation, so the header dimensions might be swapped).
+    """
+
+    if header_size is None:
+        return image.shape[0] * factor, image.shape[1] * factor
+
+    width, height = header_size
+    if (image.shape[0] > image.shape[1]) != (height > width):
+        width, height = height, width
+    return height, width
+
+
+def decode_reduced(buffer, min_size: int) -> tuple:
+    """
+    Decodes an image at the lowest resolution keeping both sides >= min_size
+    (JPEG files are downscaled by the decoder itself, which is much faster and lighter
+    than decoding the full image).
+
+    Parameters
+    ----------
+    buffer : bytes
+        The content of the image file.
+    min_size : int
+        The minimum size of the smallest side of the decoded image.
+
+    Returns
+    -------
+    tuple of (ndarray, tuple)
+        The decoded image (or None if it can't be decoded) and the (height, width)
+        of the full resolution image.
+    """
+
+    header_size = read_image_size(buffer)
+    factor = 1 if header_size is None else get_reduction_factor(min(header_size), min_size)
+
+    image = cv2.imdecode(np.frombuffer(buffer, np.uint8), REDUCED_FLAGS[factor])
+    if image is None:
+        return None, None
+
+    return image, _full_size(image, header_size, factor)
+
+
+def _decode_roi_tier(buffer) -> tuple:
+    """
+    Decodes the ROI tier of an image: the lowest resolution keeping its smallest side >= ROI_MIN_SIDE.
+
+    Returns
+    -------
+    tuple of (ndarray, float, float)
+        The decoded image and its (x, y) scales from the full resolution image coordinates,
+        or None if the image can't be decoded.
+    """
+
+    if buffer is None:
+        return None
+
+    header_size = read_image_size(buffer)
+    factor = 1 if header_size is None else get_reduction_factor(min(header_size), ROI_MIN_SIDE)
+
+    image = cv2.imdecode(np.frombuffer(buffer, np.uint8), REDUCED_FLAGS[factor])
+    if image is None:
+        return None
+
+    full_h, full_w = _full_size(image, header_size, factor)
+    return image, image.shape[1] / full_w, image.shape[0] / full_h
+
+
+def prefetch_roi_image(f):
+    """
+    Starts decoding the ROI tier of an upload in the decode pool (once per upload, the damages &
+    plates pipelines of a request share it until release_roi_image), returns its future.
+    """
+
+    with roi_lock:
+        future = getattr(f, "roi_future", None)
+        if future is None:
+            future = decode_pool.submit(_decode_roi_tier, read_upload(f))
+            f.roi_future = future
+    return future
+
+
+def release_roi_image(f):
+    """
+    Releases the ROI tier of an upload for one of its users (see share_roi_images):
+    it is dropped once every pipeline cropped its boxes.
+    """
+
+    with roi_lock:
+        f.roi_users = getattr(f, "roi_users", 1) - 1
+        if f.roi_users <= 0:
+            f.roi_future = None
+
+
+def share_roi_images(files: list, users: int):
+    """ Keeps the ROI tier of the uploads until 'users' pipelines released it (e.g. 2 for /predict_all). """
+
+    with roi_lock:
+        for f in files:
+            f.roi_users = users
+
+
+def crop_rois(f, boxes: list) -> list:
+    """
+    Crops the regions of interest of an upload from its ROI tier (decoded once per upload,
+    see prefetch_roi_image).
+
+    Parameters
+    ----------
+    f : file object
+        The uploaded file (see read_upload).
+    boxes : list
+        The (x1, y1, x2, y2) boxes to extract, in the coordinates of the full resolution image.
+
+    Returns
+    -------
+    list:
+        The crops (BGR uint8 ndarrays, in the same order as the boxes),
+        or None if the image can't be decoded.
+    """
+
+    if len(boxes) == 0:
+        return []
+
+    roi = prefetch_roi_image(f).result()
+    if roi is None:
+        return None
+    image, scale_x, scale_y = roi
+
+    crops = []
+    for x1, y1, x2, y2 in boxes:
+        x1, x2 = int(x1 * scale_x), int(x2 * scale_x)
+        y1, y2 = int(y1 * scale_y), int(y2 * scale_y)
+
+        # --- keep at least one pixel & copy, so the decoded image can be released
+        crops.append(image[y1:max(y2, y1 + 1), x1:max(x2, x1 + 1)].copy())
+
+    return crops
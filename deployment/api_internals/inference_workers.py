@@ -0,0 +1,387 @@
+import concurrent.futures
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# --- DEFINE VARIABLES
+# In the inference-server mode, the models run in dedicated processes (DAMAGE_WORKERS / PLATE_WORKERS
+# processes per gunicorn worker, 0 = the models run in the gunicorn worker itself). The gunicorn threads
+# only validate & decode the uploads, then the images are passed to the processes through shared memory.
+
+WORKER_COUNTS = {
+    "damages": int(os.environ.get("DAMAGE_WORKERS") or 0),
+    "plates": int(os.environ.get("PLATE_WORKERS") or 0),
+}
+
+# Maximum duration of a prediction in a worker process (seconds)
+INFERENCE_TIMEOUT = float(os.environ.get("INFERENCE_TIMEOUT") or 60)
+
+# Set in the environment of the worker processes (the task they run)
+WORKER_TASK = os.environ.get("INFERENCE_WORKER_TASK")
+
+# The shared memory blocks are split in 64 bytes aligned segments
+ALIGNMENT = 64
+
+pools = {}
+pools_lock = threading.Lock()
+
+# Serializes the temporary INFERENCE_WORKER_TASK environment variable of the processes being started
+environ_lock = threading.Lock()
+
+# --- DEFINE FUNCTIONS
+
+
+def loads_models(task: str) -> bool:
+    """
+    Returns True if the models of a task ('damages' or 'plates') must be loaded by the current process:
+    the worker processes of the task, or the gunicorn workers if the task has no worker processes.
+    """
+
+    if WORKER_TASK is not None:
+        return WORKER_TASK == task
+    return WORKER_COUNTS[task] == 0
+
+
+def get_pool(task: str):
+    """
+    Returns the InferencePool of a task (started on the first call),
+    or None if the models of the task run in the current process.
+    """
+
+    if loads_models(task):
+        return None
+
+    with pools_lock:
+        if task not in pools:
+            pools[task] = InferencePool(task, WORKER_COUNTS[task])
+        return pools[task]
+
+
+def start_pools():
+    """ Starts the worker processes of every task that has some (see WORKER_COUNTS). """
+
+    for task in WORKER_COUNTS:
+        get_pool(task)
+
+
+def wait_pools(timeout: float = None) -> bool:
+    """ Waits until every started pool has at least one worker process ready. """
+
+    return all(pool.wait_ready(timeout) for pool in list(pools.values()))
+
+
+def _aligned(size: int) -> int:
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def pack(images: list, buffers: list) -> tuple:
+    """
+    Copies the images (and the encoded uploads) into a new shared memory block.
+
+    Parameters
+    ----------
+    images : list
+        The preprocessed images (uint8 ndarrays).
+    buffers : list
+        The content of the uploaded files (bytes or None), in the same order as the images.
+
+    Returns
+    -------
+    tuple of (SharedMemory, list)
+        The shared memory block and its layout: one ((offset, shape, dtype), (offset, length)) tuple
+        per image (the second item is None when the upload content is not passed).
+    """
+
+    sizes = [_aligned(image.nbytes) + _aligned(len(b) if b is not None else 0) for image, b in zip(images, buffers)]
+    shm = shared_memory.SharedMemory(create=True, size=max(sum(sizes), 1))
+
+    layout = []
+    offset = 0
+    for image, buffer in zip(images, buffers):
+        image = np.ascontiguousarray(image)
+        np.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf, offset=offset)[...] = image
+        image_layout = (offset, image.shape, image.dtype.str)
+        offset += _aligned(image.nbytes)
+
+        buffer_layout = None
+        if buffer is not None:
+            shm.buf[offset:offset + len(buffer)] = buffer
+            buffer_layout = (offset, len(buffer))
+            offset += _aligned(len(buffer))
+
+        layout.append((image_layout, buffer_layout))
+
+    return shm, layout
+
+
+class SharedUpload:
+    """
+    An uploaded file in a worker process: its content is a view of the shared memory block,
+    so image_io.read_upload returns it without reading anything.
+    """
+
+    def __init__(self, filename, content):
+        self.filename = filename
+        self.content = content
+
+
+def unpack(shm, layout: list, filenames: list) -> tuple:
+    """ Returns the (images, files) views of a shared memory block (no copy). """
+
+    images, files = [], []
+    for ((image_offset, shape, dtype), buffer_layout), filename in zip(layout, filenames):
+        images.append(np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=image_offset))
+
+        content = None
+        if buffer_layout is not None:
+            buffer_offset, length = buffer_layout
+            content = shm.buf[buffer_offset:buffer_offset + length]
+        files.append(SharedUpload(filename, content))
+
+    return images, files
+
+
+def get_handler(task: str):
+    """ Imports the module of a task (which loads its models) and returns its (predict, warmup) functions. """
+
+    if task == "damages":
+        from api_internals import predict_damages
+
+        return predict_damages.predict_raw_damages, predict_damages.warmup
+
+    from api_internals import predict_plates
+
+    return predict_plates.predict_raw_plates, predict_plates.warmup
+
+
+def worker_main(task: str, task_queue, result_queue):
+    """
+    The main loop of a worker process: loads & warms up the models of the task,
+    then predicts the jobs of the task queue until it receives None.
+    """
+
+    try:
+        predict, warmup = get_handler(task)
+        warmup()
+    except Exception as e:
+        print(f"#### inference worker ERROR #### {e}")
+        result_queue.put((None, "failed", str(e)))
+        return
+
+    result_queue.put((None, "ready", os.getpid()))
+
+    while True:
+        job = task_queue.get()
+        if job is None:
+            break
+
+        job_id, shm_name, layout, filenames, ratios = job
+        try:
+            shm = shared_memory.SharedMemory(name=shm_name)
+        except FileNotFoundError:
+            continue  # the job timed out, its memory was already released
+
+        # (the pool fails the pending job of a process that dies)
+        result_queue.put((job_id, "started", os.getpid()))
+
+        try:
+            images, files = unpack(shm, layout, filenames)
+            result_queue.put((job_id, "ok", predict(images, files, ratios)))
+        except Exception as e:
+            print(f"#### inference worker ERROR #### {e}")
+            result_queue.put((job_id, "error", str(e)))
+        finally:
+            images = files = None
+            try:
+                shm.close()
+            except BufferError:
+                pass  # a view is still referenced, the block is released with the process
+
+
+# --- DEFINE CLASSES
+
+
+class InferencePool:
+    """
+    A pool of worker processes running the models of a task. The jobs are sent through a queue
+    shared by the processes (the idle ones take them first), the images through shared memory,
+    and the (small, JSON serializable) results come back through a second queue.
+
+    Attributes
+    ----------
+    task : str
+        The task of the pool ('damages' or 'plates').
+    workers : int
+        The number of worker processes.
+
+    Methods
+    -------
+    predict(images, files, ratios, pass_uploads)
+        Returns the raw predictions of the images (the same as predict_raw_damages / predict_raw_plates).
+    wait_ready(timeout)
+        Waits until at least one worker process is ready.
+    """
+
+    def __init__(self, task: str, workers: int):
+        self.task = task
+        self.workers = workers
+
+        # spawn: the worker processes don't inherit the threads & the state of the gunicorn worker
+        self.context = multiprocessing.get_context("spawn")
+        self.task_queue = self.context.Queue()
+        self.result_queue = self.context.Queue()
+
+        self.pending = {}  # job id: (future, shared memory, pid of the process predicting it or None)
+        self.lock = threading.Lock()
+        self.job_ids = itertools.count()
+        self.ready = threading.Event()
+        self.error = None
+        self.processes = [self._start_process() for _ in range(workers)]
+
+        self.receiver = threading.Thread(target=self._receive, name=f"{task}-results", daemon=True)
+        self.receiver.start()
+
+    def _start_process(self):
+        # The task is set in the environment (instead of being passed as an argument) so that it is known
+        # while the spawned interpreter imports the modules, before worker_main is called
+        with environ_lock:
+            os.environ["INFERENCE_WORKER_TASK"] = self.task
+            try:
+                process = self.context.Process(
+                    target=worker_main,
+                    args=(self.task, self.task_queue, self.result_queue),
+                    name=f"{self.task}-worker",
+                    daemon=True,
+                )
+                process.start()
+            finally:
+                del os.environ["INFERENCE_WORKER_TASK"]
+        return process
+
+    def _receive(self):
+        """ Dispatches the results to the waiting requests (and restarts the dead processes). """
+
+        last_check = time.monotonic()
+
+        while True:
+            if time.monotonic() - last_check >= 1.0:
+                self._restart_dead_processes()
+                last_check = time.monotonic()
+
+            try:
+                job_id, status, value = self.result_queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+
+            if job_id is None:
+                if status == "ready":
+                    self.ready.set()
+                else:
+                    self.error = value  # the models can't be loaded, the processes are not restarted
+                    self.ready.set()
+                continue
+
+            if status == "started":
+                with self.lock:
+                    entry = self.pending.get(job_id)
+                    if entry is not None:
+                        self.pending[job_id] = (*entry[:2], value)
+                # (the process died and was replaced before its message was read)
+                if entry is not None and all(process.pid != value for process in self.processes):
+                    self._fail_jobs(value, "an inference worker exited during the prediction")
+                continue
+
+            with self.lock:
+                entry = self.pending.pop(job_id, None)
+            if entry is None:
+                continue  # the request already timed out
+
+            future, shm, _ = entry
+            _release(shm)
+            if status == "ok":
+                future.set_result(value)
+            else:
+                future.set_exception(RuntimeError(value))
+
+    def _restart_dead_processes(self):
+        if self.error is not None:
+            return
+
+        for k, process in enumerate(self.processes):
+            if not process.is_alive():
+                print(f"#### inference worker ERROR #### {process.name} exited ({process.exitcode}), restarting it")
+                self._fail_jobs(process.pid, f"{process.name} exited ({process.exitcode}) during the prediction")
+                self.processes[k] = self._start_process()
+
+    def _fail_jobs(self, pid: int, message: str):
+        """ Fails the pending jobs of a dead process (instead of letting their requests reach INFERENCE_TIMEOUT). """
+
+        with self.lock:
+            job_ids = [job_id for job_id, (_, _, job_pid) in self.pending.items() if job_pid == pid]
+            entries = [self.pending.pop(job_id) for job_id in job_ids]
+
+        for future, shm, _ in entries:
+            _release(shm)
+            future.set_exception(RuntimeError(message))
+
+    def wait_ready(self, timeout: float = None) -> bool:
+        return self.ready.wait(timeout) and self.error is None
+
+    def predict(self, images: list, files: list, ratios: list, pass_uploads: bool = True) -> list:
+        """
+        Predicts a list of images in a worker process.
+
+        Parameters
+        ----------
+        images : list
+            The preprocessed images.
+        files : list
+            The uploaded files (their content is passed to the worker when pass_uploads is True,
+            to decode the regions of interest at a higher resolution).
+        ratios : list
+            The original ratios of the images.
+        pass_uploads : bool
+            Pass the content of the uploaded files.
+
+        Returns
+        -------
+        list:
+            One list of raw predictions per image.
+        """
+
+        from api_internals.image_io import read_upload
+
+        buffers = [read_upload(f) if pass_uploads else None for f in files]
+        shm, layout = pack(images, buffers)
+
+        job_id = next(self.job_ids)
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.pending[job_id] = (future, shm, None)
+
+        self.task_queue.put((job_id, shm.name, layout, [f.filename for f in files], [tuple(r) for r in ratios]))
+
+        try:
+            return future.result(timeout=INFERENCE_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            with self.lock:
+                entry = self.pending.pop(job_id, None)
+            if entry is not None:
+                _release(entry[1])
+            raise
+
+
+def _release(shm):
+    """ Closes & removes a shared memory block created by InferencePool.predict. """
+
+    try:
+        shm.close()
+        shm.unlink()
+    except Exception as e:
+        print(f"#### inference worker ERROR #### {e}")
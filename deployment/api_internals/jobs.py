@@ -0,0 +1,177 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from api_internals.responses import dumps
+
+
+class JobStore:
+    """
+    Runs long predictions in a bounded pool of local worker threads and keeps
+    their status / results in memory so that the clients can poll them.
+
+    The store is bounded in number of jobs and in total size of the results (the oldest
+    finished jobs are dropped first), and in time (finished jobs expire after ttl seconds).
+
+    The jobs only exist in the process that received them: with several gunicorn workers,
+    GET /jobs/<id> must reach the same worker (single worker or sticky routing).
+
+    Attributes
+    ----------
+    max_workers : int
+        The number of jobs running at the same time.
+    max_pending : int
+        The maximum number of queued or running jobs (new jobs are refused above it).
+    max_stored : int
+        The maximum number of jobs kept in memory.
+    ttl : float
+        The time (in seconds) a finished job is kept in memory.
+    max_result_bytes : int
+        The maximum total size of the stored results (serialized as JSON), a result
+        bigger than this on its own fails its job.
+
+    Methods
+    -------
+    submit(fn)
+        Queues a new job and returns its id (or None if the store is full).
+    get(job_id)
+        Returns the status of a job (or None if unknown or expired).
+    """
+
+    def __init__(self, max_workers=2, max_pending=16, max_stored=256, ttl=3600, max_result_bytes=64 * 1024 * 1024):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.max_stored = max_stored
+        self.ttl = ttl
+        self.max_result_bytes = max_result_bytes
+
+        self._jobs = OrderedDict()
+        self._result_bytes = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _remove(self, job_id):
+        self._result_bytes -= self._jobs.pop(job_id)["result_bytes"]
+
+    def _purge(self):
+        """
+        Removes the expired jobs, then the oldest finished jobs above max_stored
+        or while the results take more than max_result_bytes (lock held).
+        """
+
+        now = time.time()
+        for job_id in list(self._jobs):
+            job = self._jobs[job_id]
+            if job["finished_at"] is not None and now - job["finished_at"] > self.ttl:
+                self._remove(job_id)
+
+        for job_id in list(self._jobs):
+            if len(self._jobs) <= self.max_stored and self._result_bytes <= self.max_result_bytes:
+                break
+            if self._jobs[job_id]["finished_at"] is not None:
+                self._remove(job_id)
+
+    def submit(self, fn) -> str:
+        """
+        Queues a new job.
+
+        Parameters
+        ----------
+        fn : callable
+            The function to run. It receives a progress(stage, step, steps) callback
+            and its return value is stored as the result of the job.
+
+        Returns
+        -------
+        str:
+            The id of the new job, or None if there are already max_pending unfinished jobs.
+        """
+
+        with self._lock:
+            self._purge()
+
+            pending = sum(1 for job in self._jobs.values() if job["finished_at"] is None)
+            if pending >= self.max_pending:
+                return None
+
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="job"
+                )
+
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                "id": job_id,
+                "status": "pending",
+                "progress": {"stage": None, "step": 0, "steps": None},
+                "result": None,
+                "result_bytes": 0,
+                "error": None,
+                "created_at": time.time(),
+                "finished_at": None,
+            }
+
+        self._executor.submit(self._run, job_id, fn)
+        return job_id
+
+    def _update(self, job_id, **values):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(values)
+
+    def _run(self, job_id, fn):
+        """ Runs a job in a worker thread and stores its outcome. """
+
+        def progress(stage, step, steps):
+            self._update(job_id, progress={"stage": stage, "step": step, "steps": steps})
+
+        self._update(job_id, status="running")
+
+        try:
+            result = fn(progress)
+            result_bytes = len(dumps(result))
+            if result_bytes > self.max_result_bytes:
+                raise ValueError(f"The result is too large to be stored ({result_bytes} bytes).")
+        except Exception as e:
+            print(f"#### job {job_id} ERROR #### {e}")
+            self._update(job_id, status="failed", error=str(e), finished_at=time.time())
+            return
+
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(status="done", result=result, result_bytes=result_bytes, finished_at=time.time())
+                self._result_bytes += result_bytes
+                self._purge()
+
+    def get(self, job_id: str) -> dict:
+        """
+        Returns a copy of the status of a job.
+
+        Parameters
+        ----------
+        job_id : str
+            The id returned by submit.
+
+        Returns
+        -------
+        dict:
+            The job id, status (pending / running / done / failed), progress,
+            result and error, or None if the job is unknown or expired.
+        """
+
+        with self._lock:
+            self._purge()
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return {
+                "id": job["id"],
+                "status": job["status"],
+                "progress": dict(job["progress"]),
+                "result": job["result"],
+                "error": job["error"],
+            }
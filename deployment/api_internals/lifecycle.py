@@ -0,0 +1,80 @@
+import gc
+import os
+import threading
+
+from api_internals import config_postgres
+from api_internals import inference_workers
+from api_internals import predict_damages
+from api_internals import predict_plates
+
+# --- DEFINE VARIABLES
+
+# WARMUP=0 skips the warmup inference (the server is then ready as soon as it starts)
+WARMUP = (os.environ.get("WARMUP") or "1") != "0"
+
+# Maximum duration of the start of the inference worker processes (seconds, see inference_workers)
+WORKER_START_TIMEOUT = float(os.environ.get("WORKER_START_TIMEOUT") or 600)
+
+state = {"ready": False, "error": None}
+
+# --- DEFINE FUNCTIONS
+
+
+def freeze_models():
+    """
+    Moves every object allocated so far (the models in particular) to the permanent generation
+    of the garbage collector. Once the gunicorn master has loaded the models (--preload),
+    the collections of the workers don't touch these objects anymore, so their memory pages
+    stay shared with the master (copy-on-write) instead of being duplicated in every worker.
+    """
+
+    gc.collect()
+    gc.freeze()
+
+
+def warmup():
+    """
+    Runs every model once on synthetic images, so that the lazy allocations and the first-run
+    costs (thread pools, kernels selection, ...) are paid before the first real request.
+    """
+
+    try:
+        # the models run in the inference worker processes (which warm them up themselves)
+        inference_workers.start_pools()
+        if not inference_workers.wait_pools(WORKER_START_TIMEOUT):
+            errors = [pool.error for pool in inference_workers.pools.values() if pool.error is not None]
+            raise RuntimeError(errors[0] if errors else "the inference workers are not ready")
+
+        if WARMUP:
+            if predict_damages.LOAD_MODELS:
+                predict_damages.warmup()
+            if predict_plates.LOAD_MODELS:
+                predict_plates.warmup()
+
+        state["ready"] = True
+        print("Models warmed up, the server is ready")
+
+    except Exception as e:
+        state["error"] = str(e)
+        print(f"#### warmup ERROR #### {e}")
+
+
+def start_warmup():
+    """ Runs the warmup in a background thread (the /ready endpoint reports when it is done). """
+
+    thread = threading.Thread(target=warmup, name="warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def after_fork():
+    """ Prepares a forked gunicorn worker (see gunicorn.conf.py). """
+
+    config_postgres.after_fork()
+    start_warmup()
+
+
+def is_ready() -> bool:
+    """ Returns True once the models are warmed up. """
+
+    return state["ready"]
@@ -0,0 +1,143 @@
+import os
+import time
+from contextlib import contextmanager
+
+from flask import has_request_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    REGISTRY,
+)
+
+# --- DEFINE METRICS
+# (with several gunicorn workers, set PROMETHEUS_MULTIPROC_DIR so that /metrics aggregates all of them)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+REQUEST_LATENCY = Histogram(
+    "mycover_request_seconds", "Latency of the API requests.",
+    ["endpoint"], buckets=LATENCY_BUCKETS,
+)
+STAGE_LATENCY = Histogram(
+    "mycover_stage_seconds", "Latency of the pipeline stages.",
+    ["stage", "endpoint", "model"], buckets=LATENCY_BUCKETS,
+)
+IMAGES = Counter("mycover_images_total", "Number of images received.", ["endpoint"])
+BOXES = Counter("mycover_boxes_total", "Number of boxes detected.", ["endpoint", "model"])
+DB_LOOKUPS = Counter("mycover_db_lookups_total", "Number of price lookups.", ["source"])
+ERRORS = Counter("mycover_errors_total", "Number of errors.", ["endpoint", "stage"])
+DUPLICATES = Counter("mycover_duplicate_images_total", "Number of near-identical images not predicted.", ["endpoint"])
+REJECTIONS = Counter("mycover_rejections_total", "Number of rejected requests.", ["endpoint", "reason"])
+DB_CONNECTIONS = Gauge(
+    "mycover_db_pool_checked_out", "Number of database connections checked out of the pool.",
+    multiprocess_mode="livesum",
+)
+DB_UNAVAILABLE = Counter(
+    "mycover_db_unavailable_total",
+    "Number of times the price database couldn't be reached (the lookups are then skipped for DB_RETRY_INTERVAL seconds).",
+)
+DB_POOL_WAIT = Histogram(
+    "mycover_db_pool_wait_seconds", "Waiting time for a database connection (pool checkout & connect).",
+    buckets=LATENCY_BUCKETS,
+)
+
+# --- DEFINE FUNCTIONS
+
+
+def current_endpoint() -> str:
+    """ Returns the name of the endpoint of the current request ('none' outside of a request). """
+
+    if has_request_context() and request.endpoint is not None:
+        return request.endpoint
+    return "none"
+
+
+@contextmanager
+def timer(stage: str, model: str = ""):
+    """
+    Records the duration of a stage (and counts an error if it raises).
+
+    Parameters
+    ----------
+    stage : str
+        The name of the stage (decode, detect_damages, severity, price, detect_plates, ocr, ...).
+    model : str
+        The name of the model used by the stage (if any).
+    """
+
+    endpoint = current_endpoint()
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS.labels(endpoint, stage).inc()
+        raise
+    finally:
+        STAGE_LATENCY.labels(stage, endpoint, model or "").observe(time.perf_counter() - start)
+
+
+def count_images(count: int):
+    IMAGES.labels(current_endpoint()).inc(count)
+
+
+def count_boxes(count: int, model: str):
+    BOXES.labels(current_endpoint(), model).inc(count)
+
+
+def count_db_lookups(count: int, source: str):
+    DB_LOOKUPS.labels(source).inc(count)
+
+
+def count_error(stage: str):
+    ERRORS.labels(current_endpoint(), stage).inc()
+
+
+def count_duplicates(count: int):
+    DUPLICATES.labels(current_endpoint()).inc(count)
+
+
+def count_rejection(reason: str):
+    REJECTIONS.labels(current_endpoint(), reason).inc()
+
+
+def count_db_connections(delta: int):
+    DB_CONNECTIONS.inc(delta)
+
+
+def count_db_unavailable():
+    DB_UNAVAILABLE.inc()
+
+
+@contextmanager
+def db_pool_timer():
+    """ Records the waiting time for a database connection. """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        DB_POOL_WAIT.observe(time.perf_counter() - start)
+
+
+def export() -> tuple:
+    """
+    Returns the metrics in the Prometheus text format.
+
+    Returns
+    -------
+    tuple of (bytes, str)
+        The metrics and their content type.
+    """
+
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,216 @@
+import ast
+import os
+from pathlib import Path
+
+import cv2
+import numpy as np
+import onnxruntime as rt
+
+# --- DEFINE VARIABLES
+
+# Same defaults as the ultralytics predictor
+DEFAULT_CONF = 0.25
+DEFAULT_IOU = 0.7
+DEFAULT_MAX_DET = 300
+
+# Input size of the models exported with dynamic height & width
+MODEL_INPUT_SIZE = 640
+
+# --- DEFINE CLASSES
+
+
+class OnnxBox:
+    """
+    A detected box, with the same attributes as the ultralytics boxes
+    used by predict_damages & predict_plates (xyxy[0], cls, conf).
+    """
+
+    def __init__(self, xyxy, cls, conf):
+        self.xyxy = xyxy.reshape(1, 4)
+        self.cls = np.float32(cls)
+        self.conf = np.float32(conf)
+
+
+class OnnxResults:
+    """ The detections of an image (a minimal equivalent of the ultralytics Results). """
+
+    def __init__(self, boxes, names):
+        self.boxes = boxes
+        self.names = names
+
+
+class OnnxYOLO:
+    """
+    Runs a YOLOv8 detector exported to ONNX with ONNX Runtime, as a drop-in
+    replacement of ultralytics.YOLO for the predict(images, agnostic_nms=True) calls.
+
+    The images are expected to be BGR uint8 arrays of the model input size
+    (the API already resizes them to 640x640, so no letterbox is needed).
+
+    Attributes
+    ----------
+    session : onnxruntime.InferenceSession
+        The ONNX Runtime session.
+    names : dict
+        The names of the classes ({index: name}), read from the model metadata.
+
+    Methods
+    -------
+    predict(images, agnostic_nms=False, conf=0.25, iou=0.7, max_det=300)
+        Returns the detections (one OnnxResults per image).
+    """
+
+    def __init__(self, model_path, intra_op_threads=0, inter_op_threads=0):
+        options = rt.SessionOptions()
+        options.graph_optimization_level = rt.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 1:
+            options.execution_mode = rt.ExecutionMode.ORT_PARALLEL
+
+        self.session = rt.InferenceSession(
+            str(model_path), sess_options=options, providers=["CPUExecutionProvider"]
+        )
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        # (the dynamic dimensions are named, e.g. 'height': the API images are 640x640)
+        height, width = model_input.shape[2], model_input.shape[3]
+        self.input_size = (
+            width if isinstance(width, int) else MODEL_INPUT_SIZE,
+            height if isinstance(height, int) else MODEL_INPUT_SIZE,
+        )
+        self.batch_size = model_input.shape[0] if isinstance(model_input.shape[0], int) else None
+
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.names = ast.literal_eval(metadata["names"]) if "names" in metadata else {}
+
+    def _preprocess(self, images):
+        """ Converts BGR uint8 HWC images into a RGB float32 NCHW tensor scaled to [0, 1]. """
+
+        batch = np.empty((len(images), 3, self.input_size[1], self.input_size[0]), dtype=np.float32)
+        for j, image in enumerate(images):
+            if image.shape[1] != self.input_size[0] or image.shape[0] != self.input_size[1]:
+                image = cv2.resize(image, self.input_size, interpolation=cv2.INTER_LINEAR)
+            batch[j] = image[:, :, ::-1].transpose(2, 0, 1)
+        batch *= 1.0 / 255.0
+        return batch
+
+    def _postprocess(self, output, agnostic_nms, conf, iou, max_det):
+        """
+        Decodes the (4 + nc, anchors) output of an image into boxes, then applies the NMS.
+        """
+
+        predictions = output.T  # (anchors, 4 + nc)
+        scores = predictions[:, 4:]
+        classes = scores.argmax(axis=1)
+        confidences = scores[np.arange(len(scores)), classes]
+
+        keep = confidences > conf
+        predictions, classes, confidences = predictions[keep], classes[keep], confidences[keep]
+        if len(predictions) == 0:
+            return []
+
+        # --- (cx, cy, w, h) => (x1, y1, x2, y2)
+        xyxy = np.empty((len(predictions), 4), dtype=np.float32)
+        xyxy[:, 0] = predictions[:, 0] - predictions[:, 2] / 2
+        xyxy[:, 1] = predictions[:, 1] - predictions[:, 3] / 2
+        xyxy[:, 2] = predictions[:, 0] + predictions[:, 2] / 2
+        xyxy[:, 3] = predictions[:, 1] + predictions[:, 3] / 2
+        xyxy[:, [0, 2]] = np.clip(xyxy[:, [0, 2]], 0, self.input_size[0])
+        xyxy[:, [1, 3]] = np.clip(xyxy[:, [1, 3]], 0, self.input_size[1])
+
+        # --- offset the boxes per class so that the NMS doesn't mix the classes (if not agnostic)
+        offsets = 0 if agnostic_nms else classes[:, None].astype(np.float32) * 7680.0
+        nms_boxes = xyxy + offsets
+        nms_boxes[:, 2:] -= nms_boxes[:, :2]  # (x, y, w, h) for OpenCV
+
+        indices = cv2.dnn.NMSBoxes(nms_boxes.tolist(), confidences.tolist(), conf, iou)
+        indices = np.array(indices).reshape(-1)
+
+        # --- sorted by confidence (as ultralytics), at most max_det boxes
+        indices = indices[np.argsort(-confidences[indices], kind="stable")][:max_det]
+
+        return [OnnxBox(xyxy[k], classes[k], confidences[k]) for k in indices]
+
+    def predict(self, images, agnostic_nms=False, conf=DEFAULT_CONF, iou=DEFAULT_IOU, max_det=DEFAULT_MAX_DET):
+        """
+        Predicts the boxes of a list of images.
+
+        Parameters
+        ----------
+        images : list
+            A list of BGR uint8 arrays.
+        agnostic_nms : bool
+            Apply the NMS to all the classes at once (True) or class by class (False).
+        conf : float
+            The minimum confidence of the boxes.
+        iou : float
+            The IoU threshold of the NMS.
+        max_det : int
+            The maximum number of boxes per image.
+
+        Returns
+        -------
+        list:
+            One OnnxResults per image.
+        """
+
+        if len(images) == 0:
+            return []
+
+        step = self.batch_size or len(images)
+
+        results = []
+        for start in range(0, len(images), step):
+            batch = self._preprocess(images[start:start + step])
+            outputs = self.session.run(None, {self.input_name: batch})[0]
+
+            for output in outputs:
+                boxes = self._postprocess(output, agnostic_nms, conf, iou, max_det)
+                results.append(OnnxResults(boxes, self.names))
+
+        return results
+
+
+# --- DEFINE FUNCTIONS
+
+
+def detector_name(model_name: str) -> str:
+    """ Returns the name of the model file used by load_detector (without loading it). """
+
+    if (os.environ.get("DETECTOR_BACKEND") or "torch").lower() == "onnx":
+        return str(Path(model_name).with_suffix(".onnx"))
+    return model_name
+
+
+def load_detector(model_name: str):
+    """
+    Loads a YOLO detector with the backend selected by the DETECTOR_BACKEND environment variable:
+    'torch' (default) loads the .pt model with ultralytics, 'onnx' loads the exported .onnx
+    model (same name, same folder) with ONNX Runtime (ORT_INTRA_OP_THREADS / ORT_INTER_OP_THREADS).
+
+    Parameters
+    ----------
+    model_name : str
+        The name of the .pt model in the 'models' folder.
+
+    Returns
+    -------
+    tuple of (model, str)
+        The detector and the name of the model file actually used.
+    """
+
+    name = detector_name(model_name)
+
+    if name.endswith(".onnx"):
+        model = OnnxYOLO(
+            Path("models", name),
+            intra_op_threads=int(os.environ.get("ORT_INTRA_OP_THREADS") or 0),
+            inter_op_threads=int(os.environ.get("ORT_INTER_OP_THREADS") or 0),
+        )
+        return model, name
+
+    from ultralytics import YOLO
+
+    return YOLO(Path("models", model_name)), model_name
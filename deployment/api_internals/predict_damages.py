@@ -1,56 +1,86 @@
+import os
 from pathlib import Path
 
-from api_internals.config_postgres import get_db_price
+from api_internals.config_postgres import get_db_price, get_db_prices
+from api_internals.batch_scheduler import BatchScheduler
+from api_internals.image_io import crop_rois, prefetch_roi_image, release_roi_image
+from api_internals.result_cache import make_cache, make_key
+from api_internals.onnx_detector import load_detector, detector_name
+from api_internals import inference_workers
+from api_internals import metrics
+from api_internals.dedup import DEDUP, StreamDeduplicator, get_representative, fan_out, copy_raws
+from api_internals.config_severity import (
+    DEFAULT_THRESHOLDS,
+    SEVERITY_INPUT_SIZE,
+    get_fixed_batch_size,
+    pad_severity_batch,
+    sev_model_name,
+    model_severity_input_name,
+    model_severity_output_name,
+)
 
 import cv2
 import numpy as np
 
-from ultralytics import YOLO
 import onnxruntime as rt
 
 print("ONX:", rt.get_device())
 
 # --- INIT DAMAGES MODEL
 
-cdd_model_name = "car_damage_detect_2.pt"
-model_cdd = YOLO(Path("models", cdd_model_name))
+# (DETECTOR_BACKEND=onnx runs the exported car_damage_detect_2.onnx with ONNX Runtime)
+# (with DAMAGE_WORKERS > 0, the models are only loaded by the inference worker processes)
+LOAD_MODELS = inference_workers.loads_models("damages")
+
+if LOAD_MODELS:
+    model_cdd, cdd_model_name = load_detector("car_damage_detect_2.pt")
+else:
+    model_cdd, cdd_model_name = None, detector_name("car_damage_detect_2.pt")
+
+# The images of concurrent requests are predicted together
+# (batches of at most CDD_MAX_BATCH_SIZE images, waiting at most CDD_MAX_WAIT_MS)
+cdd_scheduler = BatchScheduler(
+    lambda images: model_cdd.predict(images, agnostic_nms=True),
+    max_batch_size=int(os.environ.get("CDD_MAX_BATCH_SIZE") or 8),
+    max_wait=float(os.environ.get("CDD_MAX_WAIT_MS") or 10) / 1000.0,
+)
 
-# --- INIT SEVERITY MODEL
+# --- INIT RESULT CACHE (raw detections per image content)
 
-sev_model_name = "severity_model.onnx"
-model_severity_input_name = "sequential_2_input"
-model_severity_output_name = "output_layer"
+damage_cache = make_cache("damages")
 
+# --- INIT SEVERITY MODEL
+
+# (SEVERITY_PRECISION=int8 loads the quantized model, see config_severity)
 providers = [
     "TensorrtExecutionProvider",
     "CUDAExecutionProvider",
     "CPUExecutionProvider",
 ]
 
-model_severity = rt.InferenceSession(
-    str(Path("models", sev_model_name)), providers=providers
-)
-
-# --- DEFINE VARIABLES
-
-DEFAULT_THRESHOLDS = {
-    "hood_damage": 0.5,
-    "front_bumper_damage": 0.5,
-    "front_fender_damage": 0.5,
-    "headlight_damage": 0.0,  # REPLACE
-    "front_windscreen_damage": 0.0,  # REPLACE
-    "sidemirror_damage": 0.0,  # REPLACE
-    "sidedoor_panel_damage": 0.5,
-    "roof_damage": 0.5,
-    "runnigboard_damage": 0.5,
-    "pillar_damage": 0.5,
-    "sidedoor_window_damage": 0.0,  # REPLACE
-    "rear_fender_damage": 0.5,
-    "rear_windscreen_damage": 0.0,  # REPLACE
-    "taillight_damage": 0.0,  # REPLACE
-    "rear_bumper_damage": 0.5,
-    "backdoor_panel_damage": 0.5,
-}
+model_severity = None
+if LOAD_MODELS:
+    model_severity = rt.InferenceSession(
+        str(Path("models", sev_model_name)), providers=providers
+    )
+
+# The severity crops are scored in chunks of at most SEVERITY_BATCH_SIZE images
+# (or the fixed batch dimension of the ONNX model if it has one: the last chunk is then padded)
+SEVERITY_BATCH_SIZE = int(os.environ.get("SEVERITY_BATCH_SIZE") or 32)
+SEVERITY_FIXED_BATCH = False
+_sev_batch_dim = get_fixed_batch_size(model_severity) if model_severity is not None else None
+if _sev_batch_dim is not None:
+    if os.environ.get("SEVERITY_BATCH_SIZE") and SEVERITY_BATCH_SIZE != _sev_batch_dim:
+        print(
+            f"#### SEVERITY_BATCH_SIZE WARNING #### {sev_model_name} has a fixed batch size of {_sev_batch_dim}, "
+            f"SEVERITY_BATCH_SIZE={SEVERITY_BATCH_SIZE} is ignored"
+        )
+    SEVERITY_BATCH_SIZE = _sev_batch_dim
+    SEVERITY_FIXED_BATCH = True
+
+# The severity crops are cropped from the ROI tier of the uploaded file, decoded once per image and shared with
+# the plate crops (instead of being cropped from the 640x640 detector input), see image_io.ROI_MIN_SIDE
+ROI_DECODE = (os.environ.get("ROI_DECODE") or "1") != "0"
 
 # --- DEFINE FUNCTIONS
 
@@ -81,6 +111,121 @@ def get_action(severity: float, class_name: str) -> str:
         return "REPAIR"
 
 
+def resize_severity_input(crop: np.array) -> np.array:
+    """
+    Resizes the crop of a damage to the severity model input size.
+
+    Parameters
+    ----------
+    crop: np.array
+        the array of the damage region
+
+    Returns
+    -------
+    np.array:
+        The float32 crop resized to SEVERITY_INPUT_SIZE (HWC).
+    """
+
+    # Only the ROI is converted to float32 (not the whole image)
+    img_precise = np.asarray(crop, dtype=np.float32)
+    return cv2.resize(img_precise, dsize=SEVERITY_INPUT_SIZE, interpolation=cv2.INTER_CUBIC)
+
+
+def crop_severity_input(image: np.array, coords: np.array) -> np.array:
+    """
+    Extracts the region of a damage and resizes it to the severity model input size.
+
+    Parameters
+    ----------
+    image: np.array
+        the array of the preprocessed image
+    coords: np.array / torch.Tensor
+        the coordinates of the damage detected on the preprocessed image by the car_damage_detect model,
+        the coordinates should be in the format (x1, y1, x2, y2).
+
+    Returns
+    -------
+    np.array:
+        The float32 crop resized to SEVERITY_INPUT_SIZE (HWC).
+    """
+
+    # Extract damage coordinates
+    x1, y1, x2, y2 = int(coords[0]), int(coords[1]), int(coords[2]), int(coords[3])
+
+    return resize_severity_input(image[y1:y2, x1:x2])
+
+
+def get_severity_inputs(f, image: np.array, boxes: list) -> list:
+    """
+    Returns the severity model inputs of the damages detected on an image.
+    When ROI_DECODE is enabled, the damages are cropped from the ROI tier of the uploaded file
+    (see image_io.crop_rois), otherwise they are cropped from the preprocessed image.
+
+    Parameters
+    ----------
+    f: file object
+        the uploaded file of the image
+    image: np.array
+        the array of the preprocessed image
+    boxes: list
+        a list of (coords, coords_ratio) tuples: the coordinates of each damage on the preprocessed
+        image and on the original image.
+
+    Returns
+    -------
+    list:
+        The float32 crops resized to SEVERITY_INPUT_SIZE (HWC), in the same order as the boxes.
+    """
+
+    with metrics.timer("severity_crops"):
+        if ROI_DECODE:
+            rois = crop_rois(f, [b[1] for b in boxes])
+            if rois is not None:
+                return [resize_severity_input(roi) for roi in rois]
+
+        return [crop_severity_input(image, b[0]) for b in boxes]
+
+
+def get_severities(crops: list) -> list:
+    """
+    Returns the estimated severities for a batch of damage crops, using as few
+    ONNX runs as possible (one per SEVERITY_BATCH_SIZE chunk).
+
+    Parameters
+    ----------
+    crops: list
+        A list of crops as returned by crop_severity_input.
+
+    Returns
+    -------
+    list:
+        A list of severities (between 0 and 1), in the same order as the crops.
+    """
+
+    if len(crops) == 0:
+        return []
+
+    # Stack all the crops in a single contiguous NHWC tensor
+    batch = np.empty((len(crops), *crops[0].shape), dtype=np.float32)
+    for j, crop in enumerate(crops):
+        batch[j] = crop
+
+    severities = []
+    with metrics.timer("severity", sev_model_name):
+        for start in range(0, len(batch), SEVERITY_BATCH_SIZE):
+            chunk = batch[start:start + SEVERITY_BATCH_SIZE]
+            count = len(chunk)
+            if SEVERITY_FIXED_BATCH:
+                # (zero crops fill the fixed batch, their severities are dropped)
+                chunk = pad_severity_batch(chunk, SEVERITY_BATCH_SIZE)
+            output = model_severity.run(
+                [model_severity_output_name], {model_severity_input_name: chunk}
+            )[0]
+            severities.extend(output[:count, 0])
+
+    return severities
+
+
 def get_severity(image: np.array, coords: np.array, class_name: str) -> float:
     """
     Returns the estimated severity for a given damage detected by the car_damage_detect model.
@@ -102,21 +247,7 @@ def get_severity(image: np.array, coords: np.array, class_name: str) -> float:
         The value should be between 0 and 1.
     """
 
-    input_size = (224, 224)
-
-    # Extract plate coordinates
-    x1, y1, x2, y2 = int(coords[0]), int(coords[1]), int(coords[2]), int(coords[3])
-
-    # Preprocess plate image (crop / gray / ...)
-    nimg = np.array(image, dtype=np.float32)
-    img_precise = nimg[y1:y2, x1:x2]
-    img = cv2.resize(img_precise, dsize=(input_size), interpolation=cv2.INTER_CUBIC)
-    # cv2.imwrite("severity.png", img)
-
-    # -- Predict with ONNX
-    return model_severity.run(
-        [model_severity_output_name], {model_severity_input_name: [img]}
-    )[0][0][0]
+    return get_severities([crop_severity_input(image, coords)])[0]
 
 
 def get_price(part: str, action: str, customer_car_info: dict) -> int:
@@ -147,16 +278,47 @@ def get_price(part: str, action: str, customer_car_info: dict) -> int:
     return db_price
 
 
+def get_prices(parts_actions: list, customer_car_info: dict) -> list:
+    """
+    Returns the prices of all the damages of a request at once.
+
+    Parameters
+    ----------
+    parts_actions: list
+        a list of (part, action) tuples, where part is the name of the detected damage
+        and action the name of the recommanded action (REPAIR / REPLACE)
+    customer_car_info: dict
+        a dictionnary containng the 'trade', 'model', 'year' send along with the POST request
+
+    Returns
+    -------
+    list:
+        The estimated prices, in the same order as parts_actions
+    """
+
+    trade = customer_car_info['trade']
+    model = customer_car_info['model']
+    year = customer_car_info['year']
+
+    with metrics.timer("price"):
+        return get_db_prices(trade, model, year, parts_actions)
+
+
 class RestrictDamagesPerClass:
     """
     A class that restricts the number of damages per class, selecting 
     the highest scored damages to be added to the final result.
 
+    Each instance only holds the damages of one request (the class attribute dmg_dict is never modified),
+    so concurrent requests of the same worker don't share any state and don't need any lock.
+
     Attributes
     ----------
     dmg_dict : dict
         A dictionary containing the name of each damage class and the maximum number of damages
-        that can be selected from that class.
+        that can be selected from that class (read-only).
+    data : dict
+        The (data, score) tuples added to each damage class (per instance).
 
     Methods
     -------
@@ -187,8 +349,7 @@ class RestrictDamagesPerClass:
     }
 
     def __init__(self):
-        for dmg_class in self.dmg_dict:
-            self.dmg_dict[dmg_class]["data"] = []
+        self.data = {dmg_class: [] for dmg_class in self.dmg_dict}
 
     def add_damage(self, dmg_class, data, score):
         """
@@ -205,7 +366,7 @@ class RestrictDamagesPerClass:
             to return the top entry according to the dmg_dict limitation.
         """
 
-        self.dmg_dict[dmg_class]["data"].append((data, score))
+        self.data[dmg_class].append((data, score))
 
     def get_selected(self):
         """
@@ -218,35 +379,262 @@ class RestrictDamagesPerClass:
             according to the dmg_dict limitations.
         """
 
-        out_dict = self.dmg_dict.copy()
+        jsons = []
 
-        # --- SORT & TRIM
-        for k in out_dict:
-            out_dict[k] = sorted(out_dict[k]["data"], key=lambda x: x[1], reverse=True)
+        for dmg_class, limits in self.dmg_dict.items():
+            damages = self.data[dmg_class]
 
-            # --- REMOVE EXTA DAMAGES
-            # out_dict[k] = out_dict[k][: self.dmg_dict[k]["max"]] # cut to MAX
+            # --- SORT (in place, stable for equal scores)
+            damages.sort(key=lambda x: x[1], reverse=True)
 
-            # --- ADD DUPLICATED TAGS
-            if len(out_dict[k]) > 0:
-                for j in range(self.dmg_dict[k]["max"], len(out_dict[k])):
-                    out_dict[k][j][0]["probable_duplicate"] = True
+            # --- ADD DUPLICATED TAGS (the damages after the top 'max' ones)
+            for j, (data, _) in enumerate(damages):
+                data["probable_duplicate"] = j >= limits["max"]
+                jsons.append(data)
 
-        # --- FLATTEN THE TUPLES
-        flatten = []
-        [flatten.extend(x) for x in out_dict.values()]
+        return jsons
 
-        # --- KEEP ONLY JSON DATA
-        jsons = [x[0] for x in flatten]
 
-        return jsons
+# --- MAIN FUNCTIONS
+
+
+def detect_damages(results: list, files: list, preprocessed_files: list, original_ratios: list) -> list:
+    """
+    Computes the severity of every damage detected by the car_damage_detect model
+    (these raw detections don't depend on the customer car, so they can be cached).
+
+    Parameters
+    ----------
+    results: list
+        The car_damage_detect results (one per image).
+    files: list
+        The uploaded files (one per image), to decode the damages.
+    preprocessed_files: list
+        The preprocessed images the results were predicted from.
+    original_ratios: list
+        The original ratios of the images so that we can return damages
+        coordinates that match the original file shape.
 
+    Returns
+    -------
+    list
+        One list per image of raw detections (JSON serializable dictionaries):
+            - type: (str) The type of damage.
+            - coords: (list) The coordinates of the damage in (top, left, bottom, right) format.
+            - severity_model: (str) The name of the severity model used for prediction.
+            - severity: (str) The severity level of the damage.
+            - score: (float) The severity level of the damage.
+    """
+
+    # --- GATHER ALL THE BOXES (AND THE CROPS TO SCORE) OF THE BATCH
+
+    detections = []
+    image_boxes = []
+    crop_count = 0
 
-# --- MAIN FUNCTION
+    for i, r in enumerate(results):
+
+        boxes = r.boxes
+        severity_boxes = []
+
+        for box in boxes:
+
+            # get box coordinates in (top, left, bottom, right) format
+            coords = box.xyxy[0]
+
+            coords_ratio = coords.tolist()
+            coords_ratio[0] *= original_ratios[i][1]
+            coords_ratio[1] *= original_ratios[i][0]
+            coords_ratio[2] *= original_ratios[i][1]
+            coords_ratio[3] *= original_ratios[i][0]
+
+            classindex = box.cls
+            class_name = model_cdd.names[int(classindex)]
+
+            if DEFAULT_THRESHOLDS[class_name] == 0.0:
+                crop_index = None
+            else:
+                crop_index = crop_count
+                crop_count += 1
+                severity_boxes.append((coords, coords_ratio))
+
+            detections.append((i, class_name, coords_ratio, crop_index))
+
+        if len(severity_boxes) > 0:
+            image_boxes.append((i, severity_boxes))
+        else:
+            release_roi_image(files[i])
+
+    # --- CROP THE DAMAGES (THE ROI TIER OF THE NEXT IMAGE IS DECODED WHILE THE CURRENT ONE IS CROPPED)
+
+    crops = []
+    for k, (i, severity_boxes) in enumerate(image_boxes):
+        if ROI_DECODE and k + 1 < len(image_boxes):
+            prefetch_roi_image(files[image_boxes[k + 1][0]])
+        crops.extend(get_severity_inputs(files[i], preprocessed_files[i], severity_boxes))
+        release_roi_image(files[i])
+
+    # --- SCORE ALL THE CROPS AT ONCE
+
+    severities = get_severities(crops)
+
+    # --- BUILD THE RAW DETECTIONS
+
+    raw_damages = [[] for _ in results]
+
+    for i, class_name, coords_ratio, crop_index in detections:
+
+        if crop_index is None:
+            model_name = None
+            severity = 1.0
+        else:
+            model_name = sev_model_name
+            severity = severities[crop_index]
+
+        raw_damages[i].append({
+            "type": class_name,
+            "coords": coords_ratio,
+            "severity_model": model_name,
+            "severity": str(severity),
+            "score": float(severity),
+        })
+
+    return raw_damages
+
+
+def get_raw_damages(files: list, preprocessed_files: list, original_ratios: list) -> list:
+    """
+    Returns the raw detections of each image (see detect_damages), from the result cache
+    when the same file was already predicted with the same models.
+
+    Parameters
+    ----------
+    files: list
+        The uploaded files (one per image).
+    preprocessed_files: list
+        The preprocessed images.
+    original_ratios: list
+        The original ratios of the images.
+
+    Returns
+    -------
+    list
+        One list of raw detections per image.
+    """
+
+    keys = [make_key(f, cdd_model_name, sev_model_name, ROI_DECODE) for f in files]
+    raw_damages = [damage_cache.get(key) for key in keys]
+
+    # --- PREDICT THE IMAGES MISSING FROM THE CACHE
+    # (the near-identical images of the request get the predictions of their representative, see dedup)
+
+    missing = [
+        i for i, raw in enumerate(raw_damages) if raw is None and get_representative(files[i], files) is None
+    ]
+    if len(missing) > 0:
+        missing_files = [files[i] for i in missing]
+        missing_images = [preprocessed_files[i] for i in missing]
+        missing_ratios = [original_ratios[i] for i in missing]
+
+        pool = inference_workers.get_pool("damages")
+        if pool is not None:
+            with metrics.timer("inference_worker", cdd_model_name):
+                predicted = pool.predict(missing_images, missing_files, missing_ratios, pass_uploads=ROI_DECODE)
+        else:
+            with metrics.timer("detect_damages", cdd_model_name):
+                results = cdd_scheduler.submit(missing_images)
+
+            predicted = detect_damages(results, missing_files, missing_images, missing_ratios)
+
+        metrics.count_boxes(sum(len(raw) for raw in predicted), cdd_model_name)
+
+        for i, raw in zip(missing, predicted):
+            damage_cache.put(keys[i], raw)
+            raw_damages[i] = raw
+
+    fan_out(raw_damages, files, original_ratios)
+
+    return raw_damages
+
+
+def predict_raw_damages(images: list, files: list, original_ratios: list) -> list:
+    """
+    Returns the raw detections of a list of images (see detect_damages), without any cache:
+    the entry point of the inference worker processes (see inference_workers).
+    """
+
+    return detect_damages(model_cdd.predict(images, agnostic_nms=True), files, images, original_ratios)
+
+
+def warmup():
+    """ Runs the damage & severity models once on synthetic inputs (see lifecycle.warmup). """
+
+    image = np.random.default_rng(0).integers(0, 256, (640, 640, 3), dtype=np.uint8)
+
+    cdd_scheduler.submit([image])
+    get_severities([np.zeros((*SEVERITY_INPUT_SIZE, 3), dtype=np.float32)])
+
+
+def score_damages(raw_damages: list, files: list, customer_car_info: dict, file_indices: dict = None) -> list:
+    """
+    Computes the action and price of every damage.
+
+    Parameters
+    ----------
+    raw_damages: list
+        One list of raw detections per image (see detect_damages).
+    files: list
+        The uploaded files (one per image), to return their names.
+    customer_car_info: dict
+        A dictionary containing information about the customer's car (trade, model, year).
+    file_indices: dict
+        If given, filled with the index of the image of each prediction ({id(pred_dict): index}).
+
+    Returns
+    -------
+    list
+        A list of (class_name, pred_dict, severity) tuples, in the order of the images.
+    """
+
+    # --- GET THE ACTIONS & ALL THE PRICES AT ONCE
+
+    detections = []
+    parts_actions = []
+    for i, raw_list in enumerate(raw_damages):
+        for raw in raw_list:
+            detections.append((i, raw))
+            parts_actions.append((raw["type"], get_action(raw["score"], raw["type"])))
+
+    prices = get_prices(parts_actions, customer_car_info)
+
+    # --- BUILD THE PREDICTIONS
+
+    scored = []
+
+    for j, (i, raw) in enumerate(detections):
+
+        pred_dict = {
+            "severity_model": raw["severity_model"],
+            "type": raw["type"],
+            "coords": list(raw["coords"]),
+            "severity": raw["severity"],
+            "price": prices[j],
+            "action": parts_actions[j][1],
+            "file": files[i].filename,
+            "probable_duplicate": False,
+        }
+
+        if file_indices is not None:
+            file_indices[id(pred_dict)] = i
+
+        scored.append((raw["type"], pred_dict, raw["score"]))
+
+    return scored
 
 
 def predict_damages(
-        filtered_files: list, preprocessed_files: list, original_ratios: list, customer_car_info: dict
+        filtered_files: list, preprocessed_files: list, original_ratios: list, customer_car_info: dict,
+        file_indices: list = None
 ) -> list:
     """
     Predicts damages and their severity levels for given preprocessed files.
@@ -263,6 +651,9 @@ def predict_damages(
     customer_car_info: dict
         A dictionary containing information about the customer's car (trade, model, year)
         so that we can fetch a more precise estimated price.
+    file_indices: list
+        If given, the index of the file of each returned damage is appended to it
+        (the file names of a request are not always unique).
 
     Returns
     -------
@@ -279,47 +670,75 @@ def predict_damages(
             already reached the limit in the BATCH of images (they are ordered by severity score)
     """
 
-    results = model_cdd.predict(preprocessed_files, agnostic_nms=True)
+    raw_damages = get_raw_damages(filtered_files, preprocessed_files, original_ratios)
     predictions = RestrictDamagesPerClass()
 
-    for i, r in enumerate(results):
+    indices = {}
+    scored = score_damages(raw_damages, filtered_files, customer_car_info, indices)
 
-        boxes = r.boxes
+    for class_name, pred_dict, severity in scored:
+        predictions.add_damage(class_name, pred_dict, severity)
 
-        for box in boxes:
+    selected = predictions.get_selected()
+    if file_indices is not None:
+        file_indices.extend(indices[id(pred_dict)] for pred_dict in selected)
 
-            # get box coordinates in (top, left, bottom, right) format
-            coords = box.xyxy[0]
+    return selected
 
-            coords_ratio = coords.tolist()
-            coords_ratio[0] *= original_ratios[i][1]
-            coords_ratio[1] *= original_ratios[i][0]
-            coords_ratio[2] *= original_ratios[i][1]
-            coords_ratio[3] *= original_ratios[i][0]
 
-            classindex = box.cls
-            class_name = model_cdd.names[int(classindex)]
+def iter_predict_damages(filtered_files: list, prepared_images, customer_car_info: dict):
+    """
+    Predicts damages image by image, so that the results can be sent as soon as each image is done.
 
-            if DEFAULT_THRESHOLDS[class_name] == 0.0:
-                model_name = None
-                severity = 1.0
-            else:
-                model_name = sev_model_name
-                severity = get_severity(preprocessed_files[i], coords, class_name)
-
-            action = get_action(severity, class_name)
-
-            pred_dict = {
-                "severity_model": model_name,
-                "type": class_name,
-                "coords": coords_ratio,
-                "severity": str(severity),
-                "price": get_price(class_name, action, customer_car_info),
-                "action": action,
-                "file": filtered_files[i].filename,
-                "probable_duplicate": False,
-            }
+    Parameters
+    ----------
+    filtered_files: list
+        A list of the filtered files so that we can return the name of the original files.
+    prepared_images: iterable
+        An iterable (possibly lazy) of (preprocessed_file, original_ratio) tuples, one per filtered file.
+    customer_car_info: dict
+        A dictionary containing information about the customer's car (trade, model, year).
+
+    Yields
+    ------
+    dict
+        One {"type": "image", "file_index", "file", "damages"} record per image (same damages format as
+        predict_damages, with probable_duplicate always False), then a final
+        {"type": "summary", "damage_model", "duplicates"} record listing the {"file_index", "file", "index"}
+        of the damages flagged as probable duplicates across the whole batch (file_index is the index of
+        the upload, as several uploads can have the same name).
+    """
 
+    predictions = RestrictDamagesPerClass()
+    positions = {}
+    deduplicator = StreamDeduplicator()
+    streamed = []  # (raw damages, original ratio) of the images already sent
+
+    for i, (f, (preprocessed_file, original_ratio)) in enumerate(zip(filtered_files, prepared_images)):
+
+        # (a near-identical image gets the damages of its representative, as in predict_damages, see dedup)
+        j = deduplicator.add(preprocessed_file) if DEDUP else i
+        if j == i:
+            raw_damages = get_raw_damages([f], [preprocessed_file], [original_ratio])
+        else:
+            metrics.count_duplicates(1)
+            raw_damages = [copy_raws(streamed[j][0], streamed[j][1], original_ratio)]
+        streamed.append((raw_damages[0], original_ratio))
+
+        scored = score_damages(raw_damages, [f], customer_car_info)
+
+        damages = []
+        for class_name, pred_dict, severity in scored:
+            positions[id(pred_dict)] = (i, f.filename, len(damages))
+            damages.append(dict(pred_dict))
             predictions.add_damage(class_name, pred_dict, severity)
 
-    return predictions.get_selected()
+        yield {"type": "image", "file_index": i, "file": f.filename, "damages": damages}
+
+    duplicates = []
+    for pred_dict in predictions.get_selected():
+        if pred_dict["probable_duplicate"]:
+            file_index, filename, index = positions[id(pred_dict)]
+            duplicates.append({"file_index": file_index, "file": filename, "index": index})
+
+    yield {"type": "summary", "damage_model": cdd_model_name, "duplicates": duplicates}
@@ -1,22 +1,69 @@
-from pathlib import Path
+import os
+import threading
+from contextlib import nullcontext
+
 import numpy as np
 
 import cv2
-from ultralytics import YOLO
 import easyocr
 
+from api_internals.image_io import crop_rois, prefetch_roi_image, release_roi_image
+from api_internals.result_cache import make_cache, make_key
+from api_internals.onnx_detector import load_detector, detector_name
+from api_internals import inference_workers
+from api_internals import metrics
+from api_internals.dedup import DEDUP, StreamDeduplicator, get_representative, fan_out, copy_raws
+
 # --- INIT PLATE MODEL
 
-lpd_model_name = "license_plate_detect_model.pt"
-model_lpd = YOLO(Path("models", lpd_model_name))
+# (DETECTOR_BACKEND=onnx runs the exported license_plate_detect_model.onnx with ONNX Runtime)
+# (with PLATE_WORKERS > 0, the models are only loaded by the inference worker processes)
+LOAD_MODELS = inference_workers.loads_models("plates")
+
+if LOAD_MODELS:
+    model_lpd, lpd_model_name = load_detector("license_plate_detect_model.pt")
+else:
+    model_lpd, lpd_model_name = None, detector_name("license_plate_detect_model.pt")
+
+# The ultralytics predictor keeps per-call state on the model, so the threads of a worker
+# take turns (the ONNX Runtime sessions can be run concurrently)
+lpd_lock = nullcontext() if lpd_model_name.endswith(".onnx") else threading.Lock()
+
+# --- INIT RESULT CACHE (raw plates per image content)
+
+plate_cache = make_cache("plates")
 
 # --- INIT EASY OCR MODEL
 
-reader = easyocr.Reader(["en"])
+reader = easyocr.Reader(["en"]) if LOAD_MODELS else None
+
+# The plates are cropped from the ROI tier of the uploaded file, decoded once per image and shared with
+# the severity crops (instead of being cropped from the 640x640 detector input), see image_io.ROI_MIN_SIDE
+ROI_DECODE = (os.environ.get("ROI_DECODE") or "1") != "0"
+
+# Number of text lines per batch of the EasyOCR recognizer (on CPU, EasyOCR reads them one by one anyway)
+OCR_BATCH_SIZE = int(os.environ.get("OCR_BATCH_SIZE") or 16)
+
+# OCR_MODE=lines: the plates are split into text lines (state, number, slogan of the Nigerian plates)
+# read with a single call of the recognizer, OCR_MODE=readtext: each plate is read by reader.readtext
+# (CRAFT text detector + recognizer, slower)
+OCR_MODE = os.environ.get("OCR_MODE") or "lines"
+
+# A row of a plate belongs to a text line if at least LINE_MIN_INK of its pixels are ink,
+# and the lines thinner than LINE_MIN_HEIGHT of the plate height (borders, screws) are dropped
+LINE_MIN_INK = 0.05
+LINE_MIN_HEIGHT = 0.08
 
 # --- FUNCTIONS
 
 
+def detect_plates(images: list) -> list:
+    """ Runs the license_plate_detect model on a list of preprocessed images (thread-safe). """
+
+    with lpd_lock:
+        return model_lpd.predict(images, agnostic_nms=True)
+
+
 def get_text(image: np.array, coords: np.array) -> (str, list):
     """
     Try to obtain the license plate number from the license plate image.
@@ -36,21 +83,53 @@ def get_text(image: np.array, coords: np.array) -> (str, list):
         The list of invalid texts
     """
 
-    # Extract plate coordinates
+    return read_text(crop_plate(image, coords))
+
+
+def crop_plate(image: np.array, coords: np.array) -> np.array:
+    """ Returns the region of a license plate (a view of the image, no copy). """
+
     x1, y1, x2, y2 = int(coords[0]), int(coords[1]), int(coords[2]), int(coords[3])
+    return image[max(y1, 0):y2, max(x1, 0):x2]
 
-    # Preprocess plate image (crop / gray / ...)
-    nimg = np.array(image)
-    img = cv2.cvtColor(nimg, cv2.COLOR_RGB2BGR)
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    img_precise = img[y1:y2, x1:x2]
-    gray = cv2.cvtColor(img_precise, cv2.COLOR_RGB2GRAY)
-    # cv2.imwrite("plate.png", gray)
 
-    # Try to read text from image
-    result = reader.readtext(gray)
+def read_text(img_precise: np.array) -> (str, list):
+    """
+    Try to obtain the license plate number from the crop of a license plate.
+
+    Parameters
+    ----------
+    img_precise: np.array
+        the array of the license plate region
+
+    Returns
+    -------
+    str:
+        The estimated plate number
+    list:
+        The list of invalid texts
+    """
+
+    return read_texts([img_precise])[0]
+
+
+def parse_text(result: list) -> (str, list):
+    """
+    Parses the EasyOCR results of a license plate.
+
+    Parameters
+    ----------
+    result: list
+        the (box, text, confidence) tuples read on the plate
+
+    Returns
+    -------
+    str:
+        The estimated plate number
+    list:
+        The list of invalid texts
+    """
 
-    # Parse results
     text = "NO NIGERIAN PLATE"
     invalid_text = []
     for res in result:
@@ -62,11 +141,309 @@ def get_text(image: np.array, coords: np.array) -> (str, list):
     return text, invalid_text
 
 
-# --- MAIN FUNCTION
+def split_lines(gray: np.array) -> list:
+    """
+    Splits a grayscale plate into its text lines with a horizontal projection profile
+    (the number of ink pixels of each row, the ink being the minority class of an Otsu threshold).
+
+    Parameters
+    ----------
+    gray: np.array
+        the grayscale array of the license plate region
+
+    Returns
+    -------
+    list:
+        The (y_min, y_max) rows of the text lines, from top to bottom
+        (the whole plate if no line is found).
+    """
+
+    h = gray.shape[0]
+    _, binary = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    if binary.mean() > 0.5:  # dark text on a light plate
+        binary = 1 - binary
+
+    rows = binary.mean(axis=1) >= LINE_MIN_INK
+    min_height = max(3, int(h * LINE_MIN_HEIGHT))
+    pad = max(1, h // 50)
+
+    lines = []
+    start = None
+    for y, ink in enumerate(np.append(rows, False)):
+        if ink and start is None:
+            start = y
+        elif not ink and start is not None:
+            if y - start >= min_height:
+                lines.append((max(start - pad, 0), min(y + pad, h)))
+            start = None
+
+    return lines if len(lines) > 0 else [(0, h)]
+
+
+def read_texts(crops: list) -> list:
+    """
+    Reads the license plates of a whole batch with a single call of the EasyOCR recognizer.
+
+    The plates are already localized by the license_plate_detect model, so the CRAFT text detector
+    of reader.readtext is skipped: each plate is split into its text lines (see split_lines),
+    the grayscale crops are stacked on one canvas, and each line is given to the recognizer
+    as one text box (batched by OCR_BATCH_SIZE on GPU).
+    With OCR_MODE=readtext, each plate is read by reader.readtext instead.
+
+    Parameters
+    ----------
+    crops: list
+        the BGR arrays of the license plate regions
+
+    Returns
+    -------
+    list:
+        A list of (text, invalid_texts) tuples, in the same order as the crops.
+    """
+
+    results = [[] for _ in crops]
+
+    # --- READ EACH PLATE WITH THE TEXT DETECTOR (IF REQUESTED)
+
+    indices = [k for k, crop in enumerate(crops) if crop.shape[0] > 0 and crop.shape[1] > 0]
+    if OCR_MODE == "readtext":
+        for k in indices:
+            crop = crops[k]
+            results[k] = reader.readtext(crop if crop.ndim == 2 else cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY))
+        return [parse_text(result) for result in results]
+
+    # --- STACK THE GRAYSCALE CROPS (the empty ones are not read)
+
+    if len(indices) == 0:
+        return [parse_text(result) for result in results]
+
+    height = sum(crops[k].shape[0] for k in indices)
+    width = max(crops[k].shape[1] for k in indices)
+    canvas = np.zeros((height, width), dtype=np.uint8)
+
+    boxes = []
+    offsets = {}
+    y = 0
+    for k in indices:
+        crop = crops[k]
+        h, w = crop.shape[:2]
+        canvas[y:y + h, :w] = crop if crop.ndim == 2 else cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+        for y_min, y_max in split_lines(canvas[y:y + h, :w]):
+            boxes.append([0, w, y + y_min, y + y_max])  # (x_min, x_max, y_min, y_max)
+            offsets[y + y_min] = k
+        y += h
+
+    # --- RECOGNIZE ALL THE PLATES AT ONCE
+
+    for box, text, confidence in reader.recognize(
+        canvas, horizontal_list=boxes, free_list=[], batch_size=OCR_BATCH_SIZE
+    ):
+        results[offsets[int(box[0][1])]].append((box, text, confidence))
+
+    return [parse_text(result) for result in results]
+
+
+def get_plate_crops(f, image: np.array, boxes: list) -> list:
+    """
+    Returns the crops of the license plates detected on an image.
+    When ROI_DECODE is enabled, the plates are cropped from the ROI tier of the uploaded file
+    (at a higher resolution, see image_io.crop_rois), otherwise they are cropped from the preprocessed image.
+
+    Parameters
+    ----------
+    f: file object
+        the uploaded file of the image
+    image: np.array
+        the array of the preprocessed image
+    boxes: list
+        a list of (coords, coords_ratio) tuples: the coordinates of each plate on the preprocessed
+        image and on the original image.
+
+    Returns
+    -------
+    list:
+        The BGR arrays of the plates, in the same order as the boxes.
+    """
+
+    if ROI_DECODE:
+        rois = crop_rois(f, [b[1] for b in boxes])
+        if rois is not None:
+            return rois
+
+    return [crop_plate(image, b[0]) for b in boxes]
+
+
+# --- MAIN FUNCTIONS
+
+
+def read_plates(results: list, files: list, preprocessed_files: list, original_ratios: list) -> list:
+    """
+    Reads the text of every license plate detected by the license_plate_detect model.
+
+    Parameters
+    ----------
+    results: list
+        The license_plate_detect results (one per image).
+    files: list
+        The uploaded files (one per image), to decode the plates.
+    preprocessed_files: list
+        The preprocessed images the results were predicted from.
+    original_ratios: list
+        The original ratios of the images so that we can return plates
+        coordinates that match the original file shape.
+
+    Returns
+    -------
+    list
+        One list per image of raw plates (JSON serializable dictionaries with
+        the 'text', 'invalid' and 'coords' of the plates, see predict_plates).
+    """
+
+    # --- GATHER ALL THE PLATES (AND THEIR CROPS) OF THE BATCH
+
+    detections = []
+    image_boxes = []
+
+    for i, r in enumerate(results):
+
+        boxes = r.boxes
+        plate_boxes = []
+
+        for box in boxes:
+
+            # get box coordinates in (top, left, bottom, right) format
+            coords = box.xyxy[0]
+
+            coords_ratio = coords.tolist()
+            coords_ratio[0] *= original_ratios[i][1]
+            coords_ratio[1] *= original_ratios[i][0]
+            coords_ratio[2] *= original_ratios[i][1]
+            coords_ratio[3] *= original_ratios[i][0]
+
+            plate_boxes.append((coords, coords_ratio))
+            detections.append((i, coords_ratio))
+
+        if len(plate_boxes) > 0:
+            image_boxes.append((i, plate_boxes))
+        else:
+            release_roi_image(files[i])
+
+    # --- CROP THE PLATES (THE ROI TIER OF THE NEXT IMAGE IS DECODED WHILE THE CURRENT ONE IS CROPPED)
+
+    crops = []
+    with metrics.timer("plate_crops"):
+        for k, (i, plate_boxes) in enumerate(image_boxes):
+            if ROI_DECODE and k + 1 < len(image_boxes):
+                prefetch_roi_image(files[image_boxes[k + 1][0]])
+            crops.extend(get_plate_crops(files[i], preprocessed_files[i], plate_boxes))
+            release_roi_image(files[i])
+
+    # --- READ ALL THE PLATES AT ONCE
+
+    with metrics.timer("ocr", "easyocr"):
+        texts = read_texts(crops)
+
+    raw_plates = [[] for _ in results]
+
+    for (i, coords_ratio), (text, invalid_texts) in zip(detections, texts):
+        raw_plates[i].append({
+            "text": text,
+            "invalid": invalid_texts,
+            "coords": coords_ratio,
+        })
+
+    return raw_plates
+
+
+def get_raw_plates(files: list, preprocessed_files: list, original_ratios: list) -> list:
+    """
+    Returns the raw plates of each image (see read_plates), from the result cache
+    when the same file was already predicted with the same model.
+
+    Parameters
+    ----------
+    files: list
+        The uploaded files (one per image).
+    preprocessed_files: list
+        The preprocessed images.
+    original_ratios: list
+        The original ratios of the images.
+
+    Returns
+    -------
+    list
+        One list of raw plates per image.
+    """
+
+    keys = [make_key(f, lpd_model_name, f"easyocr-{OCR_MODE}", ROI_DECODE) for f in files]
+    raw_plates = [plate_cache.get(key) for key in keys]
+
+    # --- PREDICT THE IMAGES MISSING FROM THE CACHE
+    # (the near-identical images of the request get the predictions of their representative, see dedup)
+
+    missing = [
+        i for i, raw in enumerate(raw_plates) if raw is None and get_representative(files[i], files) is None
+    ]
+    if len(missing) > 0:
+        missing_files = [files[i] for i in missing]
+        missing_images = [preprocessed_files[i] for i in missing]
+        missing_ratios = [original_ratios[i] for i in missing]
+
+        pool = inference_workers.get_pool("plates")
+        if pool is not None:
+            with metrics.timer("inference_worker", lpd_model_name):
+                predicted = pool.predict(missing_images, missing_files, missing_ratios, pass_uploads=ROI_DECODE)
+        else:
+            with metrics.timer("detect_plates", lpd_model_name):
+                results = detect_plates(missing_images)
+
+            predicted = read_plates(results, missing_files, missing_images, missing_ratios)
+
+        metrics.count_boxes(sum(len(raw) for raw in predicted), lpd_model_name)
+
+        for i, raw in zip(missing, predicted):
+            plate_cache.put(keys[i], raw)
+            raw_plates[i] = raw
+
+    fan_out(raw_plates, files, original_ratios)
+
+    return raw_plates
+
+
+def predict_raw_plates(images: list, files: list, original_ratios: list) -> list:
+    """
+    Returns the raw plates of a list of images (see read_plates), without any cache:
+    the entry point of the inference worker processes (see inference_workers).
+    """
+
+    return read_plates(detect_plates(images), files, images, original_ratios)
+
+
+def warmup():
+    """ Runs the plate & OCR models once on a synthetic image (see lifecycle.warmup). """
+
+    image = np.random.default_rng(0).integers(0, 256, (640, 640, 3), dtype=np.uint8)
+
+    detect_plates([image])
+    read_texts([image[:64, :256]])
+
+
+def format_plates(raw_plates: list, f) -> list:
+    """ Returns the plates of an image in the predict_plates format. """
+
+    return [
+        {
+            "text": raw["text"],
+            "invalid": list(raw["invalid"]),
+            "coords": list(raw["coords"]),
+            "file": f.filename,
+        }
+        for raw in raw_plates
+    ]
 
 
 def predict_plates(
-    filtered_files: list, preprocessed_files: list, original_ratios: list
+    filtered_files: list, preprocessed_files: list, original_ratios: list, file_indices: list = None
 ) -> list:
     """
     Predicts license plate numbers for given preprocessed files.
@@ -80,6 +457,9 @@ def predict_plates(
     original_ratios: list
         A list of original ratios of the filtered files so that we can return damages
         coordinates that match the original file shape.
+    file_indices: list
+        If given, the index of the file of each returned plate is appended to it
+        (the file names of a request are not always unique).
 
     Returns
     -------
@@ -91,31 +471,50 @@ def predict_plates(
             - file: (str) The name of the file the license plate was predicted from.
     """
 
-    results = model_lpd.predict(preprocessed_files, agnostic_nms=True)
+    raw_plates = get_raw_plates(filtered_files, preprocessed_files, original_ratios)
+
     predictions = []
+    for i, (f, image_plates) in enumerate(zip(filtered_files, raw_plates)):
+        predictions.extend(format_plates(image_plates, f))
+        if file_indices is not None:
+            file_indices.extend([i] * len(image_plates))
 
-    for i, r in enumerate(results):
+    return predictions
 
-        boxes = r.boxes
-        for box in boxes:
 
-            # get box coordinates in (top, left, bottom, right) format
-            coords = box.xyxy[0]
+def iter_predict_plates(filtered_files: list, prepared_images):
+    """
+    Predicts license plate numbers image by image, so that the results can be sent
+    as soon as each image is done.
 
-            coords_ratio = coords.tolist()
-            coords_ratio[0] *= original_ratios[i][1]
-            coords_ratio[1] *= original_ratios[i][0]
-            coords_ratio[2] *= original_ratios[i][1]
-            coords_ratio[3] *= original_ratios[i][0]
+    Parameters
+    ----------
+    filtered_files: list
+        A list of the filtered files so that we can return the name of the original files.
+    prepared_images: iterable
+        An iterable (possibly lazy) of (preprocessed_file, original_ratio) tuples, one per filtered file.
 
-            text, invalid_texts = get_text(preprocessed_files[i], coords)
+    Yields
+    ------
+    dict
+        One {"type": "image", "file_index", "file", "plates"} record per image (same plates format as
+        predict_plates, file_index is the index of the upload), then a final {"type": "summary", "plate_model"} record.
+    """
 
-            pred_dict = {
-                "text": text,
-                "invalid": invalid_texts,
-                "coords": coords_ratio,
-                "file": filtered_files[i].filename,
-            }
-            predictions.append(pred_dict)
+    deduplicator = StreamDeduplicator()
+    streamed = []  # (raw plates, original ratio) of the images already sent
 
-    return predictions
+    for i, (f, (preprocessed_file, original_ratio)) in enumerate(zip(filtered_files, prepared_images)):
+
+        # (a near-identical image gets the plates of its representative, as in predict_plates, see dedup)
+        j = deduplicator.add(preprocessed_file) if DEDUP else i
+        if j == i:
+            raw_plates = get_raw_plates([f], [preprocessed_file], [original_ratio])
+        else:
+            metrics.count_duplicates(1)
+            raw_plates = [copy_raws(streamed[j][0], streamed[j][1], original_ratio)]
+        streamed.append((raw_plates[0], original_ratio))
+
+        yield {"type": "image", "file_index": i, "file": f.filename, "plates": format_plates(raw_plates[0], f)}
+
+    yield {"type": "summary", "plate_model": lpd_model_name}
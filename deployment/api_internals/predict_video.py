@@ -0,0 +1,326 @@
+import heapq
+import itertools
+import os
+import shutil
+import tempfile
+
+import cv2
+import numpy as np
+
+from api_internals.predict_damages import get_raw_damages, score_damages, RestrictDamagesPerClass
+from api_internals.predict_plates import get_raw_plates, format_plates
+from api_internals import metrics
+
+# --- DEFINE VARIABLES
+
+# A frame is sampled every VIDEO_SAMPLE_INTERVAL seconds, and kept if it differs enough from the last kept
+# frame (mean absolute difference of 32x32 grayscale thumbnails >= VIDEO_MIN_DIFFERENCE, out of 255)
+VIDEO_SAMPLE_INTERVAL = float(os.environ.get("VIDEO_SAMPLE_INTERVAL") or 0.5)
+VIDEO_MIN_DIFFERENCE = float(os.environ.get("VIDEO_MIN_DIFFERENCE") or 6.0)
+
+# At most VIDEO_MAX_FRAMES frames are predicted, by batches of VIDEO_BATCH_SIZE frames
+VIDEO_MAX_FRAMES = int(os.environ.get("VIDEO_MAX_FRAMES") or 120)
+VIDEO_BATCH_SIZE = int(os.environ.get("VIDEO_BATCH_SIZE") or 8)
+
+# Encoding quality of the kept frames (their ROI tier is decoded again for the crops, see image_io.crop_rois & prefetch_roi_image)
+VIDEO_FRAME_QUALITY = int(os.environ.get("VIDEO_FRAME_QUALITY") or 95)
+
+THUMBNAIL_SIZE = (32, 32)
+MODEL_INPUT_SIZE = 640
+
+# --- DEFINE CLASSES
+
+
+class VideoTooLargeError(ValueError):
+    """ Raised when the frames of a video have more pixels than allowed. """
+
+
+class VideoFrame:
+    """
+    A kept frame of a video, with the same attributes as the uploaded image files
+    used by the predict functions (filename & content, see image_io.read_upload).
+    The frames are not stored in the result caches (see result_cache.make_key).
+    """
+
+    cacheable = False
+
+    def __init__(self, video_name: str, time: float, frame: np.array):
+        self.filename = f"{video_name}#t={time:.2f}"
+        self.time = time
+        self.content = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, VIDEO_FRAME_QUALITY])[1].tobytes()
+
+
+class VideoDamages:
+    """
+    Merges the damages of the frames of a video per damage class: only the top scored damages of
+    each class are kept (as many as RestrictDamagesPerClass allows), so the memory doesn't depend
+    on the length of the video.
+
+    Methods
+    -------
+    add_damage(dmg_class, data, score)
+        Adds a damage detected on a frame.
+    get_selected()
+        Returns the top damages of each class, with the number of frames the class was detected on.
+    """
+
+    def __init__(self):
+        self.top = {dmg_class: [] for dmg_class in RestrictDamagesPerClass.dmg_dict}
+        self.frames = {dmg_class: set() for dmg_class in RestrictDamagesPerClass.dmg_dict}
+        self.order = itertools.count()
+
+    def add_damage(self, dmg_class, data, score):
+        limit = RestrictDamagesPerClass.dmg_dict[dmg_class]["max"]
+        entry = (score, -next(self.order), data)  # (the first frame wins on equal scores)
+
+        top = self.top[dmg_class]
+        if len(top) < limit:
+            heapq.heappush(top, entry)
+        elif entry[:2] > top[0][:2]:
+            heapq.heapreplace(top, entry)
+
+        self.frames[dmg_class].add(data["file"])
+
+    def get_selected(self):
+        selected = []
+        for dmg_class, top in self.top.items():
+            for _, _, data in sorted(top, key=lambda x: x[:2], reverse=True):
+                selected.append({**data, "frames": len(self.frames[dmg_class])})
+        return selected
+
+
+class VideoPlates:
+    """ Merges the plates read on the frames of a video per text (the first reading of each text is kept). """
+
+    def __init__(self):
+        self.plates = {}
+
+    def add_plate(self, plate):
+        if plate["text"] == "NO NIGERIAN PLATE":
+            return
+        if plate["text"] in self.plates:
+            self.plates[plate["text"]]["frames"] += 1
+        else:
+            self.plates[plate["text"]] = {**plate, "frames": 1}
+
+    def get_selected(self):
+        return list(self.plates.values())
+
+
+# --- DEFINE FUNCTIONS
+
+
+def spool_video(f, suffix: str):
+    """
+    Copies an uploaded video to a named temporary file by chunks (OpenCV reads the videos from a path).
+
+    Returns
+    -------
+    NamedTemporaryFile:
+        The temporary file (removed once closed, it outlives the request until then).
+    """
+
+    video_file = tempfile.NamedTemporaryFile(suffix=suffix)
+    f.stream.seek(0)
+    shutil.copyfileobj(f.stream, video_file, 1024 * 1024)
+    video_file.flush()
+    return video_file
+
+
+def open_video(path: str, video_name: str, max_pixels: int = None):
+    """
+    Opens a video and checks the size of its frames.
+
+    Parameters
+    ----------
+    path : str
+        The path of the video.
+    video_name : str
+        The name of the uploaded video (for the error messages).
+    max_pixels : int
+        The maximum number of pixels of the frames (None for no limit).
+
+    Returns
+    -------
+    cv2.VideoCapture:
+        The opened video (to release).
+
+    Raises
+    ------
+    ValueError
+        If the video can't be read (VideoTooLargeError if its frames have more than max_pixels pixels).
+    """
+
+    capture = cv2.VideoCapture(path)
+    try:
+        if not capture.isOpened():
+            raise ValueError(f"The video '{video_name}' can't be read.")
+
+        width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if max_pixels is not None and width * height > max_pixels:
+            raise VideoTooLargeError(f"The frames of the video '{video_name}' are too large ({width}x{height} pixels).")
+    except ValueError:
+        capture.release()
+        raise
+
+    return capture
+
+
+def check_video(path: str, video_name: str, max_pixels: int = None):
+    """ Checks that a video can be read (see open_video), before queuing its predictions. """
+
+    open_video(path, video_name, max_pixels).release()
+
+
+def get_thumbnail(frame: np.array) -> np.array:
+    """ Returns the small grayscale thumbnail comparing the frames. """
+
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+def iter_frames(capture, video_name: str, stats: dict):
+    """
+    Reads a video frame by frame (only the current frame is in memory), and yields the sampled frames
+    that differ enough from the previous kept frame.
+
+    Parameters
+    ----------
+    capture : cv2.VideoCapture
+        The opened video.
+    video_name : str
+        The name of the uploaded video.
+    stats : dict
+        Updated with the number of 'read', 'sampled' and 'kept' frames, and the 'duration' of the video.
+
+    Yields
+    ------
+    VideoFrame, np.array
+        The kept frames and their decoded image.
+    """
+
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    if not fps or fps <= 0 or fps > 1000:
+        fps = 25.0
+
+    step = max(1, int(round(VIDEO_SAMPLE_INTERVAL * fps)))
+    last_thumbnail = None
+
+    for index in itertools.count():
+        # grab() only demuxes the frames that are not sampled, retrieve() converts the sampled ones
+        if not capture.grab():
+            break
+        stats["read"] += 1
+        stats["duration"] = index / fps
+
+        if index % step != 0:
+            continue
+
+        ok, frame = capture.retrieve()
+        if not ok:
+            continue
+        stats["sampled"] += 1
+
+        thumbnail = get_thumbnail(frame)
+        if last_thumbnail is not None and np.abs(thumbnail - last_thumbnail).mean() < VIDEO_MIN_DIFFERENCE:
+            continue  # a near-duplicate of the last kept frame
+
+        last_thumbnail = thumbnail
+        stats["kept"] += 1
+        yield VideoFrame(video_name, index / fps, frame), frame
+
+        if stats["kept"] >= VIDEO_MAX_FRAMES:
+            break
+
+
+def prepare_frame(frame: np.array) -> tuple:
+    """ Resizes a frame to the model input size (same output as API_client_server.decode_image). """
+
+    height, width = frame.shape[:2]
+    resized = cv2.resize(frame, (MODEL_INPUT_SIZE, MODEL_INPUT_SIZE), interpolation=cv2.INTER_LINEAR)
+    return resized, (height / MODEL_INPUT_SIZE, width / MODEL_INPUT_SIZE)
+
+
+def iter_batches(frames, size: int):
+    """ Groups the (VideoFrame, image) tuples in lists of at most size items. """
+
+    batch = []
+    for item in frames:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def predict_video(
+    path: str, video_name: str, task: str, customer_car_info: dict, max_pixels: int = None, progress=None
+) -> dict:
+    """
+    Predicts the damages and / or the plates of an uploaded video: the frames are decoded as a stream,
+    sampled every VIDEO_SAMPLE_INTERVAL seconds (the near-duplicates are dropped), predicted by batches
+    of VIDEO_BATCH_SIZE frames, then the detections are merged across the frames.
+
+    Parameters
+    ----------
+    path : str
+        The path of the uploaded video (see spool_video).
+    video_name : str
+        The name of the uploaded video.
+    task : str
+        The predictions to compute: 'damages', 'plates' or 'all'.
+    customer_car_info : dict
+        A dictionary containing information about the customer's car (trade, model, year).
+    max_pixels : int
+        The maximum number of pixels of the frames (None for no limit).
+    progress : callable
+        An optional progress(stage, step, steps) callback (see jobs.JobStore), called after each batch.
+
+    Returns
+    -------
+    dict:
+        - frames: (dict) the number of 'read', 'sampled' and 'kept' frames, and the 'duration' of the video.
+        - damages: (list) the top damages of each class (predict_damages format, the 'file' is the video name
+        followed by the time of the frame: 'video.mp4#t=3.50'), with the number of 'frames' of the class.
+        - plates: (list) the distinct plates read (predict_plates format), with their number of 'frames'.
+
+    Raises
+    ------
+    ValueError
+        If the video can't be read (VideoTooLargeError if its frames have more than max_pixels pixels).
+    """
+
+    stats = {"read": 0, "sampled": 0, "kept": 0, "duration": 0.0}
+    damages = VideoDamages()
+    plates = VideoPlates()
+
+    capture = open_video(path, video_name, max_pixels)
+    try:
+        frames = iter_frames(capture, video_name, stats)
+        for batch in iter_batches(frames, VIDEO_BATCH_SIZE):
+
+            with metrics.timer("video_frames"):
+                files = [video_frame for video_frame, _ in batch]
+                prepared = [prepare_frame(frame) for _, frame in batch]
+                images = [image for image, _ in prepared]
+                ratios = [ratio for _, ratio in prepared]
+            batch = prepared = None  # only the encoded frames are kept for the predictions
+
+            if task in ("damages", "all"):
+                raw_damages = get_raw_damages(files, images, ratios)
+                for class_name, pred_dict, severity in score_damages(raw_damages, files, customer_car_info):
+                    damages.add_damage(class_name, pred_dict, severity)
+
+            if task in ("plates", "all"):
+                for video_frame, raw_plates in zip(files, get_raw_plates(files, images, ratios)):
+                    for plate in format_plates(raw_plates, video_frame):
+                        plates.add_plate(plate)
+
+            if progress is not None:
+                progress("frames", stats["kept"], VIDEO_MAX_FRAMES)
+    finally:
+        capture.release()
+
+    return {"frames": stats, "damages": damages.get_selected(), "plates": plates.get_selected()}
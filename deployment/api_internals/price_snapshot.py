@@ -0,0 +1,113 @@
+import os
+import sqlite3
+import tempfile
+import time
+
+# --- DEFINE VARIABLES
+# A price snapshot is a SQLite file holding a copy of the PostgreSQL price table (same columns),
+# exported with export_price_snapshot.py. It is read once into the in-memory price index
+# (no network I/O), and read again when the file is replaced.
+
+SNAPSHOT_COLUMNS = ("part", "trade", "model", "year", "price_repair", "price_replace")
+
+# --- DEFINE FUNCTIONS
+
+
+def get_signature(path: str) -> tuple:
+    """
+    Returns the signature of a snapshot file, which changes when the file is replaced
+    (None if the file doesn't exist).
+    """
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def read_snapshot(path: str) -> dict:
+    """
+    Reads a price snapshot.
+
+    Parameters
+    ----------
+    path : str
+        The path of the SQLite snapshot.
+
+    Returns
+    -------
+    dict:
+        The price index: {(part, trade, model, year): (price_repair, price_replace)}.
+
+    Raises
+    ------
+    ValueError
+        If the snapshot is empty (a truncated export is not loaded).
+    """
+
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = connection.execute(f"SELECT {', '.join(SNAPSHOT_COLUMNS)} FROM price").fetchall()
+    finally:
+        connection.close()
+
+    if len(rows) == 0:
+        raise ValueError(f"The price snapshot '{path}' is empty.")
+
+    return {(part, trade, model, year): (price_repair, price_replace)
+            for part, trade, model, year, price_repair, price_replace in rows}
+
+
+def write_snapshot(path: str, rows: list) -> int:
+    """
+    Writes a price snapshot. The file is written next to its destination then renamed,
+    so that the running workers never read a partial snapshot.
+
+    Parameters
+    ----------
+    path : str
+        The path of the SQLite snapshot.
+    rows : list
+        The (part, trade, model, year, price_repair, price_replace) rows of the price table.
+
+    Returns
+    -------
+    int:
+        The number of rows written.
+
+    Raises
+    ------
+    ValueError
+        If there are no rows (the current snapshot is kept).
+    """
+
+    if len(rows) == 0:
+        raise ValueError("The price table is empty, the snapshot is not written.")
+
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, temporary_path = tempfile.mkstemp(prefix=".prices_", suffix=".db", dir=folder)
+    os.close(fd)
+
+    try:
+        connection = sqlite3.connect(temporary_path)
+        try:
+            connection.execute(
+                "CREATE TABLE price (part TEXT NOT NULL, trade TEXT, model TEXT, year INTEGER, "
+                "price_repair INTEGER, price_replace INTEGER)"
+            )
+            connection.executemany("INSERT INTO price VALUES (?, ?, ?, ?, ?, ?)", rows)
+            connection.execute("CREATE TABLE snapshot (exported_at REAL, rows INTEGER)")
+            connection.execute("INSERT INTO snapshot VALUES (?, ?)", (time.time(), len(rows)))
+            connection.commit()
+        finally:
+            connection.close()
+
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, path)
+    except Exception:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+    return len(rows)
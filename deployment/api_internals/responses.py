@@ -0,0 +1,94 @@
+import json
+
+from flask import Response
+
+try:
+    import orjson
+except ImportError:  # (orjson is listed in the requirements, the standard json module is slower)
+    orjson = None
+
+# --- DEFINE VARIABLES
+
+# The response formats of the predict endpoints (?format=...)
+RESPONSE_FORMATS = {"full", "compact"}
+
+# --- DEFINE FUNCTIONS
+
+
+def dumps(content) -> bytes:
+    """
+    Serializes a JSON content once, with orjson if available (numpy values included).
+    The keys are sorted, as flask.jsonify did.
+    """
+
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_SORT_KEYS)
+    return json.dumps(content, separators=(",", ":"), default=float, sort_keys=True).encode()
+
+
+def json_response(content, status: int = 200) -> Response:
+    """ Returns a JSON response serialized by dumps (instead of flask.jsonify). """
+
+    return Response(dumps(content), status=status, mimetype="application/json")
+
+
+def _group_by_file(predictions: list, file_indices: list, filenames: list, columns: dict) -> list:
+    """
+    Groups the predictions per uploaded file, as one array per field (in the order of the predictions).
+    The files are identified by their index, as several uploads can have the same name.
+
+    Parameters
+    ----------
+    predictions : list
+        The predictions.
+    file_indices : list
+        The index of the file of each prediction.
+    filenames : list
+        The names of all the uploaded files (the files without predictions are listed too).
+    columns : dict
+        The name of each array and the function returning its value from a prediction.
+
+    Returns
+    -------
+    list:
+        One {"file", <column>: [...]} dictionary per file, in the upload order.
+    """
+
+    groups = [{"file": filename, **{name: [] for name in columns}} for filename in filenames]
+
+    for prediction, i in zip(predictions, file_indices):
+        for name, get_value in columns.items():
+            groups[i][name].append(get_value(prediction))
+
+    return groups
+
+
+def compact_damages(damages: list, file_indices: list, filenames: list) -> list:
+    """
+    Returns the damages (predict_damages format) grouped per file, with numeric arrays:
+    type, coords ([x1, y1, x2, y2] per damage), severity (a number, or null for the classes
+    that are always replaced, which are not scored by the severity model), price, action and
+    probable_duplicate.
+    """
+
+    return _group_by_file(damages, file_indices, filenames, {
+        "type": lambda d: d["type"],
+        "coords": lambda d: [round(float(c), 1) for c in d["coords"]],
+        "severity": lambda d: float(d["severity"]) if d["severity_model"] is not None else None,
+        "price": lambda d: d["price"],
+        "action": lambda d: d["action"],
+        "probable_duplicate": lambda d: d["probable_duplicate"],
+    })
+
+
+def compact_plates(plates: list, file_indices: list, filenames: list) -> list:
+    """
+    Returns the plates (predict_plates format) grouped per file:
+    text, invalid and coords ([x1, y1, x2, y2] per plate).
+    """
+
+    return _group_by_file(plates, file_indices, filenames, {
+        "text": lambda p: p["text"],
+        "invalid": lambda p: p["invalid"],
+        "coords": lambda p: [round(float(c), 1) for c in p["coords"]],
+    })
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from api_internals.image_io import read_upload
+
+
+class ResultCache:
+    """
+    A content-addressed cache of the raw predictions of an image
+    (keyed by the digest of the uploaded bytes and the names of the models used).
+
+    The entries are kept in a size-bounded LRU in memory and optionally
+    in a directory (one JSON file per entry) shared by the workers.
+
+    Attributes
+    ----------
+    max_entries : int
+        The maximum number of entries kept in memory (0 disables the cache).
+    directory : str
+        The directory of the on-disk tier (None to disable it).
+    hits : int
+        The number of lookups found in the cache.
+    misses : int
+        The number of lookups not found in the cache.
+
+    Methods
+    -------
+    get(key)
+        Returns the cached value of a key (or None).
+    put(key, value)
+        Stores a JSON serializable value.
+    stats()
+        Returns the hit / miss counters and the size of the cache.
+    """
+
+    def __init__(self, max_entries=1024, directory=None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str):
+        """
+        Returns the cached value of a key.
+
+        Parameters
+        ----------
+        key : str
+            The key returned by make_key.
+
+        Returns
+        -------
+        The cached value, or None if the key isn't cached.
+        """
+
+        if key is None or self.max_entries <= 0:
+            return None
+
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+        if self.directory is not None:
+            try:
+                with open(self._path(key)) as fp:
+                    value = json.load(fp)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"#### ResultCache.get ERROR #### {e}")
+            else:
+                self._store(key, value)
+                with self._lock:
+                    self.hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _store(self, key, value):
+        """ Adds an entry to the in-memory LRU. """
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def put(self, key: str, value):
+        """
+        Stores the value of a key (in memory and on disk if enabled).
+
+        Parameters
+        ----------
+        key : str
+            The key returned by make_key.
+        value : JSON serializable
+            The value to store.
+        """
+
+        if key is None or self.max_entries <= 0:
+            return
+
+        self._store(key, value)
+
+        if self.directory is not None:
+            try:
+                tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "w") as fp:
+                    json.dump(value, fp)
+                os.replace(tmp_path, self._path(key))
+            except Exception as e:
+                print(f"#### ResultCache.put ERROR #### {e}")
+
+    def stats(self) -> dict:
+        """ Returns the hit / miss counters and the number of entries in memory. """
+
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "directory": self.directory,
+            }
+
+
+def make_key(f, *model_names) -> str:
+    """
+    Returns the cache key of an uploaded file.
+
+    Parameters
+    ----------
+    f : file object
+        The uploaded file.
+    model_names : str
+        The names of the models producing the cached predictions.
+
+    Returns
+    -------
+    str:
+        The SHA-256 digest of the file content and of the model names,
+        or None if the file can't be read or must not be cached (cacheable attribute set to False).
+    """
+
+    if not getattr(f, "cacheable", True):
+        return None
+
+    buffer = read_upload(f)
+    if buffer is None:
+        return None
+
+    digest = hashlib.sha256(buffer)
+    for model_name in model_names:
+        digest.update(b"\0" + str(model_name).encode())
+
+    return digest.hexdigest()
+
+
+def make_cache(name: str) -> ResultCache:
+    """
+    Returns a ResultCache configured with the RESULT_CACHE_SIZE
+    and RESULT_CACHE_DIR (optional on-disk tier) environment variables.
+    """
+
+    directory = os.environ.get("RESULT_CACHE_DIR")
+    if directory:
+        directory = os.path.join(directory, name)
+
+    return ResultCache(
+        max_entries=int(os.environ.get("RESULT_CACHE_SIZE") or 1024),
+        directory=directory or None,
+    )
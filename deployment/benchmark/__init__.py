@@ -0,0 +1,7 @@
+"""
+Stage-level benchmarks of the inference pipeline.
+
+Usage (from the deployment folder):
+    python -m benchmark run --output bench_<commit>.json
+    python -m benchmark compare bench_<old>.json bench_<new>.json --tolerance 0.1
+"""
@@ -0,0 +1,114 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+
+def get_commit() -> str:
+    """ Returns the current git commit (or None outside of a git repository). """
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    """ Runs the benchmarks and writes the JSON report. """
+
+    from benchmark import price_db
+
+    # --- the environment must be set before the API modules are imported
+    price_db.configure()
+    os.environ["RESULT_CACHE_SIZE"] = "0"  # every call must run the models
+
+    from benchmark.stages import run_stages
+
+    price_db.seed()
+
+    results = run_stages(args.resolutions, args.batch_sizes, args.repeat)
+
+    config_keys = [
+        "DETECTOR_BACKEND", "SEVERITY_PRECISION", "ROI_DECODE", "ROI_MIN_SIDE", "CDD_MAX_BATCH_SIZE", "CDD_MAX_WAIT_MS",
+        "SEVERITY_BATCH_SIZE", "DECODE_WORKERS", "DAMAGE_WORKERS", "PLATE_WORKERS", "ORT_INTRA_OP_THREADS", "ORT_INTER_OP_THREADS",
+    ]
+    report = {
+        "meta": {
+            "commit": get_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "config": {key: os.environ.get(key) for key in config_keys},
+        },
+        "results": results,
+    }
+
+    with open(args.output, "w") as fp:
+        json.dump(report, fp, indent=4)
+    print(f"Report written to {args.output}")
+
+
+def result_key(result: dict) -> str:
+    return f"{result['stage']} {json.dumps(result['params'], sort_keys=True)}"
+
+
+def compare(args):
+    """ Compares two reports and exits with an error if a stage is slower than the tolerance. """
+
+    with open(args.base) as fp:
+        base = {result_key(r): r for r in json.load(fp)["results"]}
+    with open(args.new) as fp:
+        new = {result_key(r): r for r in json.load(fp)["results"]}
+
+    regressions = 0
+    for key in sorted(base.keys() & new.keys()):
+        old_p50, new_p50 = base[key]["latency_ms"]["p50"], new[key]["latency_ms"]["p50"]
+        old_p95, new_p95 = base[key]["latency_ms"]["p95"], new[key]["latency_ms"]["p95"]
+        change = (new_p50 - old_p50) / old_p50 if old_p50 > 0 else 0.0
+
+        regression = new_p50 > old_p50 * (1 + args.tolerance) or new_p95 > old_p95 * (1 + args.tolerance)
+        regressions += int(regression)
+
+        # (the peak RSS increase during the stage, older reports don't have it)
+        old_mem = base[key]["rss_mb"].get("peak_delta")
+        new_mem = new[key]["rss_mb"].get("peak_delta")
+        memory = f"peak +{old_mem:.1f} -> +{new_mem:.1f}MB" if old_mem is not None and new_mem is not None else ""
+
+        flag = "REGRESSION" if regression else ""
+        print(f"{key:<80} p50 {old_p50:9.2f} -> {new_p50:9.2f}ms ({change:+7.1%}) {memory} {flag}")
+
+    for key in sorted(base.keys() ^ new.keys()):
+        print(f"{key:<80} only in {'base' if key in base else 'new'} report")
+
+    print(f"{regressions} regression(s) above {args.tolerance:.0%}")
+    sys.exit(1 if regressions > 0 else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmark", description="Stage-level benchmarks of the API")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_run = subparsers.add_parser("run", help="run the benchmarks")
+    parser_run.add_argument("--resolutions", nargs="+", default=["vga", "fhd", "12mp"])
+    parser_run.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 4, 8])
+    parser_run.add_argument("--repeat", type=int, default=20)
+    parser_run.add_argument("--output", default="bench_output.json")
+
+    parser_compare = subparsers.add_parser("compare", help="compare two reports")
+    parser_compare.add_argument("base")
+    parser_compare.add_argument("new")
+    parser_compare.add_argument("--tolerance", type=float, default=0.1)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
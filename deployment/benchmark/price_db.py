@@ -0,0 +1,48 @@
+import os
+import tempfile
+
+# --- DEFINE VARIABLES
+
+PARTS = [
+    "hood", "front_bumper", "front_fender", "headlight", "front_windscreen", "sidemirror",
+    "sidedoor_panel", "roof", "runnigboard", "pillar", "sidedoor_window", "rear_fender",
+    "rear_windscreen", "taillight", "rear_bumper", "backdoor_panel",
+]
+
+CARS = [("toyota", "corolla", 2015), ("honda", "civic", 2018), ("lexus", "rx350", 2012)]
+
+# --- DEFINE FUNCTIONS
+
+
+def configure() -> str:
+    """
+    Points the API to a local SQLite stand-in of the price database.
+    Must be called before importing the API modules.
+
+    Returns
+    -------
+    str:
+        The path of the SQLite file.
+    """
+
+    path = os.path.join(tempfile.mkdtemp(prefix="mycover_bench_"), "prices.db")
+    os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+    return path
+
+
+def seed():
+    """ Fills the stand-in database with generic and car specific prices, then reloads the price cache. """
+
+    from api_internals import config_postgres
+    from api_internals.config_postgres import db, Price
+
+    with config_postgres.db_app.app_context():
+        db.session.query(Price).delete()
+        for k, part in enumerate(PARTS):
+            db.session.add(Price(part, None, None, None, 100 + k, 300 + k))
+            for trade, model, year in CARS:
+                db.session.add(Price(part, trade, model, year, 120 + k, 360 + k))
+        db.session.commit()
+
+    if config_postgres.PRICE_CACHE_TTL > 0:
+        config_postgres.load_price_cache()
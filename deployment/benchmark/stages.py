@@ -0,0 +1,159 @@
+import io
+
+import cv2
+import numpy as np
+from werkzeug.datastructures import FileStorage
+
+from benchmark.synthetic import RESOLUTIONS, make_image, make_uploads
+from benchmark.timing import measure
+
+# --- DEFINE VARIABLES
+
+CUSTOMER_CAR_INFO = {"trade": "toyota", "model": "corolla", "year": "2015"}
+
+# --- DEFINE FUNCTIONS
+
+
+def post_files(client, path: str, uploads: list):
+    """ Posts a list of (filename, bytes) to an endpoint of the API (as the clients do). """
+
+    data = {"file": [(io.BytesIO(content), name) for name, content in uploads]}
+    data.update(CUSTOMER_CAR_INFO)
+    response = client.post(path, data=data, content_type="multipart/form-data")
+    if response.status_code != 200:
+        raise RuntimeError(f"{path} returned {response.status_code}: {response.data[:200]}")
+    return response
+
+
+def crop_shared_rois(content: bytes, damage_boxes: list, plate_boxes: list) -> tuple:
+    """ Crops the damages & plates of an upload as /predict_all does (from one shared ROI tier). """
+
+    from api_internals.image_io import crop_rois, release_roi_image, share_roi_images
+
+    f = FileStorage(io.BytesIO(content), filename="roi.jpg")
+    share_roi_images([f], 2)
+
+    damages = crop_rois(f, damage_boxes)
+    release_roi_image(f)
+    plates = crop_rois(f, plate_boxes)
+    release_roi_image(f)
+
+    return damages, plates
+
+
+def make_plate_crop() -> np.array:
+    """ Returns a synthetic license plate crop (BGR). """
+
+    crop = np.full((60, 220, 3), 235, dtype=np.uint8)
+    cv2.putText(crop, "ABC 123 DE", (8, 42), cv2.FONT_HERSHEY_SIMPLEX, 1.1, (20, 20, 20), 3)
+    return crop
+
+
+def run_stages(resolutions: list, batch_sizes: list, repeat: int) -> list:
+    """
+    Benchmarks every stage of the pipeline.
+
+    Parameters
+    ----------
+    resolutions : list
+        The names of the synthetic image resolutions (see synthetic.RESOLUTIONS).
+    batch_sizes : list
+        The numbers of images (or boxes) per call.
+    repeat : int
+        The number of timed calls per stage.
+
+    Returns
+    -------
+    list:
+        The statistics of every stage (see timing.measure).
+    """
+
+    import API_client_server as api
+    from api_internals import inference_workers, lifecycle, predict_damages, predict_plates
+
+    client = api.app.test_client()
+    results = []
+
+    # With DAMAGE_WORKERS / PLATE_WORKERS, the models run in the inference worker processes: only the routes
+    # use them (started & loaded before timing), the stages calling the models directly are skipped
+    inference_workers.start_pools()
+    if not inference_workers.wait_pools(lifecycle.WORKER_START_TIMEOUT):
+        raise RuntimeError("The inference workers are not ready")
+
+    # --- IMAGE STAGES (PER RESOLUTION & BATCH SIZE)
+
+    for resolution in resolutions:
+        uploads = make_uploads(resolution, max(batch_sizes))
+
+        buffer = uploads[0][1]
+        results.append(measure(
+            "decode_image", lambda: api.decode_image(buffer),
+            repeat=repeat, resolution=resolution,
+        ))
+
+        # (a damage covering a sixth of the image and a small plate, full resolution coordinates)
+        width, height = RESOLUTIONS[resolution]
+        damage_boxes = [[width * 0.2, height * 0.3, width * 0.6, height * 0.7]]
+        plate_boxes = [[width * 0.45, height * 0.75, width * 0.55, height * 0.78]]
+        results.append(measure(
+            "roi_crops", lambda: crop_shared_rois(buffer, damage_boxes, plate_boxes),
+            repeat=repeat, resolution=resolution,
+        ))
+
+        for batch_size in batch_sizes:
+            batch = uploads[:batch_size]
+            images = [api.decode_image(content)[0] for _, content in batch]
+
+            if predict_damages.LOAD_MODELS:
+                results.append(measure(
+                    "model_cdd.predict", lambda: predict_damages.model_cdd.predict(images, agnostic_nms=True),
+                    items=batch_size, repeat=repeat, resolution=resolution, batch_size=batch_size,
+                ))
+            if predict_plates.LOAD_MODELS:
+                results.append(measure(
+                    "model_lpd.predict", lambda: predict_plates.model_lpd.predict(images, agnostic_nms=True),
+                    items=batch_size, repeat=repeat, resolution=resolution, batch_size=batch_size,
+                ))
+
+            for path in ("/predict_damages", "/predict_plates", "/predict_all"):
+                results.append(measure(
+                    f"route {path}", lambda: post_files(client, path, batch),
+                    items=batch_size, repeat=repeat, resolution=resolution, batch_size=batch_size,
+                ))
+
+    # --- BOX STAGES (PER NUMBER OF BOXES)
+
+    image = make_image(640, 640)
+    coords = np.array([100.0, 120.0, 380.0, 340.0], dtype=np.float32)
+
+    for batch_size in batch_sizes:
+        if predict_damages.LOAD_MODELS:
+            crops = [predict_damages.crop_severity_input(image, coords) for _ in range(batch_size)]
+            results.append(measure(
+                "get_severity", lambda: predict_damages.get_severities(crops),
+                items=batch_size, repeat=repeat, boxes=batch_size,
+            ))
+
+        parts_actions = [("hood_damage", "REPAIR"), ("taillight_damage", "REPLACE")] * batch_size
+        results.append(measure(
+            "get_price", lambda: predict_damages.get_prices(parts_actions, CUSTOMER_CAR_INFO),
+            items=len(parts_actions), repeat=repeat, boxes=len(parts_actions),
+        ))
+
+    if not predict_plates.LOAD_MODELS:
+        return results
+
+    plate_crop = make_plate_crop()
+    results.append(measure(
+        "get_text", lambda: predict_plates.read_text(plate_crop),
+        repeat=repeat, boxes=1,
+    ))
+
+    for batch_size in batch_sizes:
+        plate_crops = [plate_crop] * batch_size
+        results.append(measure(
+            "read_texts", lambda: predict_plates.read_texts(plate_crops),
+            items=batch_size, repeat=repeat, boxes=batch_size,
+        ))
+
+    return results
@@ -0,0 +1,51 @@
+import cv2
+import numpy as np
+
+# --- DEFINE VARIABLES
+
+RESOLUTIONS = {
+    "vga": (640, 480),
+    "fhd": (1920, 1080),
+    "12mp": (4000, 3000),
+}
+
+# --- DEFINE FUNCTIONS
+
+
+def make_image(width: int, height: int, seed: int = 0) -> np.array:
+    """
+    Returns a synthetic BGR image (gradients, rectangles and noise) that compresses
+    like a photo rather than like pure noise.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)
+    image = np.empty((height, width, 3), dtype=np.float32)
+    image[:, :, 0] = x[None, :]
+    image[:, :, 1] = y[:, None]
+    image[:, :, 2] = (x[None, :] + y[:, None]) / 2
+
+    for _ in range(12):
+        x1, y1 = int(rng.integers(0, width)), int(rng.integers(0, height))
+        x2, y2 = x1 + int(rng.integers(width // 20, width // 4)), y1 + int(rng.integers(height // 20, height // 4))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.rectangle(image, (x1, y1), (x2, y2), color, thickness=-1)
+
+    image += rng.normal(0, 8, image.shape).astype(np.float32)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def make_jpeg(width: int, height: int, seed: int = 0, quality: int = 90) -> bytes:
+    """ Returns a synthetic image encoded as JPEG (as uploaded by the clients). """
+
+    ok, encoded = cv2.imencode(".jpg", make_image(width, height, seed), [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return encoded.tobytes()
+
+
+def make_uploads(resolution: str, count: int) -> list:
+    """ Returns a list of (filename, jpeg bytes) of a given resolution (distinct images). """
+
+    width, height = RESOLUTIONS[resolution]
+    return [(f"{resolution}_{k:02d}.jpg", make_jpeg(width, height, seed=k)) for k in range(count)]
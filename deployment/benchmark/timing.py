@@ -0,0 +1,129 @@
+import resource
+import time
+
+import numpy as np
+
+# --- DEFINE FUNCTIONS
+
+
+def current_rss_mb() -> float:
+    """ Returns the current resident memory of the process (in MB). """
+
+    try:
+        with open("/proc/self/statm") as fp:
+            pages = int(fp.read().split()[1])
+        return pages * resource.getpagesize() / (1024 * 1024)
+    except OSError:
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    """
+    Returns the peak resident memory of the process (in MB), since the last reset_peak_rss call
+    (or since the process started if the peak can't be reset).
+    """
+
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss() -> bool:
+    """
+    Resets the peak resident memory of the process to its current resident memory (Linux >= 4.0),
+    so that the peak of each stage can be measured.
+
+    Returns
+    -------
+    bool:
+        True if the peak was reset.
+    """
+
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def measure(
+    name: str, fn, items: int = 1, repeat: int = 20, warmup: int = 2, memory_repeat: int = 3, **params
+) -> dict:
+    """
+    Runs a stage several times and returns its statistics.
+    The memory is measured on separate calls, after the timed ones and after resetting the peak RSS.
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage.
+    fn : callable
+        The function running the stage once.
+    items : int
+        The number of items (images, boxes, ...) processed by each call, for the throughput.
+    repeat : int
+        The number of timed calls.
+    warmup : int
+        The number of calls before timing.
+    memory_repeat : int
+        The number of calls measuring the memory.
+    params :
+        The parameters of the stage (resolution, batch size, ...) reported along with the results.
+
+    Returns
+    -------
+    dict:
+        The p50 / p95 / p99 / mean latency (ms), the throughput (items/s) and the memory of the stage
+        (RSS before / after the memory calls, their peak RSS and its increase over 'before', MB;
+        'peak_reset' is False if the peak couldn't be reset, it is then the peak of the whole process).
+    """
+
+    for _ in range(warmup):
+        fn()
+
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - start) * 1000.0)
+
+    peak_reset = reset_peak_rss()
+    rss_before = current_rss_mb()
+    for _ in range(memory_repeat):
+        fn()
+    rss_after = current_rss_mb()
+    rss_peak = max(peak_rss_mb(), rss_after)  # (the kernel updates the peak lazily)
+
+    latencies = np.array(latencies)
+    result = {
+        "stage": name,
+        "params": params,
+        "repeat": repeat,
+        "latency_ms": {
+            "p50": float(np.percentile(latencies, 50)),
+            "p95": float(np.percentile(latencies, 95)),
+            "p99": float(np.percentile(latencies, 99)),
+            "mean": float(latencies.mean()),
+        },
+        "throughput_per_s": float(items * 1000.0 / latencies.mean()),
+        "rss_mb": {
+            "before": rss_before,
+            "after": rss_after,
+            "peak": rss_peak,
+            "peak_delta": rss_peak - rss_before,
+            "peak_reset": peak_reset,
+        },
+    }
+
+    print(
+        f"{name:<24} {str(params):<45} p50={result['latency_ms']['p50']:9.2f}ms "
+        f"p95={result['latency_ms']['p95']:9.2f}ms p99={result['latency_ms']['p99']:9.2f}ms "
+        f"{result['throughput_per_s']:9.2f}/s peak=+{result['rss_mb']['peak_delta']:.1f}MB"
+    )
+    return result
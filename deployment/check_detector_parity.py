@@ -0,0 +1,123 @@
+#! /usr/bin/env python3
+# coding: utf-8
+
+"""
+Compare the detections of a YOLO model run with PyTorch (ultralytics, .pt)
+and with ONNX Runtime (api_internals.onnx_detector, .onnx) on a folder of images.
+
+Usage (from the deployment folder):
+    python check_detector_parity.py --model car_damage_detect_2.pt --images ../experiment1/data --export
+    python check_detector_parity.py --model license_plate_detect_model.pt --images ../experiment1/data
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+import cv2
+import numpy as np
+from ultralytics import YOLO
+
+from api_internals.onnx_detector import OnnxYOLO
+
+IMAGE_EXTENSIONS = {".bmp", ".jpeg", ".jpg", ".png", ".tif", ".tiff", ".webp"}
+
+
+def load_images(folder: Path, size: int = 640) -> list:
+    """ Loads & resizes the images of a folder the same way as the API (see preprocess_image). """
+
+    images = []
+    for path in sorted(folder.iterdir()):
+        if path.suffix.lower() in IMAGE_EXTENSIONS:
+            image = cv2.imread(str(path), cv2.IMREAD_COLOR)
+            if image is not None:
+                images.append((path.name, cv2.resize(image, (size, size), interpolation=cv2.INTER_LINEAR)))
+    return images
+
+
+def box_iou(a: np.array, b: np.array) -> float:
+    """ Returns the IoU of two (x1, y1, x2, y2) boxes. """
+
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0.0, x2 - x1) * max(0.0, y2 - y1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def to_arrays(result) -> tuple:
+    """ Returns the (xyxy, cls) arrays of a result (ultralytics or ONNX). """
+
+    xyxy = [np.asarray(box.xyxy[0], dtype=np.float32).reshape(4) for box in result.boxes]
+    cls = [int(box.cls) for box in result.boxes]
+    return xyxy, cls
+
+
+def compare(torch_result, onnx_result, min_iou: float) -> dict:
+    """ Matches the ONNX boxes with the PyTorch boxes (same class, best IoU). """
+
+    torch_xyxy, torch_cls = to_arrays(torch_result)
+    onnx_xyxy, onnx_cls = to_arrays(onnx_result)
+
+    matched, max_diff = 0, 0.0
+    used = set()
+    for t_box, t_cls in zip(torch_xyxy, torch_cls):
+        best, best_iou = None, min_iou
+        for k, (o_box, o_cls) in enumerate(zip(onnx_xyxy, onnx_cls)):
+            iou = box_iou(t_box, o_box)
+            if k not in used and o_cls == t_cls and iou >= best_iou:
+                best, best_iou = k, iou
+        if best is not None:
+            used.add(best)
+            matched += 1
+            max_diff = max(max_diff, float(np.abs(t_box - onnx_xyxy[best]).max()))
+
+    return {
+        "torch_boxes": len(torch_xyxy),
+        "onnx_boxes": len(onnx_xyxy),
+        "matched": matched,
+        "max_coord_diff": max_diff,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", required=True, help="the name of the .pt model in the 'models' folder")
+    parser.add_argument("--images", required=True, help="a folder of test images")
+    parser.add_argument("--export", action="store_true", help="export the .pt model to ONNX first")
+    parser.add_argument("--min-iou", type=float, default=0.9, help="minimum IoU of two matching boxes")
+    parser.add_argument("--max-diff", type=float, default=2.0, help="maximum coordinate difference (pixels)")
+    args = parser.parse_args()
+
+    pt_path = Path("models", args.model)
+    onnx_path = pt_path.with_suffix(".onnx")
+
+    torch_model = YOLO(pt_path)
+    if args.export:
+        torch_model.export(format="onnx", imgsz=640, dynamic=False, simplify=True)
+
+    onnx_model = OnnxYOLO(onnx_path)
+
+    if onnx_model.names and {int(k): v for k, v in onnx_model.names.items()} != torch_model.names:
+        print("#### ERROR #### the class names of the two models are different")
+        sys.exit(1)
+
+    failures = 0
+    for name, image in load_images(Path(args.images)):
+        torch_result = torch_model.predict([image], imgsz=640, agnostic_nms=True, verbose=False)[0]
+        onnx_result = onnx_model.predict([image], agnostic_nms=True)[0]
+
+        report = compare(torch_result, onnx_result, args.min_iou)
+        ok = (
+            report["torch_boxes"] == report["onnx_boxes"] == report["matched"]
+            and report["max_coord_diff"] <= args.max_diff
+        )
+        failures += 0 if ok else 1
+        print(f"{'OK  ' if ok else 'FAIL'} {name}: {report}")
+
+    print(f"{failures} image(s) with different detections")
+    sys.exit(1 if failures > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
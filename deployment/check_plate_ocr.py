@@ -0,0 +1,115 @@
+#! /usr/bin/env python3
+# coding: utf-8
+
+"""
+Compare the plate numbers read by the batched EasyOCR recognizer (OCR_MODE=lines, the plates split into
+text lines) and by reader.readtext (OCR_MODE=readtext, CRAFT text detector + recognizer) on a folder of
+license plate crops (or on synthetic three-line Nigerian plates).
+
+Usage (from the deployment folder):
+    python check_plate_ocr.py --images ../experiment1/plates
+    python check_plate_ocr.py --synthetic 20
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from api_internals import predict_plates
+
+IMAGE_EXTENSIONS = {".bmp", ".jpeg", ".jpg", ".png", ".tif", ".tiff", ".webp"}
+
+STATES = ["LAGOS", "ABUJA", "KANO", "RIVERS", "OYO", "ENUGU"]
+SLOGANS = ["CENTRE OF EXCELLENCE", "FEDERAL CAPITAL TERRITORY", "CENTRE OF COMMERCE", "TREASURE OF THE NATION"]
+
+
+def load_crops(folder: Path) -> list:
+    """ Loads the (BGR) plate crops of a folder. """
+
+    crops = []
+    for path in sorted(folder.iterdir()):
+        if path.suffix.lower() in IMAGE_EXTENSIONS:
+            crop = cv2.imread(str(path), cv2.IMREAD_COLOR)
+            if crop is not None:
+                crops.append((path.name, crop))
+    return crops
+
+
+def make_plate(seed: int) -> tuple:
+    """ Returns a synthetic Nigerian plate (state, number, slogan) and its number. """
+
+    rng = np.random.default_rng(seed)
+    letters = "ABCDEFGHJKLMNPRSTUVWXYZ"
+    number = (
+        "".join(rng.choice(list(letters), 3)) + " " + "".join(rng.choice(list("0123456789"), 3))
+        + " " + "".join(rng.choice(list(letters), 2))
+    )
+
+    plate = np.full((160, 340, 3), 240, dtype=np.uint8)
+    cv2.rectangle(plate, (2, 2), (337, 157), (30, 30, 30), 2)
+    cv2.putText(plate, STATES[seed % len(STATES)], (125, 32), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (160, 40, 40), 2)
+    cv2.putText(plate, number, (18, 96), cv2.FONT_HERSHEY_SIMPLEX, 1.35, (20, 20, 20), 3)
+    cv2.putText(plate, SLOGANS[seed % len(SLOGANS)], (20, 140), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (160, 40, 40), 1)
+    return plate, number
+
+
+def read_all(crops: list, mode: str) -> tuple:
+    """ Reads all the crops with an OCR mode, returns the (text, invalid_texts) tuples and the duration (s). """
+
+    predict_plates.OCR_MODE = mode
+    start = time.perf_counter()
+    texts = predict_plates.read_texts(crops)
+    return texts, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", help="a folder of license plate crops")
+    parser.add_argument("--synthetic", type=int, default=0, help="number of synthetic plates to read")
+    parser.add_argument("--min-agreement", type=float, default=0.95, help="minimum share of identical numbers")
+    args = parser.parse_args()
+
+    crops, expected = [], []
+    if args.images:
+        crops.extend(load_crops(Path(args.images)))
+        expected.extend([None] * len(crops))
+    for k in range(args.synthetic):
+        plate, number = make_plate(k)
+        crops.append((f"synthetic_{k:02d}", plate))
+        expected.append(number)
+
+    if len(crops) == 0:
+        print("#### ERROR #### no plate to read (use --images and / or --synthetic)")
+        sys.exit(1)
+
+    images = [crop for _, crop in crops]
+    readtext_texts, readtext_duration = read_all(images, "readtext")
+    lines_texts, lines_duration = read_all(images, "lines")
+
+    same, readtext_valid, lines_valid = 0, 0, 0
+    for (name, _), number, (readtext_text, _), (lines_text, lines_invalid) in zip(
+        crops, expected, readtext_texts, lines_texts
+    ):
+        no_plate = "NO NIGERIAN PLATE"
+        readtext_valid += int(readtext_text != no_plate)
+        lines_valid += int(lines_text != no_plate)
+
+        ok = lines_text == readtext_text
+        same += int(ok)
+        truth = f" (expected {number})" if number is not None else ""
+        print(f"{'OK  ' if ok else 'DIFF'} {name}: readtext={readtext_text!r} lines={lines_text!r}{truth} invalid={lines_invalid}")
+
+    agreement = same / len(crops)
+    print(
+        f"{same}/{len(crops)} identical numbers ({agreement:.1%}), valid plates: readtext {readtext_valid} / lines {lines_valid}, "
+        f"duration: readtext {readtext_duration * 1000:.0f} ms / lines {lines_duration * 1000:.0f} ms"
+    )
+    sys.exit(0 if agreement >= args.min_agreement else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -103,8 +103,7 @@ function initializeCells(files){
 }
 
 async function predict_all(files){
-     	await postPictures(files, "predict_damages", saveJson)
-     	await postPictures(files, "predict_plates", saveJson)
+     	await postPictures(files, "predict_all", saveJson)
 	showResult(files, save_json)
 }
 
@@ -115,7 +114,7 @@ function postPictures(files, action, callback) {
     		formData.append('file', file, file.name);
   	}
 
-	if(action == "predict_damages"){
+	if(action == "predict_damages" || action == "predict_all"){
 
 		trade_v = document.getElementById('trade').value;
 		console.log("TRADE:", trade_v);
@@ -167,6 +166,13 @@ function saveJson(json, files, action){
 		case "predict_plates":
 			save_json['plates_json'] = json
 			break;
+
+		case "predict_all":
+			save_json = {
+				'damages_json': {'damage_model': json.damage_model, 'damages': json.damages},
+				'plates_json': {'plate_model': json.plate_model, 'plates': json.plates},
+			}
+			break;
 	}
 }
 
@@ -0,0 +1,57 @@
+#! /usr/bin/env python3
+# coding: utf-8
+
+"""
+Export the price table of the PostgreSQL database to a local price snapshot (SQLite file).
+
+Usage (from the deployment folder, with the DATABASE_* environment variables of the API):
+    python export_price_snapshot.py --output /path/to/prices.db
+
+The API started with PRICE_BACKEND=snapshot and PRICE_SNAPSHOT_PATH=/path/to/prices.db serves
+the prices from the snapshot, and loads it again once this script replaced the file.
+"""
+
+import argparse
+import os
+import time
+
+from flask import Flask
+
+# (the whole table is read at once, the API statement timeout is too short for it)
+os.environ.setdefault("DB_STATEMENT_TIMEOUT_MS", "60000")
+
+from api_internals.config_postgres import DB_URL, PRICE_SNAPSHOT_PATH, Price, db, get_engine_options
+from api_internals.price_snapshot import read_snapshot, write_snapshot
+
+
+def export(output: str) -> int:
+    """ Writes the snapshot of the price table, returns its number of rows. """
+
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = DB_URL
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = get_engine_options(DB_URL)
+    db.init_app(app)
+
+    with app.app_context():
+        rows = db.session.query(
+            Price.part, Price.trade, Price.model, Price.year,
+            Price.price_repair, Price.price_replace,
+        ).all()
+
+    return write_snapshot(output, [tuple(row) for row in rows])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default=PRICE_SNAPSHOT_PATH, help="path of the snapshot file")
+    args = parser.parse_args()
+
+    count = export(args.output)
+
+    start = time.perf_counter()
+    index = read_snapshot(args.output)
+    print(f"{count} rows exported to {args.output} ({len(index)} prices, loaded in {(time.perf_counter() - start) * 1000:.1f} ms)")
+
+
+if __name__ == "__main__":
+    main()
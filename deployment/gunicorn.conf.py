@@ -0,0 +1,26 @@
+# Gunicorn settings of the API (gunicorn API_client_server:app -c gunicorn.conf.py)
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT') or 5000}"
+timeout = 60
+# (the per-request state is isolated, see tests/test_damage_aggregation.py, so a worker can run many threads)
+threads = int(os.environ.get("GUNICORN_THREADS") or 8)
+workers = int(os.environ.get("GUNICORN_WORKERS") or 1)
+
+# The models are loaded once in the master process and shared with the workers (copy-on-write)
+preload_app = True
+
+
+def post_fork(server, worker):
+    from api_internals import lifecycle
+
+    lifecycle.after_fork()
+
+
+def child_exit(server, worker):
+    # The metric files of a dead worker are removed from the aggregate (its livesum gauges would stay in it)
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,233 @@
+#! /usr/bin/env python3
+# coding: utf-8
+
+"""
+Build an INT8 version of the severity model and compare it with the fp32 model.
+
+Usage (from the deployment folder):
+    python quantize_severity.py quantize --mode dynamic
+    python quantize_severity.py quantize --mode static --crops path/to/crops
+    python quantize_severity.py compare --crops path/to/crops --output report.json
+
+The crops folder contains damage crops (any size, they are resized as in the API).
+If the crops are stored in sub-folders named after the damage classes (e.g. crops/hood_damage/*.jpg),
+the REPAIR / REPLACE decisions are compared with the threshold of each class,
+otherwise with every distinct non-zero threshold of DEFAULT_THRESHOLDS.
+Once the decision changes are acceptable, start the API with SEVERITY_PRECISION=int8.
+"""
+
+import argparse
+import json
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+import onnxruntime as rt
+
+from api_internals.config_severity import (
+    DEFAULT_THRESHOLDS,
+    SEVERITY_INPUT_SIZE,
+    SEVERITY_MODELS,
+    get_fixed_batch_size,
+    pad_severity_batch,
+    model_severity_input_name,
+    model_severity_output_name,
+)
+
+IMAGE_EXTENSIONS = {".bmp", ".jpeg", ".jpg", ".png", ".tif", ".tiff", ".webp"}
+
+FP32_PATH = Path("models", SEVERITY_MODELS["fp32"])
+INT8_PATH = Path("models", SEVERITY_MODELS["int8"])
+
+
+def load_crops(folder: Path) -> list:
+    """
+    Loads the crops of a folder with the same preprocessing as predict_damages.resize_severity_input.
+
+    Returns
+    -------
+    list:
+        A list of (class_name or None, float32 HWC crop) tuples.
+    """
+
+    crops = []
+    for path in sorted(folder.rglob("*")):
+        if path.suffix.lower() not in IMAGE_EXTENSIONS:
+            continue
+        image = cv2.imread(str(path), cv2.IMREAD_COLOR)
+        if image is None:
+            continue
+        crop = cv2.resize(np.asarray(image, dtype=np.float32), dsize=SEVERITY_INPUT_SIZE, interpolation=cv2.INTER_CUBIC)
+        class_name = path.parent.name if path.parent.name in DEFAULT_THRESHOLDS else None
+        crops.append((class_name, crop))
+    return crops
+
+
+class CropsDataReader:
+    """
+    Feeds the calibration crops to onnxruntime.quantization.quantize_static
+    (one by one, or by padded batches if the model has a fixed batch dimension).
+    """
+
+    def __init__(self, crops: list, batch_size: int = None):
+        inputs = np.stack([crop for _, crop in crops])
+        if batch_size is None:
+            self.iterator = (inputs[k:k + 1] for k in range(len(inputs)))
+        else:
+            self.iterator = (
+                pad_severity_batch(inputs[k:k + batch_size], batch_size) for k in range(0, len(inputs), batch_size)
+            )
+
+    def get_next(self):
+        batch = next(self.iterator, None)
+        if batch is None:
+            return None
+        return {model_severity_input_name: batch}
+
+
+def quantize(mode: str, crops_folder: str):
+    """ Writes the INT8 model next to the fp32 model (dynamic or static quantization). """
+
+    from onnxruntime.quantization import QuantType, quantize_dynamic, quantize_static
+
+    if mode == "dynamic":
+        quantize_dynamic(str(FP32_PATH), str(INT8_PATH), weight_type=QuantType.QInt8)
+    else:
+        if crops_folder is None:
+            raise SystemExit("The static quantization needs calibration crops (--crops)")
+        crops = load_crops(Path(crops_folder))
+        session = rt.InferenceSession(str(FP32_PATH), providers=["CPUExecutionProvider"])
+        quantize_static(
+            str(FP32_PATH),
+            str(INT8_PATH),
+            CropsDataReader(crops, get_fixed_batch_size(session)),
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+        )
+
+    print(f"INT8 model written to {INT8_PATH}")
+
+
+def run_model(path: Path, crops: list, batch_size: int) -> dict:
+    """
+    Scores every crop one by one (latency), then by batches (throughput).
+    If the model has a fixed batch dimension, the batches are padded as in predict_damages.get_severities
+    (a single crop is then scored in a padded batch).
+    """
+
+    session = rt.InferenceSession(str(path), providers=["CPUExecutionProvider"])
+
+    fixed_batch_size = get_fixed_batch_size(session)
+    if fixed_batch_size is not None:
+        batch_size = fixed_batch_size
+
+    def run(batch):
+        count = len(batch)
+        if fixed_batch_size is not None:
+            batch = pad_severity_batch(batch, fixed_batch_size)
+        return session.run([model_severity_output_name], {model_severity_input_name: batch})[0][:count, 0]
+
+    inputs = [crop for _, crop in crops]
+    run(inputs[0][np.newaxis])  # warmup
+
+    latencies, severities = [], []
+    for crop in inputs:
+        start = time.perf_counter()
+        severities.append(float(run(crop[np.newaxis])[0]))
+        latencies.append((time.perf_counter() - start) * 1000.0)
+
+    batch = np.stack(inputs)
+    start = time.perf_counter()
+    for k in range(0, len(batch), batch_size):
+        run(batch[k:k + batch_size])
+    elapsed = time.perf_counter() - start
+
+    return {
+        "latency_ms": {
+            "p50": float(np.percentile(latencies, 50)),
+            "p95": float(np.percentile(latencies, 95)),
+            "p99": float(np.percentile(latencies, 99)),
+        },
+        "throughput_crops_per_s": len(batch) / elapsed,
+        "severities": severities,
+    }
+
+
+def get_decision_changes(crops: list, fp32: list, int8: list) -> dict:
+    """ Counts the REPAIR / REPLACE decisions that change between the two models. """
+
+    thresholds = sorted({t for t in DEFAULT_THRESHOLDS.values() if t > 0.0})
+    changes = {}
+
+    for (class_name, _), s32, s8 in zip(crops, fp32, int8):
+        if class_name is not None:
+            crop_thresholds = [DEFAULT_THRESHOLDS[class_name]] if DEFAULT_THRESHOLDS[class_name] > 0.0 else []
+        else:
+            crop_thresholds = thresholds
+
+        for threshold in crop_thresholds:
+            key = f"{class_name or 'all'}@{threshold}"
+            entry = changes.setdefault(key, {"crops": 0, "REPAIR->REPLACE": 0, "REPLACE->REPAIR": 0})
+            entry["crops"] += 1
+            if s32 <= threshold < s8:
+                entry["REPAIR->REPLACE"] += 1
+            elif s8 <= threshold < s32:
+                entry["REPLACE->REPAIR"] += 1
+
+    return changes
+
+
+def compare(crops_folder: str, batch_size: int, output: str):
+    """ Prints (and optionally saves) the accuracy / latency comparison of the two models. """
+
+    crops = load_crops(Path(crops_folder))
+    if len(crops) == 0:
+        raise SystemExit(f"No crops found in {crops_folder}")
+
+    fp32 = run_model(FP32_PATH, crops, batch_size)
+    int8 = run_model(INT8_PATH, crops, batch_size)
+
+    diffs = np.abs(np.array(fp32["severities"]) - np.array(int8["severities"]))
+    changes = get_decision_changes(crops, fp32["severities"], int8["severities"])
+
+    report = {
+        "crops": len(crops),
+        "fp32": {k: v for k, v in fp32.items() if k != "severities"},
+        "int8": {k: v for k, v in int8.items() if k != "severities"},
+        "severity_abs_diff": {
+            "mean": float(diffs.mean()),
+            "p95": float(np.percentile(diffs, 95)),
+            "max": float(diffs.max()),
+        },
+        "decision_changes": changes,
+    }
+
+    print(json.dumps(report, indent=4))
+    if output is not None:
+        with open(output, "w") as fp:
+            json.dump(report, fp, indent=4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_quantize = subparsers.add_parser("quantize", help="build the INT8 severity model")
+    parser_quantize.add_argument("--mode", choices=["dynamic", "static"], default="dynamic")
+    parser_quantize.add_argument("--crops", help="calibration crops folder (static mode)")
+
+    parser_compare = subparsers.add_parser("compare", help="compare the fp32 and INT8 severity models")
+    parser_compare.add_argument("--crops", required=True, help="test crops folder")
+    parser_compare.add_argument("--batch-size", type=int, default=32)
+    parser_compare.add_argument("--output", help="save the report as JSON")
+
+    args = parser.parse_args()
+    if args.command == "quantize":
+        quantize(args.mode, args.crops)
+    else:
+        compare(args.crops, args.batch_size, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The tests import the API modules from the deployment folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The models are not loaded by the tests (the inference worker processes are never started)
+os.environ.setdefault("DAMAGE_WORKERS", "1")
+os.environ.setdefault("PLATE_WORKERS", "1")
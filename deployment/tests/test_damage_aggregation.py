@@ -0,0 +1,65 @@
+"""
+Reentrancy of the damage aggregation (RestrictDamagesPerClass): the requests served by the threads
+of a gunicorn worker aggregate their damages concurrently, and must not share any state.
+"""
+
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from api_internals.predict_damages import RestrictDamagesPerClass
+
+CLASSES = list(RestrictDamagesPerClass.dmg_dict)
+
+
+def make_batch(seed: int) -> list:
+    """ Returns a random batch of (class_name, pred_dict, score) damages (with some equal scores). """
+
+    rng = random.Random(seed)
+    batch = []
+    for index in range(rng.randint(1, 40)):
+        class_name = rng.choice(CLASSES)
+        pred_dict = {"type": class_name, "file": f"request_{seed}", "index": index, "probable_duplicate": False}
+        batch.append((class_name, pred_dict, round(rng.random(), 1)))
+    return batch
+
+
+def aggregate(batch: list) -> list:
+    """ Aggregates a batch and returns the (file, index, probable_duplicate) of the selected damages. """
+
+    predictions = RestrictDamagesPerClass()
+    for class_name, pred_dict, score in batch:
+        predictions.add_damage(class_name, dict(pred_dict), score)
+
+    return [(d["file"], d["index"], d["probable_duplicate"]) for d in predictions.get_selected()]
+
+
+@pytest.fixture
+def fast_switching():
+    # switch threads as often as possible, so that the requests interleave
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+def test_instances_do_not_share_state():
+    first, second = RestrictDamagesPerClass(), RestrictDamagesPerClass()
+    first.add_damage(CLASSES[0], {"type": CLASSES[0], "probable_duplicate": False}, 0.9)
+
+    assert len(first.get_selected()) == 1
+    assert second.get_selected() == []
+
+
+def test_concurrent_aggregations_match_sequential(fast_switching):
+    batches = [make_batch(seed) for seed in range(2000)]
+    expected = [aggregate(batch) for batch in batches]
+
+    with ThreadPoolExecutor(max_workers=32) as pool:
+        results = list(pool.map(aggregate, batches))
+
+    for batch, result, selection in zip(batches, results, expected):
+        assert all(file == batch[0][1]["file"] for file, _, _ in result), "a damage of another request was returned"
+        assert result == selection